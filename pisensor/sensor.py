@@ -1,28 +1,27 @@
 #!/usr/bin/env python3
 
-import os, sys, socket, signal, struct, hashlib, binascii, re, tzlocal
-import RPi.GPIO as GPIO
-from time import sleep
+import os, socket, signal, struct, binascii, tzlocal
+from time import sleep, perf_counter_ns, monotonic
 from datetime import datetime
-if sys.version_info.major == 3 and sys.version_info.minor < 9:
-    from backports.zoneinfo import ZoneInfo
-else:
-    from zoneinfo import ZoneInfo
-from iso6709 import Location
-from suntime import Sun
 import settings, globals
 from util.pyasync import proc
-from util.notifications import sendEmail, sendSMS
+from util.notifications import sendEmail, sendSMS, dispatcher, carriers
 from util.networking import getInternalIP
 from util.printing import debugException
+from util.gpio import loadGPIO, loadTimeline
+from util.events import EventEngine
+from util.control import ControlClient
+from util.infrared import IRScheduler, loadZoneCoords
+from util.journal import JournalWriter, SENSOR_MOTION, SENSOR_DOOR, SENSOR_WINDOW, SENSOR_ALARM
+from util.heartbeat import HeartbeatSender, nodeId, CAP_VIDEO, CAP_MOTION, CAP_DOOR, CAP_WINDOW, CAP_INFRARED, CAP_ALARM
 
 
 # TODO: move to settings.py
 #### app settings
 debug = True
-run_dir = '/run/shomesec'
+run_dir = settings.RUN_DIR
 pid_file = os.path.join(run_dir, 'pisense.pid')
-pivid_pid_file = os.path.join(run_dir, 'pivid.pid')
+pivid_control_sock = os.path.join(run_dir, 'pivid.sock')
 alarm_enabled = False
 motion_sensor_enabled = True
 door_sensor_enabled = True
@@ -37,36 +36,48 @@ infrared = 23 # GPIO 23 (pin 16)
 door = 27 # GPIO 27 (pin 13)
 window = 22 # GPIO 22 (pin 15)
 
-#### timezone variables
-tz_name = ""
-tz_sun_info = object()
+#### module variables
+GPIO = loadGPIO(settings.GPIO_BACKEND)
+video_control = ControlClient(pivid_control_sock)
 
-#### function definitions
-def setTimezoneInfo():
-    global tz_name, tz_to_coords, tz_sun_info
-
-    tz_name = tzlocal.get_localzone_name()
+ir_scheduler = None
+journal = None
+# last transition journaled per sensor
+sensor_states = {}
 
-    with open('/usr/share/zoneinfo/zone1970.tab', 'r') as f:
-        for line in f:
-            if line[0] == '#':
-                continue
-
-            fields = line.split('\t')
-            fields[2] = fields[2].strip()
-            if fields[2] != tz_name:
-                continue
+#### function definitions
+def startIRScheduler():
+    global ir_scheduler
 
-            loc = Location(re.search(r'((?:\+|-)[0-9]+(?:\+|-)[0-9]+)', fields[1]).groups()[0])
-            #tz_to_coords = {}
-            #tz_to_coords[fields[2].strip()] = [int(x) for x in re.search(r'((?:\+|-)[0-9]+)((?:\+|-)[0-9]+)', fields[1]).groups()]
+    if not camera_infrared_enabled:
+        GPIO.output(infrared, GPIO.HIGH)
+        print("Camera IR Disabled")
+        return
 
-    tz_sun_info = Sun(float(loc.lat.decimal), float(loc.lng.decimal))
+    tz_name = tzlocal.get_localzone_name()
+    coords = loadZoneCoords(tz_name, settings.IR_ZONE_CACHE)
+    if coords is None:
+        print("No coordinates known for timezone {}, camera IR stays inactive".format(tz_name))
+        return
+    ir_scheduler = IRScheduler(GPIO, infrared, tz_name, coords)
+    ir_scheduler.start()
+
+def logEvent(sensor, transition, timestamp=None):
+    """Journal a sensor transition, repeated readings of the same state are not transitions"""
+
+    if journal is None or sensor_states.get(sensor) == transition:
+        return
+    sensor_states[sensor] = transition
+    try:
+        journal.append(sensor, transition, timestamp)
+    except OSError as ex:
+        print("could not journal event: {}".format(str(ex)))
 
 def sigHandler(signum=None, frame=None):
     if signum == signal.SIGALRM.value:
         globals.alarm_active = True
         print("alarm triggered")
+        logEvent(SENSOR_ALARM, 1)
 
         text_msg = 'Your Alarm was Triggered at {}'.format(str(datetime.now()))
         html_msg = ('<html><head><style>.error{{border: 1px solid; margin: 10px 0px; padding: 15px 10px 15px 50px; background-color: #FF5555;}}</style></head>'
@@ -76,56 +87,38 @@ def sigHandler(signum=None, frame=None):
 
 def record():
     try:
-        with open(pivid_pid_file, 'r') as f:
-            pivid_pid = f.read()
-
-        if len(pivid_pid) > 0:
-            pivid_pid = int(pivid_pid)
-            # tell the pivid proc to record to file
-
-            os.kill(pivid_pid, signal.SIGUSR1)
-            print("recording to file")
-    except (FileNotFoundError, ProcessLookupError):
+        # tell the pivid proc to record to file
+        start = perf_counter_ns()
+        resp = video_control.send('start')
+    except OSError:
         print("pivid process is dead")
+        return
+    # an error ack comes from a live pivid that could not start the recording
+    if not resp.get('ok', False):
+        print("pivid could not start recording: {}".format(resp.get('error', 'unknown error')))
+        return
+    print("recording to file {} (ack in {} us)".format(resp['file'], (perf_counter_ns() - start) // 1000))
 
 def norecord():
     try:
-        with open(pivid_pid_file, 'r') as f:
-            pivid_pid = f.read()
-
-        if len(pivid_pid) > 0:
-            pivid_pid = int(pivid_pid)
-            # tell the pivid proc to stop recording to file
-
-            os.kill(pivid_pid, signal.SIGUSR2)
-            print("not recording to file")
-    except (FileNotFoundError, ProcessLookupError):
+        # tell the pivid proc to stop recording to file
+        start = perf_counter_ns()
+        resp = video_control.send('stop')
+    except OSError:
         print("pivid process is dead")
+        return
+    if not resp.get('ok', False):
+        print("pivid could not stop recording: {}".format(resp.get('error', 'unknown error')))
+        return
+    print("not recording to file (ack in {} us)".format((perf_counter_ns() - start) // 1000))
 
-def setIR():
-    if not camera_infrared_enabled:
-        GPIO.output(infrared, GPIO.HIGH)
-        print("Camera IR Disabled")
-    else:
-        now = datetime.now(tz=ZoneInfo(tz_name))
-        datenow = now.date()
-        sunrise = tz_sun_info.get_local_sunrise_time(datenow)
-        sunset = tz_sun_info.get_local_sunset_time(datenow)
-        if now < sunrise or now > sunset:
-            GPIO.output(infrared, GPIO.LOW)
-            print("Camera IR Active")
-        else:
-            GPIO.output(infrared, GPIO.HIGH)
-            print("Camera IR Inactive")
-
-def syncCurrentNode(ip):
+def syncCurrentNode(nodeid, ip):
     """send node info to web server"""
     sock = socket.socket()
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     try:
         sock.connect((settings.NODESYNC_HOST, settings.NODESYNC_PORT))
-        nodeid = binascii.hexlify(hashlib.sha256(bytes(ip+str(settings.VIDEO_PORT), 'utf-8')).digest())
         host = ip.encode('utf-8')
         port = settings.VIDEO_PORT
         req = struct.pack('<64s16si',nodeid,host,port)
@@ -135,18 +128,73 @@ def syncCurrentNode(ip):
     finally:
         sock.close()
 
+def getCapabilities():
+    capabilities = CAP_VIDEO
+    if motion_sensor_enabled:
+        capabilities |= CAP_MOTION
+    if door_sensor_enabled:
+        capabilities |= CAP_DOOR
+    if window_sensor_enabled:
+        capabilities |= CAP_WINDOW
+    if camera_infrared_enabled:
+        capabilities |= CAP_INFRARED
+    if alarm_enabled:
+        capabilities |= CAP_ALARM
+    return capabilities
+
+def videoStatsReader():
+    """
+    Returns a callable reporting (fps, active streams, disk free bytes) of the video server\n
+    fps is derived from the encoded frame count between two calls
+    """
+
+    control = ControlClient(pivid_control_sock)
+    last = [0, 0.0]
+
+    def getStats():
+        try:
+            status = control.send('status')
+        except (OSError, ValueError):
+            last[:] = [0, 0.0]
+            return 0.0, 0, 0
+        now = monotonic()
+        frames = status.get('frames_encoded', 0)
+        fps = (frames - last[0]) / (now - last[1]) if last[1] > 0 and frames >= last[0] else 0.0
+        last[:] = [frames, now]
+        return fps, status.get('active_streams', 0), status.get('disk_free', 0)
+
+    return getStats
+
 @proc
 def runSyncManager(delay):
     """Run in the background constantly updating web server"""
 
     internal_ip = getInternalIP()
 
+    # datagram heartbeats with live stats, the webserver notices a dead node within a few intervals
+    # without a configured webserver the heartbeats announce the node until a webserver answers
+    if settings.NODESYNC_PROTOCOL == 'udp':
+        sender = HeartbeatSender((settings.NODESYNC_HOST, settings.NODESYNC_PORT), internal_ip, settings.VIDEO_PORT,
+                                 settings.NODESYNC_INTERVAL, getCapabilities(), videoStatsReader(), getInternalIP,
+                                 settings.NODESYNC_DISCOVERY_GROUP, settings.NODESYNC_DISCOVERY_PORT,
+                                 os.path.join(run_dir, 'nodesync.json'), settings.EVENT_JOURNAL)
+        try:
+            sender.run()
+        finally:
+            sender.close()
+    elif settings.NODESYNC_HOST == '':
+        print('Web server discovery needs NODESYNC_PROTOCOL udp, set NODESYNC_HOST to use tcp')
+        return
+
+    nodeid = binascii.hexlify(nodeId(internal_ip, settings.VIDEO_PORT))
     while True:
-        syncCurrentNode(internal_ip)
+        syncCurrentNode(nodeid, internal_ip)
         sleep(delay)
 
 
 def setup():
+    global journal
+
     # setup GPIO pins
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
@@ -155,11 +203,19 @@ def setup():
     GPIO.setup(door, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
     GPIO.setup(window, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
 
+    # scripted pin transitions when running without sensor hardware
+    if settings.GPIO_BACKEND == 'simulated' and settings.GPIO_SIM_TIMELINE:
+        start, transitions = loadTimeline(settings.GPIO_SIM_TIMELINE)
+        GPIO.playTimeline(transitions, start)
+
     # initialize globals
     globals.initialize()
 
-    # set variables for all processes to use
-    setTimezoneInfo()
+    # the camera IR follows sunset and sunrise on its own timer
+    startIRScheduler()
+
+    # sensor transitions are journaled here and replicated to the webserver by the sync process
+    journal = JournalWriter(settings.EVENT_JOURNAL, nodeId(getInternalIP(), settings.VIDEO_PORT))
 
     # create pid file
     os.makedirs(run_dir, exist_ok=True)
@@ -172,38 +228,114 @@ def setup():
     # send data to the webserver in a separate process
     runSyncManager(settings.NODESYNC_DELAY)
 
+    # after the fork, the sync process does not need the smtp session
+    dispatcher.start()
+    if settings.SMS_NUMBER_PREWARM:
+        carriers.prewarm(settings.ALARM_NOTIFY_NUMBERS)
+
 def teardown():
+    if ir_scheduler is not None:
+        ir_scheduler.close()
+    dispatcher.close()
+    if journal is not None:
+        journal.close()
+    video_control.close()
     GPIO.cleanup()
     try:
         os.remove(pid_file)
     except:
         pass
 
-def main():
-    print("stabalizing sensors")
-    sleep(3)
+def onDoor(event):
+    # door sensor is closed when the pin is high
+    if event.value == GPIO.LOW:
+        print("door opened")
+        logEvent(SENSOR_DOOR, 1, event.timestamp)
+        if alarm_enabled:
+            # trigger alarm once until disarmed
+            if not globals.alarm_active:
+                os.kill(os.getpid(), signal.SIGALRM)
+    else:
+        print("door closed")
+        logEvent(SENSOR_DOOR, 0, event.timestamp)
+
+def onWindow(event):
+    # window sensor is closed when the pin is high
+    if event.value == GPIO.LOW:
+        print("window opened")
+        logEvent(SENSOR_WINDOW, 1, event.timestamp)
+        if alarm_enabled:
+            # trigger alarm once until disarmed
+            if not globals.alarm_active:
+                os.kill(os.getpid(), signal.SIGALRM)
+    else:
+        print("window closed")
+        logEvent(SENSOR_WINDOW, 0, event.timestamp)
+
+def onMotion(event):
+    # motion activates video recording to file
+    if event.value == GPIO.HIGH:
+        print("detected movement")
+        logEvent(SENSOR_MOTION, 1, event.timestamp)
+        record()
+    else:
+        print("no movement")
+        logEvent(SENSOR_MOTION, 0, event.timestamp)
+        norecord()
+
+def runEventLoop():
+    """Handle sensor transitions as they happen using edge interrupts"""
+
+    engine = EventEngine(GPIO)
+    if door_sensor_enabled:
+        engine.addSensor('door', door, onDoor, settings.SENSOR_DEBOUNCE['door'])
+    if window_sensor_enabled:
+        engine.addSensor('window', window, onWindow, settings.SENSOR_DEBOUNCE['window'])
+    if motion_sensor_enabled:
+        engine.addSensor('motion', motion, onMotion, settings.SENSOR_DEBOUNCE['motion'])
+
+    try:
+        engine.run()
+    finally:
+        engine.close()
+
+def runPollingLoop():
+    """Check all sensors every loop_delay seconds"""
 
     while True:
         # door opening checks for alarm
         if not GPIO.input(door):
             print("door opened")
+            logEvent(SENSOR_DOOR, 1)
             if alarm_enabled:
                 # trigger alarm once until disarmed
                 if not globals.alarm_active:
                     os.kill(os.getpid(), signal.SIGALRM)
+        else:
+            logEvent(SENSOR_DOOR, 0)
 
         # motion activates video recording to file
         if GPIO.input(motion):
             print("detected movement")
-            setIR()
+            logEvent(SENSOR_MOTION, 1)
             record()
         else:
             print("no movement")
+            logEvent(SENSOR_MOTION, 0)
             norecord()
 
         # delay between checks
         sleep(loop_delay)
 
+def main():
+    print("stabalizing sensors")
+    sleep(3)
+
+    if settings.SENSOR_EVENT_DRIVEN:
+        runEventLoop()
+    else:
+        runPollingLoop()
+
 #### main loop
 if __name__ == '__main__':
     try:
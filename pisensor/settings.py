@@ -12,11 +12,57 @@ MAIL_ASCII_ATTACHMENTS = False
 MAIL_DEFAULT_SENDER = 'Simple Home Security <{}>'.format(MAIL_USERNAME)
 MAIL_DEFAULT_SUBJECT = "Simple Home Security System Notification"
 SMS_NUMBER_LOOKUP_URL = 'https://api.telnyx.com/v1/phone_number/'
+# carrier lookups are cached on disk for SMS_NUMBER_CACHE_TTL seconds (30 days), misses are looked up in parallel
+SMS_NUMBER_CACHE = '/var/cache/shomesec/numbers.json'
+SMS_NUMBER_CACHE_TTL = 2592000
+SMS_NUMBER_LOOKUP_WORKERS = 4
+# look up ALARM_NOTIFY_NUMBERS at boot so the first alarm does not wait on the lookup service
+SMS_NUMBER_PREWARM = True
+# alerts share one smtp session kept open with a NOOP every NOTIFY_SMTP_KEEPALIVE seconds, 0 connects for each send
+NOTIFY_SMTP_KEEPALIVE = 60
+# alerts to a recipient within NOTIFY_DIGEST_WINDOW seconds of the last one are sent together as a digest
+NOTIFY_DIGEST_WINDOW = 30
+# failed sends are retried after NOTIFY_RETRY_BACKOFF seconds, doubling up to NOTIFY_RETRY_MAX seconds
+NOTIFY_RETRY_BACKOFF = 5
+NOTIFY_RETRY_MAX = 600
+NOTIFY_MAX_ATTEMPTS = 10
+# queued alerts are kept on disk so they survive a crash or restart
+NOTIFY_OUTBOX = '/var/spool/shomesec/outbox.json'
 
 # settings for node sync server
-NODESYNC_HOST = '192.168.1.131'
+# empty discovers the webserver through the discovery group (udp only), the last one found is remembered in RUN_DIR
+NODESYNC_HOST = ''
 NODESYNC_PORT = 10001
 NODESYNC_DELAY = 60
+# udp sends a heartbeat with live stats every NODESYNC_INTERVAL seconds, tcp connects every NODESYNC_DELAY seconds
+NODESYNC_PROTOCOL = 'udp'
+NODESYNC_INTERVAL = 2
+# multicast (or broadcast) address to announce to and receive webserver probes on, must match the webserver
+NODESYNC_DISCOVERY_GROUP = '239.255.10.1'
+NODESYNC_DISCOVERY_PORT = 10005
 
 # settings for video server
 VIDEO_PORT = 10000
+
+# runtime files shared with the video server
+RUN_DIR = '/run/shomesec'
+
+# append-only journal of motion, door, window and alarm events, replicated to the webserver over udp node sync
+EVENT_JOURNAL = '/var/lib/shomesec/events.journal'
+
+# timezone coordinates for the camera IR sunrise / sunset schedule, zone1970.tab is only read on a miss
+IR_ZONE_CACHE = '/var/cache/shomesec/zones.json'
+
+# GPIO settings
+# backend for the sensor pins: rpi | simulated
+GPIO_BACKEND = 'rpi'
+# json file of scripted pin transitions for the simulated backend (see util.gpio.loadTimeline)
+GPIO_SIM_TIMELINE = ''
+# react to pin edge interrupts instead of polling every second
+SENSOR_EVENT_DRIVEN = True
+# debounce window per sensor in milliseconds
+SENSOR_DEBOUNCE = {
+    'motion': 50,
+    'door': 100,
+    'window': 100
+}
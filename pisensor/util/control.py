@@ -0,0 +1,68 @@
+'''
+@Summary: Contains the client for the video server control channel
+@Author: devopsec
+'''
+
+import socket, json
+from threading import Lock
+
+
+class ControlClient():
+    """
+    Persistent connection to the video server control socket\n
+    Reconnects transparently when the video server restarts
+    """
+
+    def __init__(self, path, timeout=2):
+        self.path = path
+        self.timeout = timeout
+        self.lock = Lock()
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def send(self, cmd, **kwargs):
+        """
+        Send a command and wait for its acknowledgement
+
+        :param cmd:         start | stop | mark | status
+        :type cmd:          str
+        :return:            response from the video server
+        :rtype:             dict
+        :raises OSError:    when the video server can not be reached
+        """
+
+        request = json.dumps(dict(kwargs, cmd=cmd)).encode('utf-8') + b'\n'
+
+        with self.lock:
+            # one retry covers a stale connection from a previous video server process
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(request)
+                    line = self.reader.readline()
+                    if len(line) == 0:
+                        raise ConnectionResetError('control channel closed')
+                    return json.loads(line)
+                except OSError:
+                    self.close()
+                    if attempt == 1:
+                        raise
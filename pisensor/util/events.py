@@ -0,0 +1,126 @@
+'''
+@Summary: Contains the edge-interrupt event engine for the sensor pins
+@Author: devopsec
+'''
+
+import queue
+from collections import namedtuple
+from time import time, monotonic
+from threading import Lock, Timer
+
+
+# a debounced transition of a sensor pin
+SensorEvent = namedtuple('SensorEvent', ['timestamp', 'name', 'pin', 'value'])
+
+
+class EventEngine():
+    """
+    Turns GPIO edge interrupts into debounced sensor events\n
+    Edge callbacks only enqueue events, handlers run on the thread calling run()\n
+    The first edge is reported immediately and further edges within the debounce window
+    are ignored, then the pin is re-read once the window closes so a release is never lost
+    """
+
+    def __init__(self, gpio):
+        """
+        :param gpio:    backend exposing the RPi.GPIO interface (see util.gpio.loadGPIO)
+        """
+
+        self.gpio = gpio
+        self.pins = {}
+        self.lock = Lock()
+        self.events = queue.Queue()
+        self.running = False
+
+    def addSensor(self, name, pin, handler, debounce=0):
+        """
+        Watch an input pin and call handler(event) on each debounced transition
+
+        :param name:        sensor name reported in events
+        :type name:         str
+        :param pin:         input pin, must already be set up
+        :type pin:          int
+        :param handler:     callable receiving a SensorEvent
+        :type handler:      callable
+        :param debounce:    debounce window in milliseconds
+        :type debounce:     int
+        """
+
+        with self.lock:
+            self.pins[pin] = {
+                'name': name,
+                'handler': handler,
+                'debounce': debounce / 1000,
+                'level': self.gpio.input(pin),
+                'last_event': 0.0,
+                'timer': None,
+            }
+        self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self.edgeCallback)
+
+    def removeSensor(self, pin):
+        self.gpio.remove_event_detect(pin)
+        with self.lock:
+            pin_info = self.pins.pop(pin, None)
+        if pin_info is not None and pin_info['timer'] is not None:
+            pin_info['timer'].cancel()
+
+    def edgeCallback(self, pin):
+        """ Runs on the GPIO interrupt thread, must stay short """
+
+        now = monotonic()
+        with self.lock:
+            pin_info = self.pins.get(pin)
+            if pin_info is None:
+                return
+
+            remaining = pin_info['debounce'] - (now - pin_info['last_event'])
+            if remaining > 0:
+                if pin_info['timer'] is None:
+                    pin_info['timer'] = Timer(remaining, self.settle, (pin,))
+                    pin_info['timer'].daemon = True
+                    pin_info['timer'].start()
+                return
+
+            self.sample(pin, pin_info, now)
+
+    def settle(self, pin):
+        with self.lock:
+            pin_info = self.pins.get(pin)
+            if pin_info is None:
+                return
+            pin_info['timer'] = None
+            self.sample(pin, pin_info, monotonic())
+
+    def sample(self, pin, pin_info, now):
+        """ Must be called with the lock held """
+
+        level = self.gpio.input(pin)
+        if level == pin_info['level']:
+            return
+        pin_info['level'] = level
+        pin_info['last_event'] = now
+        self.events.put(SensorEvent(time(), pin_info['name'], pin, level))
+
+    def run(self):
+        """
+        Dispatch events to their handlers until stop() is called
+        """
+
+        self.running = True
+        while self.running:
+            try:
+                event = self.events.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            pin_info = self.pins.get(event.pin)
+            if pin_info is not None:
+                pin_info['handler'](event)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.stop()
+        for pin in list(self.pins.keys()):
+            self.removeSensor(pin)
@@ -0,0 +1,155 @@
+'''
+@Summary: Contains GPIO backends for the sensor pins
+@Author: devopsec
+'''
+
+import json
+from time import time, sleep
+from threading import Lock, Thread
+
+
+def loadGPIO(backend='rpi'):
+    """
+    Load a GPIO backend exposing the RPi.GPIO interface
+
+    :param backend:         rpi | simulated
+    :type backend:          str
+    :return:                RPi.GPIO module or a simulated equivalent
+    :rtype:                 module|SimulatedGPIO
+    :raises ValueError:     on unknown backend
+    """
+
+    if backend == 'rpi':
+        import RPi.GPIO as GPIO
+        return GPIO
+    elif backend == 'simulated':
+        return SimulatedGPIO()
+    raise ValueError("unknown GPIO backend: {}".format(backend))
+
+def loadTimeline(path):
+    """
+    Load a scripted list of pin transitions for the simulated backend
+
+    The file is json: {"start": <epoch or null>, "transitions": [[<seconds after start>, <pin>, <0|1>], ...]}\n
+    A null start means the timeline starts when it is played
+
+    :param path:    timeline file
+    :type path:     str
+    :return:        start time and sorted transitions
+    :rtype:         tuple
+    """
+
+    with open(path, 'r') as fp:
+        timeline = json.load(fp)
+    transitions = sorted((float(at), int(pin), int(value)) for at, pin, value in timeline['transitions'])
+    return timeline.get('start'), transitions
+
+
+class SimulatedGPIO():
+    """
+    In-memory stand-in for the subset of RPi.GPIO used by the sensor\n
+    Input levels are driven with setInput(), which fires edge callbacks like the real interrupt thread
+    """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = Lock()
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.callbacks = {}
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        with self.lock:
+            self.directions[channel] = direction
+            if direction == self.OUT:
+                self.levels[channel] = initial if initial is not None else self.LOW
+            elif channel not in self.levels:
+                self.levels[channel] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, channel):
+        return self.levels[channel]
+
+    def output(self, channel, value):
+        if self.directions.get(channel) != self.OUT:
+            raise RuntimeError("channel {} is not set up as an output".format(channel))
+        self.levels[channel] = self.HIGH if value else self.LOW
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if self.directions.get(channel) != self.IN:
+            raise RuntimeError("channel {} is not set up as an input".format(channel))
+        with self.lock:
+            self.callbacks[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel):
+        with self.lock:
+            self.callbacks.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        with self.lock:
+            if channel is None:
+                self.directions.clear()
+                self.levels.clear()
+                self.callbacks.clear()
+            else:
+                self.directions.pop(channel, None)
+                self.levels.pop(channel, None)
+                self.callbacks.pop(channel, None)
+
+    def playTimeline(self, transitions, start=None):
+        """
+        Drive input pins from a background thread following a scripted timeline
+
+        :param transitions:     (seconds after start, pin, value) tuples sorted by time
+        :type transitions:      list
+        :param start:           epoch the offsets are relative to, defaults to now
+        :type start:            float
+        """
+
+        start = time() if start is None else start
+
+        def play():
+            for at, channel, value in transitions:
+                delay = start + at - time()
+                if delay > 0:
+                    sleep(delay)
+                self.setInput(channel, value)
+
+        thr = Thread(target=play, daemon=True)
+        thr.start()
+        return thr
+
+    def setInput(self, channel, value):
+        """
+        Drive an input pin, firing its edge callback on a transition
+        """
+
+        value = self.HIGH if value else self.LOW
+        with self.lock:
+            previous = self.levels.get(channel)
+            self.levels[channel] = value
+            edge, callback = self.callbacks.get(channel, (None, None))
+
+        if callback is None or previous == value:
+            return
+        if edge == self.BOTH or (edge == self.RISING and value == self.HIGH) or \
+                (edge == self.FALLING and value == self.LOW):
+            callback(channel)
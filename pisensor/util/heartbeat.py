@@ -0,0 +1,287 @@
+'''
+@Summary: Contains the datagram heartbeat sent to the webserver node sync server
+@Author: devopsec
+
+Every heartbeat is a single datagram:
+    magic (4s) version (B) capabilities (H) node id (32s) ip (4s) video port (H) sequence (I) interval ms (H)
+    fps (f) active streams (H) disk free bytes (Q) cpu temperature (f)
+Unknown stats are sent as 0, an unknown temperature as NaN
+
+Without a configured webserver the sensor announces itself by sending its heartbeats to a discovery group
+(multicast or broadcast address). Webservers probe the group and answer announcements with a probe:
+    magic (4s) version (B) node sync port (H)
+and the sensor sends its heartbeats to the address the probe came from from then on
+
+Event journal records the webserver has not acknowledged are sent with every heartbeat, up to a burst of datagrams:
+    magic (4s) version (B) node id (32s) journal created (Q) first record (I) record count (B) records
+The webserver answers with the number of records it holds, records are sent again from there until it has all:
+    magic (4s) version (B) journal created (Q) next record (I)
+'''
+
+import os, socket, struct, hashlib, select, json, ipaddress
+from time import monotonic
+from util.journal import JournalReader, JOURNAL_RECORD
+
+HEARTBEAT_MAGIC = b'SHHB'
+PROBE_MAGIC = b'SHPR'
+EVENTS_MAGIC = b'SHEV'
+ACK_MAGIC = b'SHEA'
+PROTOCOL_VERSION = 1
+HEARTBEAT = struct.Struct('<4sBH32s4sHIHfHQf')
+PROBE = struct.Struct('<4sBH')
+EVENTS = struct.Struct('<4sB32sQIB')
+ACK = struct.Struct('<4sBQI')
+# records per datagram and datagrams per heartbeat, a datagram stays below a 1500 byte mtu
+EVENTS_PER_DATAGRAM = 64
+EVENTS_BURST = 4
+CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+# capabilities
+CAP_VIDEO = 0x01
+CAP_MOTION = 0x02
+CAP_DOOR = 0x04
+CAP_WINDOW = 0x08
+CAP_INFRARED = 0x10
+CAP_ALARM = 0x20
+
+
+def nodeId(ip, port):
+    """
+    :return:    sha256 digest identifying the node, the webserver uses its hex form as sensor id
+    :rtype:     bytes
+    """
+
+    return hashlib.sha256(bytes(ip + str(port), 'utf-8')).digest()
+
+def parseProbe(data):
+    """
+    :return:    node sync port of the probing webserver, None if data is not a probe
+    :rtype:     int|None
+    """
+
+    if len(data) != PROBE.size:
+        return None
+    magic, version, port = PROBE.unpack(data)
+    if magic != PROBE_MAGIC or version != PROTOCOL_VERSION:
+        return None
+    return port
+
+def parseAck(data):
+    """
+    :return:    journal created time and the next record the webserver expects, None if data is not an ack
+    :rtype:     tuple|None
+    """
+
+    if len(data) != ACK.size:
+        return None
+    magic, version, created, next_record = ACK.unpack(data)
+    if magic != ACK_MAGIC or version != PROTOCOL_VERSION:
+        return None
+    return created, next_record
+
+
+class HeartbeatSender():
+    """
+    Sends a heartbeat with live stats to the webserver every interval\n
+    Everything that does not change is packed once, each beat only fills in the sequence number and stats\n
+    In discovery mode heartbeats go to the discovery group until a webserver probe names the server,
+    the last discovered server is cached on disk so a restarted sensor reaches it right away\n
+    The event journal is replicated to the webserver, records go out with the heartbeats until they are acknowledged
+    """
+
+    def __init__(self, addr, ip, port, interval=2, capabilities=CAP_VIDEO, get_stats=None, get_ip=None,
+                 discovery_group='', discovery_port=0, cache_path=None, journal_path=None):
+        """
+        :param addr:                webserver node sync address, an empty host discovers the webserver
+        :type addr:                 tuple
+        :param ip:                  address the video server is reachable at
+        :type ip:                   str
+        :param port:                video server port
+        :type port:                 int
+        :param interval:            seconds between heartbeats
+        :type interval:             float
+        :param capabilities:        CAP_* flags
+        :type capabilities:         int
+        :param get_stats:           callable returning (fps, active streams, disk free bytes)
+        :type get_stats:            callable
+        :param get_ip:              callable returning the current address, checked before every heartbeat
+        :type get_ip:               callable
+        :param discovery_group:     multicast or broadcast address announcements are sent to on the node sync port
+        :type discovery_group:      str
+        :param discovery_port:      port to receive probes on
+        :type discovery_port:       int
+        :param cache_path:          file remembering the discovered webserver
+        :type cache_path:           str
+        :param journal_path:        event journal to replicate to the webserver
+        :type journal_path:         str
+        """
+
+        self.interval = interval
+        self.get_stats = get_stats
+        self.get_ip = get_ip
+        # the node id stays the same when the address changes, the webserver updates the address of the sensor
+        self.node_id = nodeId(ip, port)
+        self.capabilities = capabilities
+        self.port = port
+        self.setAddress(ip)
+        self.interval_ms = min(int(interval * 1000), 0xffff)
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addr = addr
+        self.discovery = None
+        self.cache_path = cache_path
+        if addr[0] == '':
+            self.discovery = (discovery_group, addr[1])
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('', discovery_port))
+            if ipaddress.ip_address(discovery_group).is_multicast:
+                membership = struct.pack('4sl', socket.inet_aton(discovery_group), socket.INADDR_ANY)
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            else:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.addr = self.loadCache()
+        # heartbeats also go to the discovery group until a probe confirms the server
+        self.confirmed = self.discovery is None
+        self.journal_path = journal_path
+        self.journal = None
+        # first record the webserver has not acknowledged
+        self.journal_next = 0
+        try:
+            self.temp_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+        except OSError:
+            self.temp_fd = None
+
+    def readCpuTemp(self):
+        """
+        :return:    cpu temperature in degrees celsius, NaN if unknown
+        :rtype:     float
+        """
+
+        if self.temp_fd is None:
+            return float('nan')
+        try:
+            return int(os.pread(self.temp_fd, 16, 0)) / 1000
+        except (OSError, ValueError):
+            return float('nan')
+
+    def setAddress(self, ip):
+        self.ip = ip
+        self.fields = (HEARTBEAT_MAGIC, PROTOCOL_VERSION, self.capabilities, self.node_id, socket.inet_aton(ip), self.port)
+
+    def loadCache(self):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'r') as fp:
+                host, port = json.load(fp)
+                return host, port
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def saveCache(self):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path, 'w') as fp:
+                json.dump(self.addr, fp)
+        except OSError as ex:
+            print('Could not cache web server address: {}'.format(str(ex)))
+
+    def send(self):
+        if self.get_ip is not None:
+            try:
+                ip = self.get_ip()
+                if ip != self.ip:
+                    print('Address changed from {} to {}'.format(self.ip, ip))
+                    self.setAddress(ip)
+            except Exception as ex:
+                print('Could not determine address: {}'.format(str(ex)))
+
+        fps, streams, disk_free = self.get_stats() if self.get_stats is not None else (0.0, 0, 0)
+        self.seq = (self.seq + 1) & 0xffffffff
+        beat = HEARTBEAT.pack(*self.fields, self.seq, self.interval_ms, fps, min(streams, 0xffff), disk_free,
+                              self.readCpuTemp())
+        destinations = [self.addr] if self.addr is not None else []
+        if not self.confirmed:
+            destinations.append(self.discovery)
+        for addr in destinations:
+            try:
+                self.sock.sendto(beat, addr)
+            except OSError as ex:
+                print('Could not send heartbeat to {}: {}'.format(str(addr), str(ex)))
+        self.sendEvents()
+
+    def sendEvents(self):
+        """ Send journal records the webserver has not acknowledged yet """
+
+        if self.journal_path is None or self.addr is None:
+            return
+        if self.journal is None:
+            try:
+                self.journal = JournalReader(self.journal_path)
+            except (OSError, ValueError):
+                return
+        self.journal.refresh()
+        stop = min(self.journal.count, self.journal_next + EVENTS_PER_DATAGRAM * EVENTS_BURST)
+        for first in range(self.journal_next, stop, EVENTS_PER_DATAGRAM):
+            records = self.journal.raw(first, min(first + EVENTS_PER_DATAGRAM, stop))
+            datagram = EVENTS.pack(EVENTS_MAGIC, PROTOCOL_VERSION, self.node_id, self.journal.created, first,
+                                   len(records) // JOURNAL_RECORD.size) + records
+            try:
+                self.sock.sendto(datagram, self.addr)
+            except OSError as ex:
+                print('Could not send events to {}: {}'.format(str(self.addr), str(ex)))
+                return
+
+    def receive(self, timeout):
+        """
+        Wait up to timeout for webserver probes and event acknowledgements
+
+        :return:    True if a probe named a new webserver
+        :rtype:     bool
+        """
+
+        readable, _, _ = select.select((self.sock,), (), (), timeout)
+        if len(readable) == 0:
+            return False
+        try:
+            data, (host, _) = self.sock.recvfrom(max(PROBE.size, ACK.size) + 1)
+        except OSError:
+            return False
+        ack = parseAck(data)
+        if ack is not None:
+            if self.journal is not None and ack[0] == self.journal.created:
+                self.journal_next = ack[1]
+                # keep going while the webserver is behind
+                if self.journal_next < self.journal.count:
+                    self.sendEvents()
+            return False
+        port = parseProbe(data)
+        if port is None:
+            return False
+        addr = (host, port)
+        self.confirmed = True
+        if addr == self.addr:
+            return False
+        print('Discovered web server at {}'.format(str(addr)))
+        self.addr = addr
+        self.saveCache()
+        return True
+
+    def run(self):
+        deadline = monotonic()
+        while True:
+            self.send()
+            # fixed schedule, a slow stats query does not stretch the interval
+            deadline = max(deadline + self.interval, monotonic())
+            while monotonic() < deadline:
+                if self.receive(max(deadline - monotonic(), 0)):
+                    # a newly discovered server hears from us right away
+                    break
+
+    def close(self):
+        self.sock.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.temp_fd is not None:
+            os.close(self.temp_fd)
@@ -0,0 +1,175 @@
+'''
+@Summary: Contains the scheduler switching the camera IR on between sunset and sunrise
+@Author: devopsec
+'''
+
+import os, sys, re, json
+from datetime import datetime, timedelta, time
+from threading import Condition, Thread
+if sys.version_info.major == 3 and sys.version_info.minor < 9:
+    from backports.zoneinfo import ZoneInfo
+else:
+    from zoneinfo import ZoneInfo
+from iso6709 import Location
+from suntime import Sun, SunTimeException
+
+ZONE_TAB = '/usr/share/zoneinfo/zone1970.tab'
+
+
+def findZoneCoords(tz_name, zone_tab=ZONE_TAB):
+    """
+    :return:    latitude and longitude of the principal location of the timezone, None if it is not listed
+    :rtype:     tuple|None
+    """
+
+    with open(zone_tab, 'r') as f:
+        for line in f:
+            if line[0] == '#':
+                continue
+
+            fields = line.split('\t')
+            if fields[2].strip() != tz_name:
+                continue
+
+            loc = Location(re.search(r'((?:\+|-)[0-9]+(?:\+|-)[0-9]+)', fields[1]).groups()[0])
+            return float(loc.lat.decimal), float(loc.lng.decimal)
+    return None
+
+def loadZoneCoords(tz_name, cache_path=None, zone_tab=ZONE_TAB):
+    """
+    Coordinates of the timezone, zone_tab is only scanned when the cache does not know the timezone yet
+
+    :return:    latitude and longitude, None if the timezone is not listed
+    :rtype:     tuple|None
+    """
+
+    cache = {}
+    if cache_path is not None:
+        try:
+            with open(cache_path, 'r') as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            cache = {}
+    if tz_name in cache:
+        return tuple(cache[tz_name])
+
+    coords = findZoneCoords(tz_name, zone_tab)
+    if coords is not None and cache_path is not None:
+        cache[tz_name] = coords
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'w') as fp:
+                json.dump(cache, fp)
+        except OSError as ex:
+            print('Could not cache timezone coordinates: {}'.format(str(ex)))
+    return coords
+
+
+class IRScheduler():
+    """
+    Switches the camera IR on between sunset and sunrise\n
+    Sunrise and sunset are computed once per day, a timer wakes up at each transition
+    and the pin is only written when the state changes\n
+    The timer also wakes up every check interval, a clock set late (no rtc before ntp sync) is caught up quickly
+    """
+
+    def __init__(self, gpio, pin, tz_name, coords, check_interval=60):
+        """
+        :param gpio:            gpio backend driving the pin
+        :type gpio:             module|object
+        :param pin:             pin switching the IR, low turns it on
+        :type pin:              int
+        :param tz_name:         local timezone
+        :type tz_name:          str
+        :param coords:          latitude and longitude to compute sunrise and sunset for
+        :type coords:           tuple
+        :param check_interval:  longest time in seconds between checks of the clock
+        :type check_interval:   float
+        """
+
+        self.gpio = gpio
+        self.pin = pin
+        self.tz = ZoneInfo(tz_name)
+        self.sun = Sun(*coords)
+        self.check_interval = check_interval
+        self.condition = Condition()
+        self.running = False
+        self.day = None
+        self.sunrise = None
+        self.sunset = None
+        # None until the pin was first written
+        self.active = None
+        self.switches = 0
+
+    def computeDay(self, day):
+        self.day = day
+        try:
+            self.sunrise = self.sun.get_local_sunrise_time(day, self.tz)
+            self.sunset = self.sun.get_local_sunset_time(day, self.tz)
+        except SunTimeException as ex:
+            # the sun does not rise or set at all today
+            print('No sunrise / sunset on {}: {}'.format(str(day), str(ex)))
+            self.sunrise = self.sunset = None
+            return
+        # suntime can return the sunset of the previous day for zones far from their meridian
+        if self.sunset < self.sunrise:
+            self.sunset += timedelta(days=1)
+        print('Camera IR scheduled for sunset at {} and sunrise at {}'.format(
+            self.sunset.strftime('%H:%M:%S'), self.sunrise.strftime('%H:%M:%S')))
+
+    def isNight(self, now):
+        if now.date() != self.day:
+            self.computeDay(now.date())
+        if self.sunrise is None:
+            return False
+        return now < self.sunrise or now >= self.sunset
+
+    def nextTransition(self, now):
+        for transition in (self.sunrise, self.sunset):
+            if transition is not None and transition > now:
+                return transition
+        return datetime.combine(now.date() + timedelta(days=1), time(), tzinfo=self.tz)
+
+    def setActive(self, active):
+        if active == self.active:
+            return
+        self.gpio.output(self.pin, self.gpio.LOW if active else self.gpio.HIGH)
+        self.active = active
+        self.switches += 1
+        print("Camera IR Active" if active else "Camera IR Inactive")
+
+    def update(self):
+        """
+        :return:    the time the state was checked at
+        :rtype:     datetime
+        """
+
+        now = datetime.now(tz=self.tz)
+        self.setActive(self.isNight(now))
+        return now
+
+    def run(self):
+        while True:
+            now = self.update()
+            timeout = min((self.nextTransition(now) - now).total_seconds(), self.check_interval)
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running, max(timeout, 0))
+                if not self.running:
+                    break
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def getStats(self):
+        return {
+            'active': self.active,
+            'sunrise': self.sunrise.isoformat() if self.sunrise is not None else None,
+            'sunset': self.sunset.isoformat() if self.sunset is not None else None,
+            'switches': self.switches,
+        }
@@ -0,0 +1,158 @@
+'''
+@Summary: Contains the append-only journal of sensor events
+@Author: devopsec
+
+Every motion, door, window and alarm transition is appended as one fixed size record:
+    header:     magic (4s) version (H) record size (H) created (Q, microseconds since the epoch)
+    records:    timestamp (d) node (8s) sensor (B) transition (B)
+Timestamps never go backwards within a journal, so it is sorted by time and can be binary searched in place.
+The created time identifies the journal, a journal that was recreated starts over at record 0.
+'''
+
+import os, mmap, struct
+from time import time
+
+JOURNAL_MAGIC = b'SHEJ'
+JOURNAL_VERSION = 1
+JOURNAL_HEADER = struct.Struct('<4sHHQ')
+JOURNAL_RECORD = struct.Struct('<d8sBB')
+
+# sensors
+SENSOR_MOTION = 1
+SENSOR_DOOR = 2
+SENSOR_WINDOW = 3
+SENSOR_ALARM = 4
+
+
+def readHeader(fp, path):
+    """
+    :return:                created time of the journal and its number of whole records
+    :rtype:                 tuple
+    :raises ValueError:     if the file is not an event journal
+    """
+
+    header = fp.read(JOURNAL_HEADER.size)
+    if len(header) < JOURNAL_HEADER.size:
+        raise ValueError('truncated journal {}'.format(path))
+    magic, version, record_size, created = JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or record_size != JOURNAL_RECORD.size:
+        raise ValueError('unsupported journal {}'.format(path))
+    size = os.fstat(fp.fileno()).st_size
+    return created, (size - JOURNAL_HEADER.size) // JOURNAL_RECORD.size
+
+
+class JournalWriter():
+    """
+    Appends records to a journal, each record is a single write to a file opened for appending\n
+    A partial record left by a crash is cut off when the journal is opened
+    """
+
+    def __init__(self, path, node=b''):
+        """
+        :param path:    journal file, created if it does not exist
+        :type path:     str
+        :param node:    node the events happened on, the first 8 bytes of its node id
+        :type node:     bytes
+        """
+
+        self.path = path
+        self.node = node[:8]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            self.created = int(time() * 1000000)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, JOURNAL_RECORD.size, self.created))
+            os.replace(path + '.tmp', path)
+        with open(path, 'rb') as fp:
+            self.created, self.count = readHeader(fp, path)
+            self.last = 0.0
+            if self.count > 0:
+                fp.seek(JOURNAL_HEADER.size + (self.count - 1) * JOURNAL_RECORD.size)
+                self.last = JOURNAL_RECORD.unpack(fp.read(JOURNAL_RECORD.size))[0]
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        os.truncate(self.fd, JOURNAL_HEADER.size + self.count * JOURNAL_RECORD.size)
+
+    def append(self, sensor, transition, timestamp=None):
+        """
+        :param sensor:      SENSOR_* the event came from
+        :type sensor:       int
+        :param transition:  1 when the sensor became active, 0 when it became inactive
+        :type transition:   int
+        :return:            number of the record
+        :rtype:             int
+        """
+
+        # a clock set back does not break the time order
+        self.last = max(timestamp if timestamp is not None else time(), self.last)
+        os.write(self.fd, JOURNAL_RECORD.pack(self.last, self.node, sensor, transition))
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JournalReader():
+    """
+    Memory mapped reader of a journal, records are read in place and nothing is loaded up front\n
+    refresh() maps records appended since the journal was opened
+    """
+
+    def __init__(self, path):
+        """
+        :raises ValueError:     if the file is not an event journal
+        """
+
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.map = None
+        self.count = 0
+        try:
+            self.created, _ = readHeader(self.fp, path)
+        except:
+            self.fp.close()
+            raise
+        self.refresh()
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def refresh(self):
+        """
+        :return:    True if records were appended since the last refresh
+        :rtype:     bool
+        """
+
+        size = os.fstat(self.fp.fileno()).st_size
+        # a journal still being written may end in a partial record, ignore it
+        count = (size - JOURNAL_HEADER.size) // JOURNAL_RECORD.size
+        if count == self.count:
+            return False
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = count
+        return True
+
+    def raw(self, start, stop):
+        """
+        :return:    records start to stop as stored
+        :rtype:     bytes
+        """
+
+        start, stop = max(start, 0), min(stop, self.count)
+        if start >= stop:
+            return b''
+        return self.map[JOURNAL_HEADER.size + start * JOURNAL_RECORD.size:JOURNAL_HEADER.size + stop * JOURNAL_RECORD.size]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fp.close()
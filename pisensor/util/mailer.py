@@ -0,0 +1,354 @@
+'''
+@Summary: Contains the mail dispatcher that sends alerts over one persistent smtp session
+@Author: devopsec
+'''
+
+import os, json, smtplib, uuid
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from time import time, monotonic
+from threading import Condition, Thread
+
+
+def buildMessage(sender, recipients, subject, text_body, html_body=None, attachments=()):
+    """
+    :return:    multipart message with the plain text body, optional html body and attachments
+    :rtype:     str
+    """
+
+    msg_root = MIMEMultipart('alternative')
+    msg_root['From'] = sender
+    msg_root['To'] = ", ".join(recipients)
+    msg_root['Subject'] = subject
+    msg_root.preamble = "|-------------------MULTIPART_BOUNDARY-------------------|\n"
+
+    msg_root.attach(MIMEText(text_body, 'plain'))
+
+    if html_body is not None and html_body != "":
+        msg_root.attach(MIMEText(html_body, 'html'))
+
+    for file in attachments:
+        try:
+            with open(file, 'rb') as fp:
+                msg_attachments = MIMEBase('application', "octet-stream")
+                msg_attachments.set_payload(fp.read())
+        except OSError as ex:
+            # a queued alert can outlive its attachment
+            print('Skipping attachment {}: {}'.format(file, str(ex)))
+            continue
+        encoders.encode_base64(msg_attachments)
+        msg_attachments.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file))
+        msg_root.attach(msg_attachments)
+
+    return msg_root.as_string()
+
+def buildDigest(entries):
+    """
+    Merge queued alerts for the same recipients into one message
+
+    :param entries:     outbox entries in the order they were queued
+    :type entries:      list
+    :return:            subject, text body, html body and attachments
+    :rtype:             tuple
+    """
+
+    if len(entries) == 1:
+        entry = entries[0]
+        return entry['subject'], entry['text'], entry['html'], entry['attachments']
+
+    subject = '{} ({} alerts)'.format(entries[0]['subject'], len(entries))
+    text_body = '\r\n\n----------\r\n\n'.join(entry['text'] for entry in entries)
+    html_body = None
+    if any(entry['html'] for entry in entries):
+        html_body = '<hr>'.join(entry['html'] or '<pre>{}</pre>'.format(entry['text']) for entry in entries)
+    attachments = []
+    for entry in entries:
+        attachments.extend(x for x in entry['attachments'] if x not in attachments)
+    return subject, text_body, html_body, attachments
+
+
+class SmtpSession():
+    """
+    One authenticated smtp connection reused for every message\n
+    An idle connection is checked with NOOP and reopened when the server dropped it,
+    so sending usually skips the connect, STARTTLS and login round trips
+    """
+
+    def __init__(self, server, port, use_tls=True, username='', password='', timeout=30):
+        self.server = server
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.smtp = None
+        self.last_activity = 0.0
+        self.connects = 0
+
+    def connect(self):
+        self.close()
+        self.last_activity = monotonic()
+        smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.use_tls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.connects += 1
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+    def keepAlive(self, interval):
+        """
+        Open the session, or NOOP it once it sat idle for the interval and reopen it if that fails
+        """
+
+        if monotonic() - self.last_activity < interval:
+            return
+        try:
+            if self.smtp is not None:
+                self.last_activity = monotonic()
+                code, _ = self.smtp.noop()
+                if code == 250:
+                    return
+            self.connect()
+        except (smtplib.SMTPException, OSError) as ex:
+            print('Could not keep smtp session to {} open: {}'.format(self.server, str(ex)))
+            self.close()
+
+    def send(self, sender, recipients, msg):
+        """
+        :return:    { recipient: (code, response) } for refused recipients
+        :rtype:     dict
+        """
+
+        if self.smtp is None:
+            self.connect()
+            return self.smtp.sendmail(sender, recipients, msg)
+        try:
+            refused = self.smtp.sendmail(sender, recipients, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # the server dropped the kept connection since it was last used
+            self.connect()
+            refused = self.smtp.sendmail(sender, recipients, msg)
+        self.last_activity = monotonic()
+        return refused
+
+
+class MailDispatcher():
+    """
+    Sends queued mail over one persistent smtp session from a single thread\n
+    The first alert to a recipient goes out right away, alerts that follow within the digest window
+    are held and sent together as one digest when the window closes\n
+    Failed sends are retried with exponential backoff, the outbox is written to disk on every change
+    so queued alerts survive a crash or restart
+    """
+
+    def __init__(self, session, outbox_path=None, window=30, keepalive=60, backoff=5, max_backoff=600, max_attempts=10):
+        """
+        :param session:         smtp session to send over
+        :type session:          SmtpSession
+        :param outbox_path:     json file the outbox is kept in, None keeps it in memory only
+        :type outbox_path:      str
+        :param window:          seconds after a send during which further alerts to a recipient are held for a digest
+        :type window:           float
+        :param keepalive:       seconds between NOOPs on an idle session, 0 connects for each send
+        :type keepalive:        float
+        :param backoff:         seconds before the first retry, doubled for every further attempt
+        :type backoff:          float
+        :param max_backoff:     longest delay between retries
+        :type max_backoff:      float
+        :param max_attempts:    attempts before an alert is dropped
+        :type max_attempts:     int
+        """
+
+        self.session = session
+        self.outbox_path = outbox_path
+        self.window = window
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.condition = Condition()
+        # one entry per alert and recipient, in the order they were queued
+        self.outbox = self.loadOutbox()
+        # { recipient: time of the last send }
+        self.last_sent = {}
+        self.running = False
+        self.sent = 0
+        self.digests = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def loadOutbox(self):
+        if self.outbox_path is None:
+            return []
+        try:
+            with open(self.outbox_path, 'r') as fp:
+                outbox = json.load(fp)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as ex:
+            print('Could not load outbox {}: {}'.format(self.outbox_path, str(ex)))
+            return []
+        if len(outbox) > 0:
+            print('Resuming {} queued alerts from {}'.format(len(outbox), self.outbox_path))
+        return outbox
+
+    def saveOutbox(self):
+        """ Must be called with the condition held """
+
+        if self.outbox_path is None:
+            return
+        tmp_path = self.outbox_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.outbox_path), exist_ok=True)
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.outbox, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.outbox_path)
+        except OSError as ex:
+            print('Could not save outbox {}: {}'.format(self.outbox_path, str(ex)))
+
+    def enqueue(self, recipients, subject, text_body, html_body=None, sender='', attachments=()):
+        """
+        Queue an alert for each recipient
+
+        :return:    id of the alert
+        :rtype:     str
+        """
+
+        alert = uuid.uuid4().hex
+        now = time()
+        with self.condition:
+            for recipient in recipients:
+                self.outbox.append({
+                    'id': uuid.uuid4().hex, 'alert': alert, 'recipient': recipient, 'sender': sender,
+                    'subject': subject, 'text': text_body, 'html': html_body, 'attachments': list(attachments),
+                    'created': now, 'attempts': 0, 'next_try': now
+                })
+            self.saveOutbox()
+            self.condition.notify()
+        return alert
+
+    def dueAt(self, entry):
+        return max(entry['next_try'], self.last_sent.get(entry['recipient'], 0.0) + self.window)
+
+    def getTimeout(self, now):
+        wakeups = [self.dueAt(entry) - now for entry in self.outbox]
+        if self.keepalive > 0:
+            wakeups.append(self.keepalive)
+        return max(min(wakeups), 0) if len(wakeups) > 0 else None
+
+    def run(self):
+        # the session is opened up front so the first alert does not wait on the handshake
+        if self.keepalive > 0:
+            self.session.keepAlive(0)
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                now = time()
+                due = [entry for entry in self.outbox if self.dueAt(entry) <= now]
+                if len(due) == 0:
+                    self.condition.wait(self.getTimeout(now))
+
+            if len(due) > 0:
+                self.deliver(due)
+            elif self.keepalive > 0:
+                self.session.keepAlive(self.keepalive)
+        self.session.close()
+
+    def deliver(self, due):
+        # recipients waiting for the same alerts share one message
+        alerts = {}
+        for entry in due:
+            alerts.setdefault((entry['recipient'], entry['sender']), []).append(entry)
+        groups = {}
+        for (recipient, sender), entries in alerts.items():
+            key = (sender, tuple(entry['alert'] for entry in entries))
+            groups.setdefault(key, []).append(recipient)
+
+        done = set()
+        failed = set()
+        sent_to = []
+        for (sender, alert_ids), recipients in groups.items():
+            entries = alerts[(recipients[0], sender)]
+            subject, text_body, html_body, attachments = buildDigest(entries)
+            group_ids = {entry['id'] for recipient in recipients for entry in alerts[(recipient, sender)]}
+            try:
+                msg = buildMessage(sender, recipients, subject, text_body, html_body, attachments)
+                refused = self.session.send(sender, recipients, msg)
+            except smtplib.SMTPRecipientsRefused as ex:
+                refused = ex.recipients
+            except (smtplib.SMTPException, OSError) as ex:
+                print('Sending alert to {} failed: {}'.format(', '.join(recipients), str(ex)))
+                self.session.close()
+                self.failures += 1
+                failed |= group_ids
+                continue
+            for recipient, response in refused.items():
+                print('Alert to {} refused: {}'.format(recipient, str(response)))
+            self.dropped += len(refused)
+            sent_to.extend(x for x in recipients if x not in refused)
+            done |= group_ids
+            self.sent += 1
+            if len(alert_ids) > 1:
+                self.digests += 1
+
+        if self.keepalive <= 0:
+            self.session.close()
+
+        now = time()
+        with self.condition:
+            for recipient in sent_to:
+                self.last_sent[recipient] = now
+            outbox = []
+            for entry in self.outbox:
+                if entry['id'] in done:
+                    continue
+                if entry['id'] in failed:
+                    entry['attempts'] += 1
+                    if entry['attempts'] >= self.max_attempts:
+                        print('Dropping alert to {} after {} attempts'.format(entry['recipient'], entry['attempts']))
+                        self.dropped += 1
+                        continue
+                    entry['next_try'] = now + min(self.backoff * 2 ** (entry['attempts'] - 1), self.max_backoff)
+                outbox.append(entry)
+            self.outbox = outbox
+            self.saveOutbox()
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def getStats(self):
+        return {
+            'queued': len(self.outbox),
+            'sent': self.sent,
+            'digests': self.digests,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'connects': self.session.connects,
+        }
@@ -5,6 +5,9 @@ RTF_UP = 0x0001          # route usable
 RTF_GATEWAY = 0x0002     # destination is a gateway
 RTF_HOST = 0x0004        # host entry (net otherwise)
 
+# internal ip and the routing table it was derived from
+internal_ip_cache = {'routes': None, 'ip': None}
+
 def ipToStr(ip_int):
     """
     Convert integer IP to string
@@ -39,33 +42,47 @@ def ipToInt(ip_str):
         pass
     raise ValueError("invalid IP address")
 
-def getRoutingTableIPv4():
+def readRoutingTableIPv4():
+    """
+    :return:    raw contents of /proc/net/route, empty if it can not be read
+    :rtype:     str
+    """
+
+    try:
+        with open('/proc/net/route', 'r') as fp:
+            return fp.read()
+    except OSError:
+        return ''
+
+def getRoutingTableIPv4(routes=None):
     """
     Get IPv4 routing table entries
 
     The addresses are stored as byte-reversed hex and must be converted by flipping byte-order
 
-    :return:    routing table entries
-    :rtype:     list
+    :param routes:  contents of /proc/net/route if already read
+    :type routes:   str
+    :return:        routing table entries
+    :rtype:         list
     """
 
     rt_entries = []
+    if routes is None:
+        routes = readRoutingTableIPv4()
 
     try:
-        with open('/proc/net/route', 'r') as fp:
-            _ = next(fp)
-            for line in fp:
-                fields = line.strip().split()
-                rt_entries.append({
-                    'iface': fields[0],                                                         # interface name
-                    'dst_addr': struct.unpack('<I', struct.pack('>I', int(fields[1], 16)))[0],  # destination network/host address
-                    'gw_addr': struct.unpack('<I', struct.pack('>I', int(fields[2], 16)))[0],   # gateway address
-                    'flags': int(fields[3], 16),                                                # routing flags
-                    'use': int(fields[5]),                                                      # number of lookups for this route
-                    'metric': int(fields[6]),                                                   # hops to target address
-                    'mask': struct.unpack('<I', struct.pack('>I', int(fields[7], 16)))[0],      # network mask for destination
-                    'mtu': int(fields[8])                                                       # max packet size for this route
-                })
+        for line in routes.splitlines()[1:]:
+            fields = line.strip().split()
+            rt_entries.append({
+                'iface': fields[0],                                                         # interface name
+                'dst_addr': struct.unpack('<I', struct.pack('>I', int(fields[1], 16)))[0],  # destination network/host address
+                'gw_addr': struct.unpack('<I', struct.pack('>I', int(fields[2], 16)))[0],   # gateway address
+                'flags': int(fields[3], 16),                                                # routing flags
+                'use': int(fields[5]),                                                      # number of lookups for this route
+                'metric': int(fields[6]),                                                   # hops to target address
+                'mask': struct.unpack('<I', struct.pack('>I', int(fields[7], 16)))[0],      # network mask for destination
+                'mtu': int(fields[8])                                                       # max packet size for this route
+            })
     except:
         pass
     return rt_entries
@@ -87,7 +104,20 @@ def getHostAddressesIPv4():
 
 
 def getInternalIP():
-    rt_entries = getRoutingTableIPv4()
+    """
+    Address of the interface holding the default route\n
+    The result is cached until the routing table changes, an interface coming up or going down changes the table,
+    so calling this every cycle only costs reading /proc/net/route
+
+    :return:    internal ipv4 address
+    :rtype:     str
+    """
+
+    routes = readRoutingTableIPv4()
+    if routes == internal_ip_cache['routes'] and internal_ip_cache['ip'] is not None:
+        return internal_ip_cache['ip']
+
+    rt_entries = getRoutingTableIPv4(routes)
     if len(rt_entries) == 0:
         raise Exception("could not retrieve routing table entries")
     host_addrs = getHostAddressesIPv4()
@@ -104,6 +134,7 @@ def getInternalIP():
 
     for addr in host_addrs:
         if ipToInt(addr) & def_iface_info['mask'] == def_iface_info['dst_addr']:
+            internal_ip_cache.update(routes=routes, ip=addr)
             return addr
 
     raise Exception("could not determine internal ip address")
\ No newline at end of file
@@ -1,11 +1,10 @@
-import os, settings, smtplib, requests, json
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from util.pyasync import thread
+import os, settings, requests, json
+from time import time
+from threading import Lock, Thread
+from util.mailer import SmtpSession, MailDispatcher
+from util.pyasync import mtexec
 from util.printing import debugException
-import phonenumbers, globals
+import phonenumbers
 
 
 # more gateways available:
@@ -26,6 +25,16 @@ CARRIER_SMS_GATEWAYS = {
     'straighttalk': '@mypixmessages.com'
 }
 
+# every alert goes out over one kept smtp session, started with dispatcher.start()
+# the session is only kept open when there is someone to notify
+keepalive = settings.NOTIFY_SMTP_KEEPALIVE if settings.ALARM_NOTIFY_EMAILS or settings.ALARM_NOTIFY_NUMBERS else 0
+dispatcher = MailDispatcher(
+    SmtpSession(settings.MAIL_SERVER, settings.MAIL_PORT, settings.MAIL_USE_TLS, settings.MAIL_USERNAME,
+                settings.MAIL_PASSWORD),
+    settings.NOTIFY_OUTBOX, settings.NOTIFY_DIGEST_WINDOW, keepalive, settings.NOTIFY_RETRY_BACKOFF,
+    settings.NOTIFY_RETRY_MAX, settings.NOTIFY_MAX_ATTEMPTS
+)
+
 # TODO: only tested with the following carriers:
 #       sprint, verizon, att
 #       possibly get a hold of telnyx and ask for possible responses for carrier name
@@ -50,11 +59,115 @@ def normalizeCarrierName(carrier):
     else:
         return name
 
-@thread
+
+class CarrierCache():
+    """
+    Carrier and country of phone numbers from the lookup service, kept on disk for the ttl\n
+    Numbers missing from the cache are looked up in parallel,
+    an expired entry is still used when the lookup service can not be reached
+    """
+
+    def __init__(self, lookup_url, path=None, ttl=2592000, workers=4, timeout=10):
+        """
+        :param lookup_url:  url the number is appended to
+        :type lookup_url:   str
+        :param path:        json file the cache is kept in, None keeps it in memory only
+        :type path:         str
+        :param ttl:         seconds a lookup stays valid
+        :type ttl:          float
+        :param workers:     lookups running at once
+        :type workers:      int
+        :param timeout:     seconds to wait for a lookup
+        :type timeout:      float
+        """
+
+        self.lookup_url = lookup_url
+        self.path = path
+        self.ttl = ttl
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = Lock()
+        # { number: {'country_code': str, 'carrier_name': str, 'looked_up': float} }
+        self.numbers = self.load()
+
+    def load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            print('Could not load number cache {}: {}'.format(self.path, str(ex)))
+            return {}
+
+    def save(self):
+        """ Must be called with the lock held """
+
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.numbers, fp)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            print('Could not save number cache {}: {}'.format(self.path, str(ex)))
+
+    def fetch(self, number):
+        """
+        :return:    number and its info from the lookup service, None as info if the lookup failed
+        :rtype:     tuple
+        """
+
+        try:
+            number_data = json.loads(requests.get(self.lookup_url + number, timeout=self.timeout).text)
+            return number, {
+                'country_code': number_data['country_code'],
+                'carrier_name': normalizeCarrierName(number_data['carrier']['name']),
+                'looked_up': time()
+            }
+        except Exception as ex:
+            print('Carrier lookup for {} failed: {}'.format(number, str(ex)))
+            return number, None
+
+    def resolve(self, numbers):
+        """
+        :return:    { number: info } for every number that is cached or could be looked up
+        :rtype:     dict
+        """
+
+        now = time()
+        with self.lock:
+            cached = {number: self.numbers.get(number) for number in numbers}
+        misses = [number for number, info in cached.items() if info is None or now - info['looked_up'] >= self.ttl]
+        if len(misses) > 0:
+            found = {number: info for number, info in
+                     mtexec(self.fetch, args=[(number,) for number in misses], workers=min(len(misses), self.workers))
+                     if info is not None}
+            if len(found) > 0:
+                with self.lock:
+                    self.numbers.update(found)
+                    self.save()
+                cached.update(found)
+        return {number: info for number, info in cached.items() if info is not None}
+
+    def prewarm(self, numbers):
+        """ Resolve numbers in the background so the first alarm finds them cached """
+
+        if len(numbers) > 0:
+            Thread(target=self.resolve, args=(list(numbers),), daemon=True).start()
+
+carriers = CarrierCache(settings.SMS_NUMBER_LOOKUP_URL, settings.SMS_NUMBER_CACHE, settings.SMS_NUMBER_CACHE_TTL,
+                        settings.SMS_NUMBER_LOOKUP_WORKERS)
+
 def sendEmail(recipients, text_body, html_body=None, subject=settings.MAIL_DEFAULT_SUBJECT,
                sender=settings.MAIL_DEFAULT_SENDER, data=None, attachments=()):
     """
-    Send an Email asynchronously to recipients
+    Send an Email asynchronously to recipients\n
+    The email is queued with the dispatcher, alerts following shortly after are merged into a digest
 
     :param recipients:      email addresses we are sending to
     :type recipients:       list|tuple
@@ -70,55 +183,17 @@ def sendEmail(recipients, text_body, html_body=None, subject=settings.MAIL_DEFAU
     :type data:             dict
     :param attachments:     list|tuple
     :type attachments:      files to attach to email
-    :return:                no return value
-    :rtype:                 None
+    :return:                id of the queued alert
+    :rtype:                 str
     """
 
-    try:
-        if data is not None:
-            text_body += "\r\n\n"
-            for key, value in data.items():
-                text_body += "{}: {}\n".format(str(key),str(value))
-            text_body += "\n"
-
-        # print("Creating email")
-        msg_root = MIMEMultipart('alternative')
-        msg_root['From'] = sender
-        msg_root['To'] = ", ".join(recipients)
-        msg_root['Subject'] = subject
-        msg_root.preamble = "|-------------------MULTIPART_BOUNDARY-------------------|\n"
-
-        # print("Adding text body to email")
-        msg_root.attach(MIMEText(text_body, 'plain'))
-
-        if html_body is not None and html_body != "":
-            # print("Adding html body to email")
-            msg_root.attach(MIMEText(html_body, 'html'))
-
-        if len(attachments) > 0:
-            # print("Adding attachments to email")
-            for file in attachments:
-                with open(file, 'rb') as fp:
-                    msg_attachments = MIMEBase('application', "octet-stream")
-                    msg_attachments.set_payload(fp.read())
-                encoders.encode_base64(msg_attachments)
-                msg_attachments.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file))
-                msg_root.attach(msg_attachments)
-
-        # print("sending email")
-        with smtplib.SMTP(settings.MAIL_SERVER, settings.MAIL_PORT) as server:
-            server.connect(settings.MAIL_SERVER, settings.MAIL_PORT)
-            server.ehlo()
-            if settings.MAIL_USE_TLS:
-                server.starttls()
-                server.ehlo()
-            server.login(settings.MAIL_USERNAME, settings.MAIL_PASSWORD)
-            msg_root_str = msg_root.as_string()
-            server.sendmail(sender, recipients, msg_root_str)
-            server.quit()
-
-    except Exception as ex:
-        debugException(ex, log_ex=False, print_ex=True, showstack=False)
+    if data is not None:
+        text_body += "\r\n\n"
+        for key, value in data.items():
+            text_body += "{}: {}\n".format(str(key),str(value))
+        text_body += "\n"
+
+    return dispatcher.enqueue(recipients, subject, text_body, html_body, sender, attachments)
 
 def sendSMS(recipients, text_body, html_body=None, subject=settings.MAIL_DEFAULT_SUBJECT,
                sender=settings.MAIL_DEFAULT_SENDER, data=None, attachments=()):
@@ -145,20 +220,15 @@ def sendSMS(recipients, text_body, html_body=None, subject=settings.MAIL_DEFAULT
 
     recipients_formatted = []
 
+    # lookup carrier and country info
+    number_infos = carriers.resolve(recipients)
+
     # format recipients to send through sms carrier gateway
     for recipient in recipients:
+        if recipient not in number_infos:
+            continue
         try:
-            # lookup carrier and country info
-            if recipient in globals.number_info:
-                number_info = globals.number_info[recipient]
-            else:
-                url = settings.SMS_NUMBER_LOOKUP_URL + recipient
-                number_data = json.loads(requests.get(url).text)
-                number_info = {
-                    'country_code': number_data['country_code'],
-                    'carrier_name': normalizeCarrierName(number_data['carrier']['name'])
-                }
-                globals.number_info[recipient] = number_info
+            number_info = number_infos[recipient]
 
             # lookup sms gateway for carrier and format number
             sms_gateway = CARRIER_SMS_GATEWAYS[number_info['carrier_name']]
@@ -1,48 +1,46 @@
 #!/usr/bin/env python3
 import io
 import socket, weakref, signal, os, select, logging
-from datetime import datetime
-from time import sleep
-from picamera2 import Picamera2
-from picamera2.encoders import JpegEncoder
-from picamera2.outputs import FileOutput
-from threading import Condition, Thread
-from util.pyasync import thread
+from collections import deque
+from time import sleep, time
+from threading import Condition, Thread, Lock
+from util.camera import Picamera2, MappedArray, JpegEncoder, MJPEGEncoder, H264Encoder, Output
+from util.recording import Recorder, PreRollBuffer
+from util.retention import RetentionManager
+from util.control import ControlServer
+from util.framing import HELLO, HELLO_H264, FLAG_KEYFRAME, FLAG_H264, parseHello, packHeader, sendBuffers
+from util.datagram import DatagramSender
+from util.motion import MotionDetector
+from util.pyasync import thread, WorkerPool, PoolFullError
 from util.printing import debugException
 import settings
 
 
-# TODO: switch to udp for better performance
-
-# TODO: move to a settings.py file
-run_dir = '/run/shomesec'
+#### module variables
+run_dir = settings.RUN_DIR
 pid_file = os.path.join(run_dir, 'pivid.pid')
-video_dir = "/var/backups/videos" # video storage
-video_current = os.path.join(video_dir, 'current.mjpeg')
-video_resolution = (1920, 1080) # resolution in pixels
-video_fps = 40 # frames per second
+control_sock = os.path.join(run_dir, 'pivid.sock')
+video_dir = settings.VIDEO_DIR
+video_resolution = settings.VIDEO_RESOLUTION
+video_fps = settings.VIDEO_FPS
+video_codec = settings.VIDEO_CODEC
 video_timeout = 5 # timeout before recording dies (if no writes)
 log_level = logging.INFO
-
-# capped at 4 because thats the max number of splitter ports
-maxconns = 4
 buffsize = 16384
 
 
 def sigHandler(signum=None, frame=None):
-    # note: we are only recording to file on output 0
+    # legacy record control, the file work happens off the signal path
     # start recording
     if signum == signal.SIGUSR1.value:
-        server.video_outputs[0].fileoutput.recording = True
+        runCommand(server.recorder.start)
     # stop recording
     elif signum == signal.SIGUSR2.value:
-        # only process request if previously recording
-        if server.video_outputs[0].fileoutput.recording == True:
-            filename = datetime.strftime(datetime.now(), '%Y-%m-%d_%H-%M-%S.mjpeg')
-            video_file = os.path.join(video_dir, filename)
-            if os.path.exists(video_current):
-                os.rename(video_current, video_file)
-            server.video_outputs[0].fileoutput.setFile(video_current, buff=buffsize, recording=False)
+        runCommand(server.recorder.stop)
+
+@thread
+def runCommand(func):
+    func()
 
 def teardown():
     try:
@@ -59,27 +57,47 @@ def setup():
         pidfd.write(str(os.getpid()))
     Picamera2.set_logging(log_level)
 
+def createPreRoll():
+    if settings.VIDEO_PREROLL_BYTES <= 0 or settings.VIDEO_PREROLL_SECONDS <= 0:
+        return None
+    # frame table sized for the time budget plus a second of slack for clock jitter
+    max_frames = int((settings.VIDEO_PREROLL_SECONDS + 1) * video_fps)
+    return PreRollBuffer(settings.VIDEO_PREROLL_BYTES, settings.VIDEO_PREROLL_SECONDS, max_frames)
+
 class StreamingOutput(io.BufferedIOBase):
     """
-    Streams output socket conditionally
-    Automatically closes socket stream on early termination
+    Streams whole frames to a socket from a bounded per-client queue
+    The encoder thread only enqueues, the connection thread drains the queue to the socket
+    When the client falls behind the oldest frames are dropped, never partial frames
+    Framed clients get each frame behind its protocol header (see util/framing.py), others the raw jpegs
+    H.264 frames depend on the frames before them, so a stream that drops frames skips to the next keyframe
     """
 
     _active_streams = 0
-
-    def __init__(self, sock=None, streaming=True, buff=None):
-        self.output_stream = None
-
-        if buff and buff > 0:
-            if sock is not None:
-                self.output_stream = sock.makefile('wb', buffering=buff)
-                StreamingOutput.setActiveStreams(StreamingOutput.getActiveStreams() + 1)
-        else:
-            if sock is not None:
-                self.output_stream = sock.makefile('wb')
-                StreamingOutput.setActiveStreams(StreamingOutput.getActiveStreams() + 1)
-
-        self.streaming = streaming
+    # streams are opened in pooled connection threads and closed by whichever thread fails a send
+    _streams_lock = Lock()
+
+    def __init__(self, sock=None, streaming=True, queue_size=None, framed=False, h264=False):
+        self.sock = sock
+        self.framed = framed
+        self.h264 = h264
+        # a new h264 viewer can only start decoding at a keyframe
+        self.need_keyframe = h264
+        self.frames = deque()
+        self.queue_size = queue_size if queue_size else settings.VIDEO_CLIENT_QUEUE
+        self.condition = Condition()
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.streaming = False
+        self.addr = None
+
+        if sock is not None:
+            try:
+                self.addr = sock.getpeername()
+            except OSError:
+                self.addr = None
+            self.streaming = streaming
+            StreamingOutput.addActiveStreams(1)
 
     @classmethod
     def getActiveStreams(cls):
@@ -87,37 +105,80 @@ class StreamingOutput(io.BufferedIOBase):
 
     @classmethod
     def setActiveStreams(cls, value):
-        StreamingOutput._active_streams = value
+        with StreamingOutput._streams_lock:
+            StreamingOutput._active_streams = value
 
-    def setSock(self, sock, buff=None, streaming=True):
-        if self.output_stream:
-            self.output_stream.close()
-        else:
-            StreamingOutput.setActiveStreams(StreamingOutput.getActiveStreams() + 1)
-        if buff and buff > 0:
-            self.output_stream = sock.makefile('wb', buffering=buff)
-        else:
-            self.output_stream = sock.makefile('wb')
-        self.streaming = streaming
+    @classmethod
+    def addActiveStreams(cls, count):
+        with StreamingOutput._streams_lock:
+            StreamingOutput._active_streams += count
+            return StreamingOutput._active_streams
+
+    def getStats(self):
+        return {
+            'addr': self.addr,
+            'framed': self.framed,
+            'codec': 'h264' if self.h264 else 'mjpeg',
+            'sent_frames': self.sent_frames,
+            'dropped_frames': self.dropped_frames,
+            'queued_frames': len(self.frames)
+        }
+
+    def write(self, buff, header=None, keyframe=True):
+        if not self.streaming:
+            return
+        with self.condition:
+            if len(self.frames) >= self.queue_size:
+                if self.h264:
+                    self.dropped_frames += len(self.frames)
+                    self.frames.clear()
+                    self.need_keyframe = True
+                else:
+                    self.frames.popleft()
+                    self.dropped_frames += 1
+            if self.need_keyframe:
+                if not keyframe:
+                    self.dropped_frames += 1
+                    return
+                self.need_keyframe = False
+            self.frames.append((header, buff))
+            self.condition.notify()
+
+    def sendFrames(self):
+        """
+        Drain the frame queue to the socket until the stream ends
+        Blocks the calling thread, must not be called from the encoder thread
+        """
+
+        while self.streaming:
+            with self.condition:
+                while self.streaming and len(self.frames) == 0:
+                    self.condition.wait(video_timeout)
+                if not self.streaming:
+                    break
+                header, frame = self.frames.popleft()
 
-    def write(self, buff):
-        if self.output_stream and self.streaming:
             try:
-                self.output_stream.write(buff)
-            except BrokenPipeError:
-                self.output_stream.close()
-                self.streaming = False
-                StreamingOutput.setActiveStreams(StreamingOutput.getActiveStreams() - 1)
+                if self.framed:
+                    # header and frame leave in one gathered write, the frame is never copied
+                    sendBuffers(self.sock, (header, frame))
+                else:
+                    self.sock.sendall(frame)
+                self.sent_frames += 1
+            except OSError:
+                self.close()
 
     def flush(self):
-        if self.output_stream and self.streaming:
-            self.output_stream.flush()
+        pass
 
     def close(self):
-        if self.output_stream:
-            self.output_stream.close()
+        with self.condition:
+            # only count the stream once, it may already have been closed by a failed send
+            if self.streaming:
+                StreamingOutput.addActiveStreams(-1)
             self.streaming = False
-            StreamingOutput.setActiveStreams(StreamingOutput.getActiveStreams() - 1)
+            self.frames.clear()
+            self.condition.notify_all()
 
 # class StreamingOutput(io.BufferedIOBase):
 #     def __init__(self):
@@ -129,58 +190,92 @@ class StreamingOutput(io.BufferedIOBase):
 #             self.frame = buf
 #             self.condition.notify_all()
 
-class SplitOutput(StreamingOutput):
+class BroadcastOutput(Output):
+    """ Hands each encoded frame and its keyframe flag from a camera encoder to a broadcaster """
+
+    def __init__(self, broadcaster):
+        super().__init__()
+        self.broadcaster = broadcaster
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.broadcaster.write(frame, keyframe)
+
+class FrameBroadcaster(io.BufferedIOBase):
     """
-    Splits output to a file and a socket
-    Automatically closes socket stream on early termination
+    Fans out each encoded frame to the recorder, all subscribed sockets and the datagram sender
+    A single encoder feeds the broadcaster so encode cost stays flat as viewers are added
     """
 
-    def __init__(self, filename='', sock=None, recording=True, streaming=True, buff=None):
-        self.output_file = None
-
-        if buff and buff > 0:
-            if len(filename) > 0:
-                self.output_file = open(filename, 'wb', buffering=buff)
-        else:
-            if len(filename) > 0:
-                self.output_file = open(filename, 'wb')
+    def __init__(self, recorder=None, datagram=None, fps=video_fps, codec='mjpeg'):
+        self.recorder = recorder
+        self.datagram = datagram
+        self.fps = fps
+        self.codec = codec
+        self.codec_flags = FLAG_H264 if codec == 'h264' else 0
+        self.subscribers = []
+        self.subscribers_lock = Lock()
+        self.frame_size = 0
+        self.frame_seq = 0
+
+    def subscribe(self, sock, framed=False):
+        """
+        Create a socket output that receives every frame written from now on
+        """
 
-        self.recording = recording
-        super().__init__(sock, streaming, buff)
+        output = StreamingOutput(sock, streaming=True, framed=framed, h264=self.codec == 'h264')
+        # copy on write so the encoder thread can iterate without taking the lock
+        with self.subscribers_lock:
+            self.subscribers = self.subscribers + [output]
+        return output
 
-    def setFile(self, filename, buff=None, recording=True):
-        if buff and buff > 0:
-            buffsiz = buff
-        else:
-            buffsiz = -1
+    def unsubscribe(self, output):
+        with self.subscribers_lock:
+            self.subscribers = [x for x in self.subscribers if x is not output]
+        output.close()
 
-        if self.output_file is not None:
-            self.output_file.close()
-        self.output_file = open(filename, 'wb', buffering=buffsiz)
-        self.recording = recording
+    def getStats(self):
+        return [output.getStats() for output in self.subscribers]
 
-    def write(self, buff):
-        if self.output_file and self.recording:
-            try:
-                self.output_file.write(buff)
-            except ValueError:
-                self.output_file = None
-                self.recording = False
-        super().write(buff)
+    def maxSubscribers(self):
+        """
+        Connection limit derived from the streaming bandwidth budget and the measured frame size
+        """
 
-    def flush(self):
-        if self.output_file and self.recording:
-            self.output_file.flush()
-        super().flush()
+        if settings.VIDEO_MAX_BANDWIDTH <= 0 or self.frame_size == 0:
+            return settings.VIDEO_MAX_CONNS
+        per_stream = self.frame_size * self.fps
+        return max(1, min(settings.VIDEO_MAX_CONNS, settings.VIDEO_MAX_BANDWIDTH // per_stream))
+
+    def write(self, buff, keyframe=True):
+        timestamp = time()
+        self.frame_seq += 1
+        # running average of the encoded frame size (1/8 weight for new frames)
+        if self.frame_size == 0:
+            self.frame_size = len(buff)
+        else:
+            self.frame_size = (self.frame_size * 7 + len(buff)) >> 3
+
+        if self.recorder is not None:
+            self.recorder.write(buff, keyframe)
+
+        # the encoder may reuse its buffer, so take one immutable copy shared by all queues
+        datagram = self.datagram is not None and self.datagram.active
+        if len(self.subscribers) > 0 or datagram:
+            frame = bytes(buff)
+            flags = self.codec_flags | (FLAG_KEYFRAME if keyframe else 0)
+            header = packHeader(len(frame), self.frame_seq, timestamp, flags)
+            for output in self.subscribers:
+                output.write(frame, header, keyframe)
+            if datagram:
+                self.datagram.write(frame, self.frame_seq, timestamp)
 
     def close(self):
-        if self.output_file:
-            self.output_file.close()
-            self.recording = False
-        super().close()
-
-# class SplitOutput(StreamingOutput):
-#     pass
+        if self.recorder is not None:
+            self.recorder.close()
+        with self.subscribers_lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for output in subscribers:
+            output.close()
 
 class Server(object):
     def __init__(self, host, port):
@@ -192,17 +287,64 @@ class Server(object):
         self.port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.video_outputs = [
-            FileOutput(SplitOutput(video_current, recording=False, streaming=False, buff=buffsize)),
-            FileOutput(StreamingOutput(streaming=False, buff=buffsize)),
-            FileOutput(StreamingOutput(streaming=False, buff=buffsize)),
-            FileOutput(StreamingOutput(streaming=False, buff=buffsize)),
-        ]
+        # a connection holds its worker for as long as it streams, connections beyond the pool are refused
+        self.pool = WorkerPool(settings.VIDEO_MAX_CONNS, settings.VIDEO_CONN_QUEUE, 'reject', 'connections')
         self.camera = Picamera2()
-        self.camera.configure(self.camera.create_video_configuration(
+        # every viewer and the recording file share the output of a single encoder
+        self.retention = RetentionManager(video_dir, settings.VIDEO_RETENTION_BYTES, settings.VIDEO_RETENTION_DAYS * 86400,
+                                          settings.VIDEO_MIN_FREE)
+        self.codec = video_codec
+        if self.codec == 'h264' and H264Encoder is None:
+            print('H.264 is not available with the {} camera backend, using mjpeg'.format(settings.CAMERA_BACKEND))
+            self.codec = 'mjpeg'
+        self.recorder = Recorder(video_dir, buffsize, '.' + self.codec, preroll=createPreRoll(),
+                                 segment_seconds=settings.VIDEO_SEGMENT_SECONDS, retention=self.retention)
+        self.datagram = None
+        if settings.VIDEO_UDP_ENABLED:
+            self.datagram = DatagramSender(host, settings.VIDEO_UDP_PORT, settings.VIDEO_UDP_MTU, settings.VIDEO_UDP_TTL,
+                                           settings.VIDEO_UDP_MULTICAST, settings.VIDEO_UDP_MULTICAST_PORT)
+
+        # with h264 the main stream is recorded and streamed as h264,
+        # a low rate jpeg encode of the lores stream serves snapshots and mjpeg viewers
+        lores_size = None
+        if self.codec == 'h264':
+            self.h264_broadcaster = FrameBroadcaster(self.recorder, None, video_fps, 'h264')
+            self.jpeg_broadcaster = FrameBroadcaster(None, self.datagram, settings.VIDEO_JPEG_FPS)
+            lores_size = settings.VIDEO_JPEG_RESOLUTION
+        else:
+            self.h264_broadcaster = None
+            self.jpeg_broadcaster = FrameBroadcaster(self.recorder, self.datagram, video_fps)
+            if settings.VIDEO_MOTION_ENABLED:
+                lores_size = settings.VIDEO_MOTION_RESOLUTION
+        self.broadcasters = [x for x in (self.h264_broadcaster, self.jpeg_broadcaster) if x is not None]
+        video_config = self.camera.create_video_configuration(
             main={"size": video_resolution},
+            lores={"size": lores_size} if lores_size is not None else None,
             controls={"FrameRate": video_fps}
-        ))
+        )
+
+        # camera motion detection triggers recording like the motion sensor does over the control channel,
+        # recording runs while any source still sees motion
+        self.triggers = set()
+        self.triggers_lock = Lock()
+        self.motion = None
+        if settings.VIDEO_MOTION_ENABLED:
+            # a larger lores stream (h264 mode) is sampled down to about the motion resolution
+            step = max(lores_size[0] // settings.VIDEO_MOTION_RESOLUTION[0], 1)
+            self.motion = MotionDetector(lores_size, step, settings.VIDEO_MOTION_ZONES, settings.VIDEO_MOTION_SENSITIVITY,
+                                         settings.VIDEO_MOTION_MIN_AREA, settings.VIDEO_MOTION_BLOCK,
+                                         settings.VIDEO_MOTION_FRAMES, settings.VIDEO_MOTION_HOLD,
+                                         on_motion=self.onMotion, on_idle=self.onIdle)
+            self.camera.post_callback = self.analyseFrame
+
+        self.control = ControlServer(control_sock, {
+            'start': self.startRecording,
+            'stop': self.stopRecording,
+            'roll': self.recorder.roll,
+            'mark': self.recorder.mark,
+            'status': self.status,
+        })
+        self.camera.configure(video_config)
         self._finalizer = weakref.finalize(self, self.close)
 
     def close(self):
@@ -211,8 +353,14 @@ class Server(object):
         """
  
         self.sock.close()
-        for i in range(len(self.video_outputs)):
-            self.video_outputs[i].close()
+        self.control.close()
+        for broadcaster in self.broadcasters:
+            broadcaster.close()
+        self.retention.close()
+        if self.datagram is not None:
+            self.datagram.close()
+        if self.motion is not None:
+            self.motion.close()
 
         try:
             self.camera.stop_recording()
@@ -220,48 +368,155 @@ class Server(object):
             pass
         self.camera.close()
 
+    def status(self):
+        status = self.recorder.status()
+        status.update({
+            'active_streams': StreamingOutput.getActiveStreams(),
+            'codec': self.codec,
+            # frames of the stream that is recorded, readers derive the frame rate from it
+            'frames_encoded': self.broadcasters[0].frame_seq,
+            'disk_free': self.diskFree(),
+            'frame_size': {broadcaster.codec: broadcaster.frame_size for broadcaster in self.broadcasters},
+            'retention': self.retention.getStats(),
+            'datagram': self.datagram.getStats() if self.datagram is not None else None,
+            'motion': self.motion.getStats() if self.motion is not None else None,
+            'connections': self.pool.getStats(),
+            'triggers': sorted(self.triggers),
+            'streams': [stats for broadcaster in self.broadcasters for stats in broadcaster.getStats()],
+        })
+        return status
+
+    def diskFree(self):
+        try:
+            return self.retention.freeBytes()
+        except OSError:
+            return 0
+
+    def startRecording(self, source='control'):
+        """
+        Start recording on behalf of a trigger source
+
+        :param source:  what saw motion, 'control' for commands from the control channel
+        :type source:   str
+        :return:        recorder status
+        :rtype:         dict
+        """
+
+        with self.triggers_lock:
+            self.triggers.add(source)
+            return self.recorder.start()
+
+    def stopRecording(self, source='control'):
+        """
+        Stop recording once no trigger source sees motion anymore
+
+        :param source:  source that stopped seeing motion
+        :type source:   str
+        :return:        recorder status
+        :rtype:         dict
+        """
+
+        with self.triggers_lock:
+            self.triggers.discard(source)
+            if len(self.triggers) > 0:
+                return self.recorder.status()
+            return self.recorder.stop()
+
+    def onMotion(self, area):
+        status = self.startRecording('motion')
+        self.recorder.mark('motion {:.4f}'.format(area))
+        print('Motion recording to file {}'.format(status['file']))
+
+    def onIdle(self):
+        self.stopRecording('motion')
+
+    def analyseFrame(self, request):
+        """ Camera post callback, hands the lores luma plane to the motion detector """
+
+        with MappedArray(request, 'lores') as mapped:
+            self.motion.submit(mapped.array)
+
     def start(self):
         """
         Start listening for connections
         """
 
         self.sock.bind((self.host, self.port))
-        self.sock.listen(maxconns)
+        self.sock.listen()
         print("Listening on {}".format(str(self.sock.getsockname())))
 
-        # for i in range(len(self.video_outputs)):
-        #     self.camera.start_recording(picamera2.encoders.JpegEncoder(), self.video_outputs[i])
-
-        # the first camera output must always be recording in case we get a signal to output to file
-        self.camera.start_recording(JpegEncoder(), self.video_outputs[0])
+        self.retention.start()
+        if self.datagram is not None:
+            self.datagram.start()
+        if self.motion is not None:
+            self.motion.start()
+        # the encoder must always be running in case we get a command to output to file
+        if self.codec == 'h264':
+            h264_encoder = H264Encoder(bitrate=settings.VIDEO_H264_BITRATE, repeat=True, iperiod=settings.VIDEO_H264_IPERIOD)
+            jpeg_encoder = MJPEGEncoder()
+            # only every n-th lores frame is jpeg encoded
+            jpeg_encoder.frame_skip_count = max(video_fps // settings.VIDEO_JPEG_FPS, 1)
+            self.camera.start_encoder(h264_encoder, BroadcastOutput(self.h264_broadcaster), name='main')
+            self.camera.start_encoder(jpeg_encoder, BroadcastOutput(self.jpeg_broadcaster), name='lores')
+            self.camera.start()
+        else:
+            self.camera.start_recording(JpegEncoder(), BroadcastOutput(self.jpeg_broadcaster))
+        self.control.start()
 
         while True:
             conn, addr = self.sock.accept()
-            self.connHandler(conn, addr)
+            try:
+                self.pool.submit(self.connHandler, conn, addr)
+            except PoolFullError as ex:
+                print("Refusing connection from {}: {}".format(addr, str(ex)))
+                conn.close()
+
+    def negotiate(self, conn):
+        """
+        Wait briefly for a framed protocol hello, clients that send nothing get the raw stream
+
+        :return:    flags of the client hello, None for raw clients
+        :rtype:     int|None
+        """
+
+        readable, _, _ = select.select((conn,), (), (), settings.VIDEO_HELLO_TIMEOUT)
+        if len(readable) == 0:
+            return None
+        conn.settimeout(settings.VIDEO_HELLO_TIMEOUT)
+        try:
+            hello = conn.recv(HELLO.size, socket.MSG_WAITALL)
+        except socket.timeout:
+            return None
+        return parseHello(hello)
 
-    @thread
     def connHandler(self, conn, addr):
         print("Connection from {} opened".format(addr))
 
-        active_streams = SplitOutput.getActiveStreams()
+        output = None
+        active_streams = StreamingOutput.getActiveStreams()
         print('active streams: {}'.format(active_streams))
 
         try:
-            # if active streams is 0 tell the camera thread to handle it with split output
-            if active_streams  == 0:
-                self.video_outputs[0].fileoutput.setSock(conn, buff=buffsize)
-
-            # otherwise we need to handle recording with this new thread
-            else:
-                self.video_outputs[active_streams].fileoutput.setSock(conn, buff=buffsize)
-                self.camera.start_recording(JpegEncoder(), self.video_outputs[active_streams])
-                while True:
-                    sleep(video_timeout)
-                    if not self.video_outputs[active_streams].fileoutput.streaming:
-                        self.camera.stop_recording()
-                        break
-
-        except (BrokenPipeError, OSError, IndexError) as ex:
+            hello = self.negotiate(conn)
+            framed = hello is not None
+            # h264 is only offered to framed clients asking for it, everyone else gets jpegs
+            broadcaster = self.jpeg_broadcaster
+            if framed and hello & HELLO_H264 and self.h264_broadcaster is not None:
+                broadcaster = self.h264_broadcaster
+            print('Connection from {} uses the {} protocol with {}'.format(
+                addr, 'framed' if framed else 'raw', broadcaster.codec))
+
+            max_streams = broadcaster.maxSubscribers()
+            # streams may have opened or closed while the client negotiated
+            if StreamingOutput.getActiveStreams() >= max_streams:
+                raise ConnectionRefusedError('bandwidth budget allows {} streams'.format(max_streams))
+
+            # the encoder thread only queues frames, this thread sends them
+            conn.settimeout(settings.VIDEO_SEND_TIMEOUT)
+            output = broadcaster.subscribe(conn, framed)
+            output.sendFrames()
+
+        except (BrokenPipeError, OSError) as ex:
             print("Problem handling request from [{}]: {}".format(addr, str(ex)))
             # inform client to properly close
             try:
@@ -269,6 +524,9 @@ class Server(object):
             except:
                 pass
         finally:
+            if output is not None:
+                broadcaster.unsubscribe(output)
+                print('Stream stats for {}: {}'.format(addr, output.getStats()))
             print('Connection from {} closed'.format(addr))
             conn.close()
 
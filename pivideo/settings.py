@@ -1,3 +1,63 @@
 # settings for video server
 VIDEO_HOST = "0.0.0.0"
 VIDEO_PORT = 10000
+VIDEO_RESOLUTION = (1920, 1080) # resolution in pixels
+VIDEO_FPS = 40 # frames per second
+# codec for recordings and streams: mjpeg | h264
+# with h264 a low rate jpeg stream is still encoded for snapshots and mjpeg viewers
+VIDEO_CODEC = 'mjpeg'
+VIDEO_H264_BITRATE = 4000000 # bits per second
+VIDEO_H264_IPERIOD = 40 # frames between keyframes, segments and new viewers start on a keyframe
+VIDEO_JPEG_RESOLUTION = (640, 360) # jpeg stream size in h264 mode
+VIDEO_JPEG_FPS = 10 # jpeg stream rate in h264 mode
+VIDEO_DIR = "/var/backups/videos" # video storage
+VIDEO_SEGMENT_SECONDS = 60 # recordings are split into indexed segments of this length, 0 to disable
+RUN_DIR = '/run/shomesec'
+
+# camera backend: picamera2 | synthetic
+# the synthetic camera emits jpegs of a test pattern stamped with their capture time
+CAMERA_BACKEND = 'picamera2'
+SYNTHETIC_LOOP_SECONDS = 1 # length of the pre-rendered test pattern loop
+SYNTHETIC_FRAME_SIZE = 0 # pad frames to this many bytes, 0 to disable
+
+# streaming limits
+# connections are limited by the bandwidth budget (bytes per second), 0 disables the budget
+VIDEO_MAX_CONNS = 32
+VIDEO_MAX_BANDWIDTH = 12500000
+# connections waiting for a free connection worker (one per VIDEO_MAX_CONNS) before new ones are refused
+VIDEO_CONN_QUEUE = 4
+# frames queued per client before the oldest are dropped
+VIDEO_CLIENT_QUEUE = 8
+# seconds a client may stall a send before it is disconnected
+VIDEO_SEND_TIMEOUT = 10
+# seconds to wait for a framed protocol hello before streaming raw jpegs
+VIDEO_HELLO_TIMEOUT = 0.5
+
+# datagram transport, frames are fragmented into mtu sized udp packets and incomplete frames are dropped
+# receivers subscribe to VIDEO_UDP_PORT, multicast subscribers share one stream sent to the group
+VIDEO_UDP_ENABLED = False
+VIDEO_UDP_PORT = 10000
+VIDEO_UDP_MTU = 1500
+VIDEO_UDP_TTL = 10 # seconds a subscription lasts without being renewed
+VIDEO_UDP_MULTICAST = '' # e.g. 239.255.10.0, empty to disable multicast
+VIDEO_UDP_MULTICAST_PORT = 10004
+
+# pre-roll, the last seconds of frames before recording starts are kept in memory and written first
+# the ring is allocated once at startup, whichever budget is hit first limits the pre-roll
+VIDEO_PREROLL_SECONDS = 3
+VIDEO_PREROLL_BYTES = 16777216 # 0 disables the pre-roll
+
+# software motion detection on the lores camera stream, motion starts recording like the motion sensor does
+VIDEO_MOTION_ENABLED = False
+VIDEO_MOTION_RESOLUTION = (320, 240) # lores size analysed, in h264 mode the jpeg lores stream is sampled down to about this
+VIDEO_MOTION_ZONES = [] # (x, y, width, height) as fractions of the frame, empty watches the whole frame
+VIDEO_MOTION_SENSITIVITY = 50 # 0-100, higher reacts to smaller brightness changes
+VIDEO_MOTION_MIN_AREA = 0.01 # smallest moving blob that counts, as a fraction of the watched area
+VIDEO_MOTION_BLOCK = 8 # pixels per side of the blocks blobs are built from
+VIDEO_MOTION_FRAMES = 2 # consecutive frames with motion before recording starts
+VIDEO_MOTION_HOLD = 3 # seconds without motion before recording stops
+
+# archive retention, oldest segments are deleted first
+VIDEO_RETENTION_BYTES = 0 # archive byte budget, 0 to only limit by free space and age
+VIDEO_RETENTION_DAYS = 30 # 0 keeps segments until space runs out
+VIDEO_MIN_FREE = 536870912 # free bytes required before a new segment is opened
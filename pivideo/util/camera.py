@@ -0,0 +1,301 @@
+'''
+@Summary: Contains camera backends for the video server
+@Author: devopsec
+'''
+
+import struct, logging
+import numpy as np
+from time import time, sleep, monotonic
+from threading import Thread
+import settings
+
+
+#### synthetic jpeg encoding
+# the synthetic camera draws its test pattern in flat 8x8 blocks so every block is DC only,
+# which keeps a pure python baseline jpeg encoder fast enough to render a second of frames at startup
+
+# standard luminance DC huffman table (ITU T.81 annex K.3)
+DC_BITS = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)
+DC_VALS = tuple(range(12))
+# AC table holding only the end of block symbol
+AC_BITS = (1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+AC_VALS = (0x00,)
+# DC quantizer, a flat block of value v has a DC coefficient of 8 * (v - 128)
+DC_QUANT = 8
+
+
+def huffmanCodes(bits, vals):
+    """
+    Canonical huffman codes from a DHT bits / vals pair
+
+    :return:    { symbol: (code, length) }
+    :rtype:     dict
+    """
+
+    codes = {}
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(bits[length - 1]):
+            codes[vals[k]] = (code, length)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+DC_CODES = huffmanCodes(DC_BITS, DC_VALS)
+AC_EOB = huffmanCodes(AC_BITS, AC_VALS)[0x00]
+
+def jpegHeaders(width, height):
+    """
+    Headers for a baseline, single component jpeg
+    """
+
+    def segment(marker, payload):
+        return struct.pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+    return b''.join((
+        b'\xff\xd8',
+        segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'),
+        segment(0xdb, b'\x00' + bytes([DC_QUANT] * 64)),
+        segment(0xc0, struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00'),
+        segment(0xc4, b'\x00' + bytes(DC_BITS) + bytes(DC_VALS)),
+        segment(0xc4, b'\x10' + bytes(AC_BITS) + bytes(AC_VALS)),
+        segment(0xda, b'\x01\x01\x00\x00\x3f\x00'),
+    ))
+
+def encodeBlocks(headers, blocks):
+    """
+    Encode rows of flat 8x8 block values (0-255) as a grayscale baseline jpeg
+
+    :param headers:     output of jpegHeaders() for the image size
+    :type headers:      bytes
+    :param blocks:      block values, one list per row of blocks
+    :type blocks:       list of list of int
+    :return:            jpeg file contents
+    :rtype:             bytes
+    """
+
+    eob_code, eob_len = AC_EOB
+    data = bytearray()
+    acc = 0
+    nbits = 0
+    prev = 0
+    for row in blocks:
+        for value in row:
+            dc = value - 128
+            diff = dc - prev
+            prev = dc
+            size = abs(diff).bit_length()
+            code, length = DC_CODES[size]
+            # negative differences are sent as the one's complement of their magnitude
+            extra = diff if diff >= 0 else diff + (1 << size) - 1
+            acc = (((acc << length | code) << size | extra) << eob_len) | eob_code
+            nbits += length + size + eob_len
+
+            while nbits >= 8:
+                nbits -= 8
+                byte = acc >> nbits
+                acc &= (1 << nbits) - 1
+                data.append(byte)
+                # a 0xff byte in entropy coded data must be followed by a stuffed zero
+                if byte == 0xff:
+                    data.append(0x00)
+
+    # pad the last byte with ones
+    if nbits > 0:
+        byte = (acc << (8 - nbits)) | ((1 << (8 - nbits)) - 1)
+        data.append(byte)
+        if byte == 0xff:
+            data.append(0x00)
+    return headers + bytes(data) + b'\xff\xd9'
+
+def testPattern(width, height, index, count):
+    """
+    Block values for one frame of a moving bar over a gradient
+
+    :param index:   frame number within the pattern loop
+    :param count:   frames in the pattern loop
+    """
+
+    cols = (width + 7) // 8
+    rows = (height + 7) // 8
+    bar = (index * cols // count) if count > 0 else 0
+    bar_width = max(cols // 16, 1)
+    blocks = []
+    for y in range(rows):
+        shade = 32 + (160 * y // rows)
+        row = [shade] * cols
+        row[bar:bar + bar_width] = [235] * len(row[bar:bar + bar_width])
+        blocks.append(row)
+    return blocks
+
+def lumaPlane(width, height, blocks):
+    """ Expand block values into a luma plane """
+
+    plane = np.repeat(np.repeat(np.array(blocks, dtype=np.uint8), 8, axis=0), 8, axis=1)
+    return np.ascontiguousarray(plane[:height, :width])
+
+def padFrame(frame, size):
+    """
+    Grow a jpeg to roughly size bytes with APP15 filler segments so synthetic streams have a realistic bitrate
+
+    The filler never contains 0xff so marker scanning parsers are not confused
+    """
+
+    filler = []
+    missing = size - len(frame)
+    while missing > 4:
+        length = min(missing - 4, 65533)
+        filler.append(struct.pack('>BBH', 0xff, 0xef, length + 2) + (bytes(range(255)) * (length // 255 + 1))[:length])
+        missing -= length + 4
+    return frame[:2] + b''.join(filler) + frame[2:]
+
+def stampTimestamp(frame, timestamp):
+    """
+    Insert a COM segment holding the capture time right after SOI\n
+    Consumers can read it back with readTimestamp() to measure end to end latency
+    """
+
+    payload = b'shomesec-ts:' + '{:.6f}'.format(timestamp).encode('ascii')
+    return frame[:2] + struct.pack('>BBH', 0xff, 0xfe, len(payload) + 2) + payload + frame[2:]
+
+def readTimestamp(frame):
+    if frame[2:4] != b'\xff\xfe':
+        return None
+    length = struct.unpack('>H', frame[4:6])[0]
+    payload = bytes(frame[6:4 + length])
+    if not payload.startswith(b'shomesec-ts:'):
+        return None
+    return float(payload[12:])
+
+
+#### synthetic camera backend
+class SyntheticJpegEncoder():
+    """ Stand-in for picamera2.encoders.JpegEncoder, the synthetic camera already produces jpegs """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class SyntheticOutput():
+    """ Stand-in for picamera2.outputs.Output """
+
+    def __init__(self, pts=None):
+        self.recording = False
+
+    def start(self):
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        pass
+
+
+class SyntheticRequest():
+    """ Stand-in for a picamera2 CompletedRequest, holds the lores luma plane of a frame """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+
+class SyntheticMappedArray():
+    """ Stand-in for picamera2.MappedArray """
+
+    def __init__(self, request, stream, write=True):
+        self.array = request.arrays[stream]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class SyntheticCamera():
+    """
+    Stand-in for picamera2.Picamera2 emitting real jpeg frames of a test pattern\n
+    A loop of frames is rendered once at startup, each emitted frame is stamped with its capture time\n
+    With a lores stream configured post_callback is called with the matching luma plane for every frame
+    """
+
+    def __init__(self, camera_num=0):
+        self.config = None
+        self.frames = []
+        self.lores_frames = []
+        self.post_callback = None
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def set_logging(level=logging.WARN, output=None, msg=None):
+        logging.getLogger('picamera2').setLevel(level)
+
+    def create_video_configuration(self, main={}, lores=None, controls={}, **kwargs):
+        return {
+            'main': dict(main),
+            'lores': dict(lores) if lores is not None else None,
+            'controls': dict(controls),
+        }
+
+    def configure(self, config):
+        self.config = config
+        width, height = config['main'].get('size', (640, 480))
+        fps = config['controls'].get('FrameRate', 30)
+        count = max(int(fps * settings.SYNTHETIC_LOOP_SECONDS), 1)
+        headers = jpegHeaders(width, height)
+        self.frames = [padFrame(encodeBlocks(headers, testPattern(width, height, i, count)), settings.SYNTHETIC_FRAME_SIZE)
+                       for i in range(count)]
+        self.lores_frames = []
+        if config['lores'] is not None:
+            width, height = config['lores']['size']
+            self.lores_frames = [SyntheticRequest({'lores': lumaPlane(width, height, testPattern(width, height, i, count))})
+                                 for i in range(count)]
+
+    def start_recording(self, encoder, output, **kwargs):
+        output.start()
+        self.running = True
+        self.thread = Thread(target=self.run, args=(output,), daemon=True)
+        self.thread.start()
+
+    def stop_recording(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop_recording()
+
+    def run(self, output):
+        interval = 1 / self.config['controls'].get('FrameRate', 30)
+        deadline = monotonic()
+        index = 0
+        while self.running:
+            if self.post_callback is not None and len(self.lores_frames) > 0:
+                self.post_callback(self.lores_frames[index])
+            output.outputframe(stampTimestamp(self.frames[index], time()))
+            index = (index + 1) % len(self.frames)
+
+            # fixed frame clock, late frames are not made up for
+            deadline = max(deadline + interval, monotonic())
+            sleep(max(deadline - monotonic(), 0))
+
+
+#### backend selection
+# H264Encoder is None when the backend can only produce jpegs
+if settings.CAMERA_BACKEND == 'picamera2':
+    from picamera2 import Picamera2, MappedArray
+    from picamera2.encoders import JpegEncoder, MJPEGEncoder, H264Encoder
+    from picamera2.outputs import Output
+elif settings.CAMERA_BACKEND == 'synthetic':
+    Picamera2 = SyntheticCamera
+    MappedArray = SyntheticMappedArray
+    JpegEncoder = SyntheticJpegEncoder
+    MJPEGEncoder = SyntheticJpegEncoder
+    H264Encoder = None
+    Output = SyntheticOutput
+else:
+    raise ValueError("unknown camera backend: {}".format(settings.CAMERA_BACKEND))
@@ -0,0 +1,80 @@
+'''
+@Summary: Contains the unix domain control channel of the video server
+@Author: devopsec
+'''
+
+import os, socket, json
+from time import perf_counter_ns
+from threading import Thread
+
+
+class ControlServer():
+    """
+    Unix domain control channel for the video server\n
+    Each request is one json line {"cmd": <name>, ...} and is answered with one json line
+    holding the command result, "ok" and the handling time in microseconds
+    """
+
+    def __init__(self, path, commands):
+        """
+        :param path:        unix socket path
+        :type path:         str
+        :param commands:    { name: callable(**args) returning a dict }
+        :type commands:     dict
+        """
+
+        self.path = path
+        self.commands = commands
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def start(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self.sock.listen()
+        Thread(target=self.run, daemon=True).start()
+        print("Control channel listening on {}".format(self.path))
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            Thread(target=self.connHandler, args=(conn,), daemon=True).start()
+
+    def connHandler(self, conn):
+        # clients keep their connection open and send one command per line
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                try:
+                    conn.sendall(json.dumps(self.handle(line)).encode('utf-8') + b'\n')
+                except OSError:
+                    break
+
+    def handle(self, line):
+        start = perf_counter_ns()
+        cmd = None
+        try:
+            request = json.loads(line)
+            cmd = request.pop('cmd', None)
+            if cmd in self.commands:
+                response = dict(self.commands[cmd](**request))
+                response['ok'] = True
+            else:
+                response = {'ok': False, 'error': 'unknown command'}
+        except Exception as ex:
+            response = {'ok': False, 'error': str(ex)}
+        response['cmd'] = cmd
+        response['elapsed_us'] = (perf_counter_ns() - start) // 1000
+        return response
@@ -0,0 +1,181 @@
+'''
+@Summary: Contains the datagram transport for live video
+@Author: devopsec
+
+Frames are split into fragments that each fit one datagram:
+    magic (2s) version (B) flags (B) frame seq (I) capture timestamp (d)
+    fragment (H) fragment count (H) frame length (I) fragment offset (I)
+followed by the fragment payload. Receivers reassemble by frame seq and drop frames missing a fragment
+instead of waiting for a retransmit.
+Receivers subscribe by sending a control datagram to the video port and must repeat it before the subscription expires:
+    magic (4s) version (B) flags (B)
+'''
+
+import socket, struct
+from time import monotonic
+from threading import Condition, Thread
+
+PACKET_MAGIC = b'SU'
+SUBSCRIBE_MAGIC = b'SUSB'
+UNSUBSCRIBE_MAGIC = b'SUUN'
+PROTOCOL_VERSION = 1
+PACKET_HEADER = struct.Struct('<2sBBIdHHII')
+CONTROL = struct.Struct('<4sBB')
+# ip + udp headers
+IP_OVERHEAD = 28
+
+# header flags
+FLAG_KEYFRAME = 0x01
+# subscribe flags
+SUBSCRIBE_MULTICAST = 0x01
+
+
+def fragmentSize(mtu):
+    return mtu - IP_OVERHEAD - PACKET_HEADER.size
+
+
+class DatagramSender():
+    """
+    Sends each frame as datagram fragments to every subscriber and the optional multicast group\n
+    The encoder thread only hands over the newest frame, fragments are sent from the sender's own thread,
+    a frame the sender has not started when the next one arrives is skipped
+    """
+
+    def __init__(self, host, port, mtu=1500, ttl=10, multicast_group='', multicast_port=0):
+        """
+        :param host:                address to receive subscriptions on
+        :type host:                 str
+        :param port:                port to receive subscriptions on
+        :type port:                 int
+        :param mtu:                 path mtu, fragments are sized to avoid ip fragmentation
+        :type mtu:                  int
+        :param ttl:                 seconds a subscription lasts unless it is renewed
+        :type ttl:                  float
+        :param multicast_group:     group to send to while any subscriber asks for multicast, '' to disable
+        :type multicast_group:      str
+        :param multicast_port:      destination port for the multicast group
+        :type multicast_port:       int
+        """
+
+        self.addr = (host, port)
+        self.fragment_size = fragmentSize(mtu)
+        self.ttl = ttl
+        self.multicast_addr = (multicast_group, multicast_port) if multicast_group else None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.multicast_addr is not None:
+            # keep multicast video on the local network
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.condition = Condition()
+        # { addr: expiry } unicast subscribers, the multicast group is a subscriber like any other
+        self.subscribers = {}
+        self.frame = None
+        self.frame_seq = 0
+        self.frame_time = 0.0
+        self.running = False
+        self.sent_frames = 0
+        self.skipped_frames = 0
+        self.send_errors = 0
+
+    @property
+    def active(self):
+        return len(self.subscribers) > 0
+
+    def start(self):
+        self.sock.bind(self.addr)
+        self.running = True
+        Thread(target=self.controlLoop, daemon=True).start()
+        Thread(target=self.sendLoop, daemon=True).start()
+        print("Datagram video on {}".format(str(self.sock.getsockname())))
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.sock.close()
+
+    def controlLoop(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(CONTROL.size)
+            except OSError:
+                break
+            if len(data) != CONTROL.size:
+                continue
+            magic, version, flags = CONTROL.unpack(data)
+            if version != PROTOCOL_VERSION:
+                continue
+            if flags & SUBSCRIBE_MULTICAST and self.multicast_addr is not None:
+                addr = self.multicast_addr
+
+            with self.condition:
+                # copy on write so the encoder thread can read the subscribers without the lock
+                subscribers = dict(self.subscribers)
+                if magic == SUBSCRIBE_MAGIC:
+                    if addr not in subscribers:
+                        print('Datagram subscriber {} added'.format(addr))
+                    subscribers[addr] = monotonic() + self.ttl
+                elif magic == UNSUBSCRIBE_MAGIC and addr != self.multicast_addr:
+                    subscribers.pop(addr, None)
+                self.subscribers = subscribers
+
+    def write(self, frame, seq, timestamp):
+        """ Called from the encoder thread with an immutable frame """
+
+        with self.condition:
+            if self.frame is not None:
+                self.skipped_frames += 1
+            self.frame = frame
+            self.frame_seq = seq
+            self.frame_time = timestamp
+            self.condition.notify()
+
+    def expire(self):
+        now = monotonic()
+        with self.condition:
+            if any(expiry < now for expiry in self.subscribers.values()):
+                self.subscribers = {addr: expiry for addr, expiry in self.subscribers.items() if expiry >= now}
+            return list(self.subscribers.keys())
+
+    def sendLoop(self):
+        while True:
+            with self.condition:
+                while self.running and self.frame is None:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                frame, seq, timestamp = self.frame, self.frame_seq, self.frame_time
+                self.frame = None
+
+            # an empty frame has no fragments to send
+            if len(frame) == 0:
+                self.skipped_frames += 1
+                continue
+
+            destinations = self.expire()
+            view = memoryview(frame)
+            size = self.fragment_size
+            count = (len(frame) + size - 1) // size
+            try:
+                # the header is the only per datagram allocation, the payload is a view of the frame
+                for i in range(count):
+                    header = PACKET_HEADER.pack(PACKET_MAGIC, PROTOCOL_VERSION, FLAG_KEYFRAME, seq & 0xffffffff,
+                                                timestamp, i, count, len(frame), i * size)
+                    payload = view[i * size:(i + 1) * size]
+                    for addr in destinations:
+                        try:
+                            self.sock.sendmsg((header, payload), (), 0, addr)
+                        except OSError:
+                            # a full send buffer or unreachable host only costs this fragment
+                            self.send_errors += 1
+            finally:
+                view.release()
+            self.sent_frames += 1
+
+    def getStats(self):
+        return {
+            'subscribers': [str(addr) for addr in self.subscribers],
+            'sent_frames': self.sent_frames,
+            'skipped_frames': self.skipped_frames,
+            'send_errors': self.send_errors,
+        }
@@ -0,0 +1,66 @@
+'''
+@Summary: Contains the framed wire protocol between pivideo and the webserver
+@Author: devopsec
+
+A client asks for framed delivery by sending a hello right after connecting:
+    magic (4s) version (B) flags (B)
+Every frame is then sent as a fixed size header followed by the payload:
+    magic (2s) version (B) flags (B) payload length (I) sequence number (Q) capture timestamp (d)
+Clients that send nothing get the raw concatenated jpeg stream
+'''
+
+import struct
+
+FRAME_MAGIC = b'SF'
+HELLO_MAGIC = b'SHFH'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('<2sBBIQd')
+HELLO = struct.Struct('<4sBB')
+
+# header flags
+FLAG_KEYFRAME = 0x01
+FLAG_H264 = 0x02 # payload is h264 instead of a jpeg
+# hello flags
+HELLO_H264 = 0x01 # ask for the h264 stream when the camera encodes one
+
+
+def packHeader(length, seq, timestamp, flags=FLAG_KEYFRAME):
+    return FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, flags, length, seq, timestamp)
+
+def packHello(flags=0):
+    return HELLO.pack(HELLO_MAGIC, PROTOCOL_VERSION, flags)
+
+def parseHello(data):
+    """
+    :return:    requested flags, None if data is not a supported hello
+    :rtype:     int|None
+    """
+
+    if len(data) != HELLO.size:
+        return None
+    magic, version, flags = HELLO.unpack(data)
+    if magic != HELLO_MAGIC or version != PROTOCOL_VERSION:
+        return None
+    return flags
+
+def sendBuffers(sock, buffers):
+    """
+    Send several buffers with scatter / gather writes, without joining them first
+
+    :param sock:        connected stream socket
+    :type sock:         socket.socket
+    :param buffers:     bytes-like objects sent in order
+    :type buffers:      list
+    """
+
+    views = [memoryview(buff).cast('B') for buff in buffers]
+    while len(views) > 0:
+        sent = sock.sendmsg(views)
+        # drop what was sent, a partial send leaves the tail of one buffer
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
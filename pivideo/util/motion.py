@@ -0,0 +1,233 @@
+'''
+@Summary: Contains software motion detection on the camera's low resolution stream
+@Author: devopsec
+'''
+
+import numpy as np
+from time import monotonic, perf_counter_ns
+from threading import Condition, Thread
+
+
+def zoneMask(width, height, zones):
+    """
+    :param zones:   (x, y, width, height) rectangles as fractions of the frame, empty watches the whole frame
+    :type zones:    list
+    :return:        True where changes count as motion
+    :rtype:         numpy.ndarray
+    """
+
+    if len(zones) == 0:
+        return np.ones((height, width), dtype=bool)
+    mask = np.zeros((height, width), dtype=bool)
+    for x, y, w, h in zones:
+        mask[int(round(y * height)):int(round((y + h) * height)), int(round(x * width)):int(round((x + w) * width))] = True
+    return mask
+
+def largestBlob(active, counts):
+    """
+    Changed pixels in the largest group of touching active blocks\n
+    Every block starts with its own label and labels spread to their neighbours as a running maximum until they settle,
+    so each pass is a handful of array operations over the block grid
+
+    :param active:  blocks with enough changed pixels
+    :type active:   numpy.ndarray
+    :param counts:  changed pixels per block
+    :type counts:   numpy.ndarray
+    :return:        changed pixels in the largest blob, 0 if no block is active
+    :rtype:         int
+    """
+
+    # changes spread thinly over many blocks leave no block active
+    if not active.any():
+        return 0
+    labels = np.arange(1, active.size + 1).reshape(active.shape)
+    labels *= active
+    spread = labels.copy()
+    while True:
+        np.maximum(spread[1:], labels[:-1], out=spread[1:])
+        np.maximum(spread[:-1], labels[1:], out=spread[:-1])
+        np.maximum(spread[:, 1:], labels[:, :-1], out=spread[:, 1:])
+        np.maximum(spread[:, :-1], labels[:, 1:], out=spread[:, :-1])
+        spread *= active
+        if np.array_equal(spread, labels):
+            break
+        labels[:] = spread
+    return int(np.bincount(labels.ravel(), weights=counts.ravel())[1:].max())
+
+
+class MotionDetector():
+    """
+    Frame differencing on the luma plane of the low resolution stream\n
+    Pixels whose brightness changed by more than the sensitivity threshold are counted per block,
+    blocks with enough changed pixels are grouped into blobs and a blob covering the minimum area is motion\n
+    The camera thread only copies the newest luma plane, detection runs on its own thread
+    and a frame that arrives while the previous one is analysed replaces the waiting one
+    """
+
+    def __init__(self, size, step=1, zones=(), sensitivity=50, min_area=0.01, block_size=8, trigger_frames=2, hold=3,
+                 on_motion=None, on_idle=None):
+        """
+        :param size:            luma plane width and height
+        :type size:             tuple
+        :param step:            analyse every step-th pixel of every step-th row
+        :type step:             int
+        :param zones:           (x, y, width, height) rectangles as fractions of the frame, empty watches the whole frame
+        :type zones:            list
+        :param sensitivity:     0-100, higher reacts to smaller brightness changes
+        :type sensitivity:      int
+        :param min_area:        smallest blob that counts as motion, as a fraction of the watched area
+        :type min_area:         float
+        :param block_size:      pixels per side of the blocks blobs are built from
+        :type block_size:       int
+        :param trigger_frames:  consecutive frames with motion before on_motion is called
+        :type trigger_frames:   int
+        :param hold:            seconds without motion before on_idle is called
+        :type hold:             float
+        :param on_motion:       callable(area) called when motion starts, area is the blob fraction
+        :type on_motion:        callable
+        :param on_idle:         callable() called when motion ends
+        :type on_idle:          callable
+        """
+
+        self.step = step
+        self.block_size = block_size
+        # only whole blocks are analysed
+        self.rows = size[1] // step // block_size
+        self.cols = size[0] // step // block_size
+        self.height = self.rows * block_size
+        self.width = self.cols * block_size
+        self.threshold = round(1 + (100 - min(max(sensitivity, 0), 100)) / 2)
+        self.zone = zoneMask(self.width, self.height, zones)
+        self.min_pixels = max(int(min_area * np.count_nonzero(self.zone)), 1)
+        # a block is active once a quarter of its pixels changed
+        self.block_pixels = max(block_size * block_size // 4, 1)
+        self.trigger_frames = trigger_frames
+        self.hold = hold
+        self.on_motion = on_motion
+        self.on_idle = on_idle
+
+        # every buffer is allocated once, frames are analysed in place
+        self.incoming = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.current = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.previous = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.low = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.changed = np.zeros((self.height, self.width), dtype=bool)
+        self.condition = Condition()
+        self.pending = False
+        self.primed = False
+        self.running = False
+
+        self.active = False
+        self.motion_frames = 0
+        self.last_motion = 0.0
+        self.area = 0.0
+        self.frames = 0
+        self.skipped_frames = 0
+        self.events = 0
+        # running average of the analysis time in microseconds (1/8 weight for new frames)
+        self.analysis_us = 0
+
+    def submit(self, luma):
+        """
+        Hand over a frame, called from the camera thread
+
+        :param luma:    luma plane, rows beyond the plane (chroma) and row padding are ignored
+        :type luma:     numpy.ndarray
+        """
+
+        with self.condition:
+            if self.pending:
+                self.skipped_frames += 1
+            np.copyto(self.incoming, luma[:self.height * self.step:self.step, :self.width * self.step:self.step])
+            self.pending = True
+            self.condition.notify()
+
+    def analyse(self):
+        """
+        :return:    fraction of the watched area covered by the largest moving blob, 0 if it is below the minimum
+        :rtype:     float
+        """
+
+        current, previous, changed = self.current, self.previous, self.changed
+        # absolute difference without leaving uint8
+        np.minimum(current, previous, out=self.low)
+        np.maximum(current, previous, out=previous)
+        np.subtract(previous, self.low, out=previous)
+        np.greater_equal(previous, self.threshold, out=changed)
+        np.logical_and(changed, self.zone, out=changed)
+        # the analysed frame is the reference for the next one
+        self.current, self.previous = previous, current
+
+        counts = changed.reshape(self.rows, self.block_size, self.cols, self.block_size).sum(axis=(1, 3))
+        if counts.sum() < self.min_pixels:
+            return 0.0
+        blob = largestBlob(counts >= self.block_pixels, counts)
+        if blob < self.min_pixels:
+            return 0.0
+        return blob / np.count_nonzero(self.zone)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or not self.running,
+                                        self.hold if self.active else None)
+                if not self.running:
+                    break
+                pending = self.pending
+                if pending:
+                    self.incoming, self.current = self.current, self.incoming
+                    self.pending = False
+
+            if pending:
+                start = perf_counter_ns()
+                if self.primed:
+                    self.update(self.analyse())
+                else:
+                    # the first frame only becomes the reference
+                    self.current, self.previous = self.previous, self.current
+                    self.primed = True
+                elapsed = (perf_counter_ns() - start) // 1000
+                self.analysis_us = elapsed if self.frames == 0 else (self.analysis_us * 7 + elapsed) >> 3
+                self.frames += 1
+            else:
+                self.update(0.0)
+
+    def update(self, area):
+        now = monotonic()
+        if area > 0:
+            self.area = area
+            self.last_motion = now
+            self.motion_frames += 1
+            if not self.active and self.motion_frames >= self.trigger_frames:
+                self.active = True
+                self.events += 1
+                print('Motion detected covering {:.1%} of the watched area'.format(area))
+                if self.on_motion is not None:
+                    self.on_motion(area)
+            return
+
+        self.motion_frames = 0
+        if self.active and now - self.last_motion >= self.hold:
+            self.active = False
+            print('Motion ended')
+            if self.on_idle is not None:
+                self.on_idle()
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def getStats(self):
+        return {
+            'active': self.active,
+            'area': round(self.area, 4),
+            'events': self.events,
+            'frames': self.frames,
+            'skipped_frames': self.skipped_frames,
+            'analysis_us': self.analysis_us,
+        }
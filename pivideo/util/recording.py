@@ -0,0 +1,398 @@
+'''
+@Summary: Contains the recorder writing encoded frames to the video archive
+@Author: devopsec
+'''
+
+import os, json
+from array import array
+from time import time
+from threading import Lock, Condition, Timer
+from util.segments import SegmentWriter, segmentPath
+
+# batches of frames queued during the pre-roll flush that are written before the encoder is blocked
+CATCHUP_ROUNDS = 4
+
+
+class PreRollBuffer():
+    """
+    Fixed memory ring holding the most recent encoded frames\n
+    Frame data lives in one preallocated bytearray and frame positions in preallocated arrays,
+    so nothing is allocated per frame once the ring is created\n
+    Frames are kept contiguous, a frame that does not fit at the end of the ring wraps to the start\n
+    Draining starts at the oldest keyframe so the recording can be decoded from its first frame
+    """
+
+    def __init__(self, max_bytes, max_seconds, max_frames):
+        """
+        :param max_bytes:       memory budget for frame data
+        :type max_bytes:        int
+        :param max_seconds:     frames older than this are dropped
+        :type max_seconds:      float
+        :param max_frames:      size of the frame table
+        :type max_frames:       int
+        """
+
+        self.max_seconds = max_seconds
+        self.buffer = bytearray(max_bytes)
+        self.capacity = max_bytes
+        self.offsets = array('L', [0]) * max_frames
+        self.lengths = array('L', [0]) * max_frames
+        self.timestamps = array('d', [0.0]) * max_frames
+        self.keyframes = array('B', [0]) * max_frames
+        self.max_frames = max_frames
+        # index of the oldest frame in the frame table
+        self.first = 0
+        self.count = 0
+        # where the next frame would be written in the buffer
+        self.head = 0
+        self.size = 0
+        self.dropped_frames = 0
+
+    def evict(self):
+        self.size -= self.lengths[self.first]
+        self.first = (self.first + 1) % self.max_frames
+        self.count -= 1
+
+    def clear(self):
+        self.first = 0
+        self.count = 0
+        self.head = 0
+        self.size = 0
+
+    def write(self, frame, timestamp, keyframe=True):
+        length = len(frame)
+        if length > self.capacity:
+            # a frame larger than the whole ring would break the pre-roll continuity
+            self.clear()
+            self.dropped_frames += 1
+            return
+
+        pos = self.head
+        if pos + length > self.capacity:
+            # wrap, frames left at the end of the ring are the oldest ones
+            while self.count > 0 and self.offsets[self.first] >= pos:
+                self.evict()
+            pos = 0
+        end = pos + length
+        # drop the oldest frames overlapping the new one, outside the time window or beyond the frame table
+        while self.count > 0:
+            offset = self.offsets[self.first]
+            if (offset < end and offset + self.lengths[self.first] > pos) or \
+                    self.timestamps[self.first] < timestamp - self.max_seconds or self.count >= self.max_frames:
+                self.evict()
+            else:
+                break
+
+        self.buffer[pos:end] = frame
+        index = (self.first + self.count) % self.max_frames
+        self.offsets[index] = pos
+        self.lengths[index] = length
+        self.timestamps[index] = timestamp
+        self.keyframes[index] = 1 if keyframe else 0
+        self.count += 1
+        self.size += length
+        self.head = end
+
+    def firstKeyframe(self):
+        """
+        :return:    position of the oldest keyframe counted from the oldest frame, count if there is none
+        :rtype:     int
+        """
+
+        for i in range(self.count):
+            if self.keyframes[(self.first + i) % self.max_frames]:
+                return i
+        return self.count
+
+    def oldest(self):
+        """ Capture time of the first frame drain() would write """
+
+        start = self.firstKeyframe()
+        return self.timestamps[(self.first + start) % self.max_frames] if start < self.count else None
+
+    def duration(self):
+        if self.count == 0:
+            return 0
+        last = (self.first + self.count - 1) % self.max_frames
+        return self.timestamps[last] - self.timestamps[self.first]
+
+    def drain(self, output):
+        """
+        Write all buffered frames oldest first with their capture times and empty the ring
+
+        :param output:  segment to write to
+        :type output:   util.segments.SegmentWriter
+        :return:        frames and bytes written
+        :rtype:         tuple
+        """
+
+        frames = 0
+        size = 0
+        view = memoryview(self.buffer)
+        try:
+            for i in range(self.firstKeyframe(), self.count):
+                index = (self.first + i) % self.max_frames
+                offset = self.offsets[index]
+                length = self.lengths[index]
+                output.write(view[offset:offset + length], self.timestamps[index], self.keyframes[index] == 1)
+                frames += 1
+                size += length
+        finally:
+            view.release()
+            self.clear()
+        return frames, size
+
+    def getStats(self):
+        return {
+            'frames': self.count,
+            'bytes': self.size,
+            'seconds': round(self.duration(), 3),
+            'dropped_frames': self.dropped_frames,
+        }
+
+
+class Recorder():
+    """
+    Writes encoded frames to the video archive as fixed duration, indexed segments (see util/segments.py)\n
+    Segment files are opened and closed by the thread issuing the command or rolling the segment,
+    the encoder thread only ever writes to an already open segment under a short lock\n
+    While idle frames go to the optional pre-roll ring, which is flushed to the first segment when recording starts,
+    frames arriving during the flush are queued in memory and written after it so the encoder never waits on the disk\n
+    Segments always start at a keyframe, the encoder thread switches to a pre-opened segment on the next one
+    """
+
+    def __init__(self, video_dir, buffsize=-1, extension='.mjpeg', preroll=None, segment_seconds=0, retention=None,
+                 keyframe_timeout=2):
+        """
+        :param segment_seconds:     segment duration, 0 keeps each recording in a single segment
+        :type segment_seconds:      float
+        :param retention:           told about every closed segment and asked for space before opening one
+        :type retention:            util.retention.RetentionManager
+        :param keyframe_timeout:    seconds a segment roll waits for a keyframe before switching anyway
+        :type keyframe_timeout:     float
+        """
+
+        self.video_dir = video_dir
+        self.buffsize = buffsize
+        self.extension = extension
+        self.preroll = preroll
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.keyframe_timeout = keyframe_timeout
+        # guards the open segment against the encoder thread
+        self.lock = Condition()
+        # serializes start / stop / roll / mark commands
+        self.command_lock = Lock()
+        self.segment = None
+        # frames queued while the pre-roll is written, None when no flush is running
+        self.pending = None
+        # segment the encoder switches to on the next keyframe and the one it switched away from
+        self.next_segment = None
+        self.rolled = None
+        self.roll_timer = None
+        self.filename = None
+        self.started = None
+        self.segments = 0
+        self.bytes_written = 0
+        self.frames_written = 0
+
+    @property
+    def recording(self):
+        return self.segment is not None
+
+    def write(self, frame, keyframe=True):
+        """ Called from the encoder thread for every frame """
+
+        timestamp = time()
+        with self.lock:
+            if self.segment is None:
+                if self.pending is not None:
+                    # the frame buffer is reused by the encoder, keep a copy
+                    self.pending.append((bytes(frame), timestamp, keyframe))
+                elif self.preroll is not None:
+                    self.preroll.write(frame, timestamp, keyframe)
+                return
+            if keyframe and self.next_segment is not None:
+                self.rolled, self.segment = self.segment, self.next_segment
+                self.next_segment = None
+                self.filename = self.segment.path
+                self.lock.notify_all()
+            # a recording started between keyframes can not be decoded until the next one
+            if self.segment.frames == 0 and not keyframe:
+                return
+            try:
+                self.segment.write(frame, timestamp, keyframe)
+                self.bytes_written += len(frame)
+                self.frames_written += 1
+            except (OSError, ValueError) as ex:
+                print('Recording to {} failed: {}'.format(self.filename, str(ex)))
+                self.segment, segment = None, self.segment
+                self.closeSegment(segment)
+
+    def status(self):
+        return {
+            'recording': self.recording,
+            'file': self.filename,
+            'started': self.started,
+            'segments': self.segments,
+            'bytes_written': self.bytes_written,
+            'frames_written': self.frames_written,
+            'preroll': self.preroll.getStats() if self.preroll is not None else None,
+            'timestamp': time(),
+        }
+
+    def openSegment(self, timestamp):
+        if self.retention is not None:
+            self.retention.reserve()
+        return SegmentWriter(segmentPath(self.video_dir, timestamp, self.extension), self.buffsize)
+
+    def closeSegment(self, segment):
+        try:
+            segment.close()
+        except (OSError, ValueError) as ex:
+            print('Closing {} failed: {}'.format(segment.path, str(ex)))
+        if self.retention is not None:
+            self.retention.add(segment.path)
+
+    def writePending(self, segment, frames):
+        """ Write frames queued during the pre-roll flush, the encoder is not writing to the segment yet """
+
+        try:
+            for frame, timestamp, keyframe in frames:
+                # the segment can only be decoded from a keyframe
+                if segment.frames == 0 and not keyframe:
+                    continue
+                segment.write(frame, timestamp, keyframe)
+        except (OSError, ValueError) as ex:
+            print('Writing pre-roll to {} failed: {}'.format(segment.path, str(ex)))
+
+    def scheduleRoll(self, segment):
+        if self.segment_seconds > 0:
+            self.roll_timer = Timer(self.segment_seconds, self.roll, args=(segment,))
+            self.roll_timer.daemon = True
+            self.roll_timer.start()
+
+    def start(self):
+        """
+        Start recording to a new segment, does nothing if already recording
+
+        :return:    recorder status including the segment file name
+        :rtype:     dict
+        """
+
+        with self.command_lock:
+            if self.recording:
+                return self.status()
+
+            started = time()
+            # the first segment is named after the oldest pre-roll frame it will hold
+            oldest = self.preroll.oldest() if self.preroll is not None else None
+            segment = self.openSegment(oldest or started)
+            if self.preroll is not None:
+                # the ring is no longer written once frames are queued, it is copied to disk without the lock
+                with self.lock:
+                    self.pending = []
+                try:
+                    self.preroll.drain(segment)
+                except (OSError, ValueError) as ex:
+                    print('Writing pre-roll to {} failed: {}'.format(segment.path, str(ex)))
+                # catch up on the frames queued meanwhile, each batch is shorter than the one before
+                # unless the disk is slower than the encoder, then the rest is written under the lock
+                for _ in range(CATCHUP_ROUNDS):
+                    with self.lock:
+                        pending, self.pending = self.pending, []
+                    if len(pending) == 0:
+                        break
+                    self.writePending(segment, pending)
+            with self.lock:
+                # usually no more than the frames of the last batch write are left
+                if self.pending:
+                    self.writePending(segment, self.pending)
+                self.pending = None
+                self.segment = segment
+                self.filename = segment.path
+                self.started = started
+                self.segments = 1
+                self.bytes_written = segment.size
+                self.frames_written = segment.frames
+            self.scheduleRoll(segment)
+            return self.status()
+
+    def roll(self, expected=None):
+        """
+        Continue the recording in a new segment
+
+        :param expected:    only roll if this is still the current segment
+        :type expected:     SegmentWriter
+        """
+
+        with self.command_lock:
+            if not self.recording or (expected is not None and self.segment is not expected):
+                return self.status()
+
+            try:
+                segment = self.openSegment(time())
+            except OSError as ex:
+                # keep recording to the current segment and try again next period
+                print('Could not open a new segment: {}'.format(str(ex)))
+                self.scheduleRoll(self.segment)
+                return self.status()
+            with self.lock:
+                self.next_segment = segment
+                self.rolled = None
+                self.lock.wait_for(lambda: self.next_segment is None or self.segment is None, self.keyframe_timeout)
+                if self.next_segment is not None:
+                    # no keyframe in time or the current segment failed, switch right away
+                    self.rolled, self.segment = self.segment, segment
+                    self.next_segment = None
+                    self.filename = segment.path
+                previous, self.rolled = self.rolled, None
+                self.segments += 1
+            # the encoder closes a failed segment itself
+            if previous is not None:
+                self.closeSegment(previous)
+            self.scheduleRoll(segment)
+            return self.status()
+
+    def stop(self):
+        """
+        Stop recording and close the segment, does nothing if not recording
+
+        :return:    recorder status, file is the segment just closed
+        :rtype:     dict
+        """
+
+        with self.command_lock:
+            if self.roll_timer is not None:
+                self.roll_timer.cancel()
+                self.roll_timer = None
+            with self.lock:
+                segment, self.segment = self.segment, None
+            # closing may flush to disk, keep it out of the encoder's way
+            if segment is not None:
+                self.closeSegment(segment)
+            return self.status()
+
+    def mark(self, label=''):
+        """
+        Record an event at the current position of the recording\n
+        Marks are appended to a .events sidecar next to the current segment
+
+        :return:    mark with segment file name, byte offset and timestamp
+        :rtype:     dict
+        """
+
+        with self.command_lock:
+            timestamp = time()
+            with self.lock:
+                recording = self.recording
+                filename = self.filename
+                offset = self.segment.size if recording else 0
+            mark = {'file': filename if recording else None, 'offset': offset, 'timestamp': timestamp, 'label': label}
+            if recording:
+                with open(os.path.splitext(filename)[0] + '.events', 'a') as fp:
+                    fp.write(json.dumps(mark) + '\n')
+            return mark
+
+    def close(self):
+        self.stop()
@@ -0,0 +1,191 @@
+'''
+@Summary: Contains the retention manager keeping the video archive within its disk budget
+@Author: devopsec
+'''
+
+import os, errno
+from time import time
+from collections import deque
+from datetime import datetime
+from threading import Condition, Thread
+from util.segments import DAY_FORMAT, INDEX_EXTENSION
+
+# files belonging to a segment, deleted together
+SEGMENT_EXTENSIONS = ('.mjpeg', '.h264', INDEX_EXTENSION, '.events')
+
+
+class RetentionManager():
+    """
+    Deletes the oldest segments once the archive exceeds its byte budget or they exceed the max age\n
+    The archive is scanned once at startup, after that a ledger of segment sizes is kept up to date
+    by the recorder reporting every closed segment, so enforcing the budget never walks the archive\n
+    Cleanup runs on its own thread, the recorder only calls reserve() before opening a segment
+    """
+
+    def __init__(self, video_dir, max_bytes=0, max_age=0, min_free=0, interval=60):
+        """
+        :param video_dir:   video archive directory
+        :type video_dir:    str
+        :param max_bytes:   archive byte budget, 0 for no budget
+        :type max_bytes:    int
+        :param max_age:     seconds to keep segments, 0 to keep them until space runs out
+        :type max_age:      float
+        :param min_free:    free bytes to keep on the file system
+        :type min_free:     int
+        :param interval:    seconds between age checks
+        :type interval:     float
+        """
+
+        self.video_dir = video_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_free = min_free
+        self.interval = interval
+        self.condition = Condition()
+        # (segment path without extension, bytes, closed time) oldest first
+        self.ledger = deque()
+        self.total_bytes = 0
+        self.deleted_segments = 0
+        self.deleted_bytes = 0
+        self.running = False
+
+    def scan(self):
+        """
+        Build the ledger from the archive, only done once at startup
+        """
+
+        segments = {}
+        try:
+            days = sorted(entry for entry in os.listdir(self.video_dir) if self.isDay(entry))
+        except FileNotFoundError:
+            days = []
+        for day in days:
+            with os.scandir(os.path.join(self.video_dir, day)) as entries:
+                for entry in entries:
+                    base, ext = os.path.splitext(entry.path)
+                    if ext not in SEGMENT_EXTENSIONS:
+                        continue
+                    stat = entry.stat()
+                    size, closed = segments.get(base, (0, 0))
+                    segments[base] = (size + stat.st_size, max(closed, stat.st_mtime))
+
+        with self.condition:
+            # segment names start with the start time, so sorting by path sorts by time
+            self.ledger = deque((base, size, closed) for base, (size, closed) in sorted(segments.items()))
+            self.total_bytes = sum(size for _, size, _ in self.ledger)
+        print('Video archive holds {} segments, {} bytes'.format(len(self.ledger), self.total_bytes))
+
+    @staticmethod
+    def isDay(name):
+        try:
+            datetime.strptime(name, DAY_FORMAT)
+            return True
+        except ValueError:
+            return False
+
+    def add(self, path):
+        """
+        Account for a segment the recorder just closed
+
+        :param path:    segment path
+        :type path:     str
+        """
+
+        base = os.path.splitext(path)[0]
+        size = 0
+        for ext in SEGMENT_EXTENSIONS:
+            try:
+                size += os.stat(base + ext).st_size
+            except OSError:
+                pass
+        with self.condition:
+            self.ledger.append((base, size, time()))
+            self.total_bytes += size
+            if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+                self.condition.notify()
+
+    def freeBytes(self):
+        stat = os.statvfs(self.video_dir)
+        return stat.f_bavail * stat.f_frsize
+
+    def reserve(self):
+        """
+        Make sure there is room for a new segment, deleting the oldest segments if the file system is short\n
+        Called before a segment is opened, never from the encoder thread
+
+        :raises OSError:    ENOSPC if no space can be freed
+        """
+
+        if self.min_free <= 0:
+            return
+        free = self.freeBytes()
+        while free < self.min_free:
+            deleted = self.deleteOldest()
+            if deleted is None:
+                raise OSError(errno.ENOSPC, 'less than {} bytes free in {} and nothing left to delete'.format(
+                    self.min_free, self.video_dir))
+            free = self.freeBytes()
+
+    def deleteOldest(self):
+        """
+        :return:    bytes freed, None if the ledger is empty
+        :rtype:     int|None
+        """
+
+        with self.condition:
+            if len(self.ledger) == 0:
+                return None
+            base, size, _ = self.ledger.popleft()
+            self.total_bytes -= size
+
+        for ext in SEGMENT_EXTENSIONS:
+            try:
+                os.remove(base + ext)
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                print('Could not delete {}: {}'.format(base + ext, str(ex)))
+        # drop the day directory with its last segment
+        try:
+            os.rmdir(os.path.dirname(base))
+        except OSError:
+            pass
+
+        self.deleted_segments += 1
+        self.deleted_bytes += size
+        return size
+
+    def expired(self):
+        with self.condition:
+            if len(self.ledger) == 0:
+                return False
+            _, _, closed = self.ledger[0]
+            if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+                return True
+            return self.max_age > 0 and closed < time() - self.max_age
+
+    def run(self):
+        while self.running:
+            while self.running and self.expired():
+                self.deleteOldest()
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval)
+
+    def start(self):
+        self.scan()
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def getStats(self):
+        return {
+            'segments': len(self.ledger),
+            'bytes': self.total_bytes,
+            'deleted_segments': self.deleted_segments,
+            'deleted_bytes': self.deleted_bytes,
+        }
@@ -0,0 +1,225 @@
+'''
+@Summary: Contains the segment file format of the video archive
+@Author: devopsec
+
+Recordings are split into fixed duration segments stored under one directory per day:
+    <video_dir>/YYYY-MM-DD/YYYY-MM-DD_HH-MM-SS.mjpeg (or .h264)
+Each segment has a .idx sidecar with one fixed size entry per keyframe, which is every frame for mjpeg:
+    header:     magic (4s) version (H) entry size (H)
+    entries:    byte offset of the frame in the segment (Q) capture timestamp (d)
+Entries are appended in capture order so the index is sorted by timestamp and can be binary searched in place
+'''
+
+import os, mmap, struct
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+INDEX_MAGIC = b'SHIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHH')
+INDEX_ENTRY = struct.Struct('<Qd')
+INDEX_EXTENSION = '.idx'
+DAY_FORMAT = '%Y-%m-%d'
+NAME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+def indexPath(segment_path):
+    return os.path.splitext(segment_path)[0] + INDEX_EXTENSION
+
+def segmentPath(video_dir, timestamp, extension='.mjpeg'):
+    """
+    Path of a new segment starting at timestamp, suffixed with _N if the name is taken
+
+    :return:    segment path, its day directory is not created
+    :rtype:     str
+    """
+
+    start = datetime.fromtimestamp(timestamp)
+    day_dir = os.path.join(video_dir, start.strftime(DAY_FORMAT))
+    name = start.strftime(NAME_FORMAT)
+    path = os.path.join(day_dir, name + extension)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(day_dir, '{}_{}{}'.format(name, suffix, extension))
+        suffix += 1
+    return path
+
+
+class SegmentWriter():
+    """
+    Writes frames to a segment file and the offsets and timestamps of keyframes to its index\n
+    Playback can only start at a keyframe, so those are the only seek targets worth indexing
+    """
+
+    def __init__(self, path, buffsize=-1):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.video_file = open(path, 'wb', buffering=buffsize)
+        try:
+            self.index_file = open(indexPath(path), 'wb')
+            self.index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_ENTRY.size))
+        except OSError:
+            self.video_file.close()
+            raise
+        self.size = 0
+        self.frames = 0
+
+    def write(self, frame, timestamp, keyframe=True):
+        self.video_file.write(frame)
+        if keyframe:
+            self.index_file.write(INDEX_ENTRY.pack(self.size, timestamp))
+        self.size += len(frame)
+        self.frames += 1
+
+    def close(self):
+        try:
+            self.video_file.close()
+        finally:
+            self.index_file.close()
+
+
+class SegmentIndex():
+    """
+    Memory mapped reader of a segment index\n
+    Lookups binary search the mapped entries, nothing is loaded up front
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    segment or index path
+        :type path:     str
+        :raises ValueError:     if the file is not a segment index
+        """
+
+        self.path = path if path.endswith(INDEX_EXTENSION) else indexPath(path)
+        self.map = None
+        with open(self.path, 'rb') as fp:
+            header = fp.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                raise ValueError('truncated index {}'.format(self.path))
+            magic, version, entry_size = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION or entry_size != INDEX_ENTRY.size:
+                raise ValueError('unsupported index {}'.format(self.path))
+            # an index still being written may end in a partial entry, ignore it
+            size = os.fstat(fp.fileno()).st_size
+            self.count = (size - INDEX_HEADER.size) // INDEX_ENTRY.size
+            if self.count > 0:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def entry(self, i):
+        """
+        :return:    byte offset and capture timestamp of frame i
+        :rtype:     tuple
+        """
+
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('frame index out of range')
+        return INDEX_ENTRY.unpack_from(self.map, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+    def timestamp(self, i):
+        return self.entry(i)[1]
+
+    def offset(self, i):
+        return self.entry(i)[0]
+
+    def find(self, timestamp):
+        """
+        Frame showing the given time, that is the last frame captured at or before it
+
+        :return:    frame number, 0 if timestamp is before the first frame
+        :rtype:     int
+        """
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def listSegments(video_dir, day, extension='.mjpeg'):
+    """
+    Segments of one day sorted by start time
+
+    :param day:     date to list
+    :type day:      datetime.date
+    :return:        segment paths
+    :rtype:         list
+    """
+
+    day_dir = os.path.join(video_dir, day.strftime(DAY_FORMAT))
+    try:
+        names = os.listdir(day_dir)
+    except FileNotFoundError:
+        return []
+    # names start with the start time, so sorting by name sorts by time
+    return [os.path.join(day_dir, name) for name in sorted(names) if name.endswith(extension)]
+
+def findFrame(video_dir, timestamp, extension='.mjpeg'):
+    """
+    Locate the frame recorded at a wall clock time
+
+    :param video_dir:   video archive directory
+    :type video_dir:    str
+    :param timestamp:   epoch time to seek to
+    :type timestamp:    float
+    :return:            segment path, byte offset and capture time of the frame, None if nothing was recorded
+    :rtype:             tuple|None
+    """
+
+    day = datetime.fromtimestamp(timestamp).date()
+    # a segment started before midnight may hold the time we are looking for
+    segments = listSegments(video_dir, day - timedelta(days=1), extension) + listSegments(video_dir, day, extension)
+    name = datetime.fromtimestamp(timestamp).strftime(NAME_FORMAT)
+    names = [os.path.basename(path) for path in segments]
+    # last segment starting at or before the requested second, '~' sorts after any _N suffix or extension
+    pos = bisect_right(names, name + '~') - 1
+
+    # a segment may not cover the time if recording was stopped, fall back to the next recording
+    for path in segments[max(pos, 0):pos + 2]:
+        try:
+            with SegmentIndex(path) as index:
+                if len(index) == 0:
+                    continue
+                if index.timestamp(-1) < timestamp and path != segments[-1]:
+                    continue
+                offset, captured = index.entry(index.find(timestamp))
+                return path, offset, captured
+        except (OSError, ValueError):
+            continue
+    return None
+
+def openAt(video_dir, timestamp, extension='.mjpeg'):
+    """
+    Open the segment holding a wall clock time positioned at the start of that frame
+
+    :return:    open segment file and capture time of the frame, None if nothing was recorded
+    :rtype:     tuple|None
+    """
+
+    found = findFrame(video_dir, timestamp, extension)
+    if found is None:
+        return None
+    path, offset, captured = found
+    fp = open(path, 'rb')
+    fp.seek(offset)
+    return fp, captured
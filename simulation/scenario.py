@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+'''
+@Summary: Runs the sensor -> pivideo -> webserver pipeline on one linux box with simulated hardware
+@Author: devopsec
+
+pisensor runs with the simulated GPIO backend following a scripted motion timeline,
+pivideo runs with the synthetic camera and the webserver relays the stream to local viewers.
+Reports end to end frame latency (capture -> viewer) and motion -> recording latency.
+'''
+
+import os, sys, json, signal, socket, shutil, subprocess, tempfile, argparse, threading
+from time import time, sleep
+from urllib.request import urlopen
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'webserver'))
+from util.mjpeg import MjpegParser
+
+
+# sensor pins, must match pisensor/sensor.py
+MOTION_PIN = 17
+DOOR_PIN = 27
+
+# runs a component with settings overridden before its main module executes
+BOOTSTRAP = '''
+import sys, os, json, runpy
+app_dir, script, overrides = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+os.chdir(app_dir)
+sys.path.insert(0, app_dir)
+import settings
+for key, value in overrides.items():
+    setattr(settings, key, tuple(value) if isinstance(value, list) else value)
+sys.argv = [script]
+runpy.run_path(script, run_name='__main__')
+'''
+
+
+def readTimestamp(frame):
+    """capture time stamped by the synthetic camera (see pivideo/util/camera.py)"""
+
+    if frame[2:4] != b'\xff\xfe':
+        return None
+    length = int.from_bytes(frame[4:6], 'big')
+    payload = bytes(frame[6:4 + length])
+    if not payload.startswith(b'shomesec-ts:'):
+        return None
+    return float(payload[12:])
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Component():
+    """ One shomesec process started through the settings bootstrap """
+
+    def __init__(self, name, script, overrides, work_dir, env=None):
+        self.name = name
+        self.log_file = os.path.join(work_dir, name + '.log')
+        self.log = open(self.log_file, 'wb')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', '-c', BOOTSTRAP, os.path.join(PROJECT_DIR, name), script, json.dumps(overrides)],
+            stdout=self.log, stderr=subprocess.STDOUT, env=dict(os.environ, **(env or {}))
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def stop(self):
+        if self.alive():
+            # SIGINT lets the component run its teardown
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.log.close()
+
+
+class Viewer(threading.Thread):
+    """ Reads /video_feed from the webserver and records capture -> receive latency per frame """
+
+    def __init__(self, url):
+        super().__init__(daemon=True)
+        self.url = url
+        self.latencies = []
+        self.frames = 0
+        self.running = True
+
+    def run(self):
+        try:
+            with urlopen(self.url, timeout=10) as resp:
+                parser = MjpegParser()
+                while self.running:
+                    data = resp.read1(65536)
+                    if not data:
+                        break
+                    now = time()
+                    for frame in parser.feed(data):
+                        self.frames += 1
+                        captured = readTimestamp(frame)
+                        if captured is not None:
+                            self.latencies.append(now - captured)
+        except OSError as ex:
+            print('viewer error: {}'.format(str(ex)))
+
+
+class RecordingWatcher(threading.Thread):
+    """ Polls the video server control channel to see when recording starts and stops """
+
+    def __init__(self, path, interval=0.001):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.starts = []
+        self.stops = []
+        self.running = True
+
+    def run(self):
+        recording = False
+        sock = None
+        while self.running:
+            try:
+                if sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(self.path)
+                    reader = sock.makefile('rb')
+                sock.sendall(b'{"cmd": "status"}\n')
+                status = json.loads(reader.readline())
+            except (OSError, ValueError):
+                if sock is not None:
+                    sock.close()
+                sock = None
+                sleep(0.1)
+                continue
+
+            now = time()
+            if status['recording'] != recording:
+                recording = status['recording']
+                (self.starts if recording else self.stops).append(now)
+            sleep(self.interval)
+
+
+def edgeLatencies(edges, observed):
+    """latency from each scripted edge to the first observation after it"""
+
+    latencies = []
+    for edge in edges:
+        after = [t for t in observed if t >= edge]
+        if len(after) > 0:
+            latencies.append(after[0] - edge)
+    return latencies
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Run the shomesec pipeline with simulated hardware')
+    parser.add_argument('--resolution', default='1920x1080', help='camera resolution, WxH')
+    parser.add_argument('--fps', type=int, default=40, help='camera frames per second')
+    parser.add_argument('--frame-size', type=int, default=150000, help='synthetic frame size in bytes')
+    parser.add_argument('--protocol', default='framed', choices=('raw', 'framed', 'udp'),
+                        help='transport between pivideo and the webserver')
+    parser.add_argument('--viewers', type=int, default=4, help='concurrent /video_feed viewers')
+    parser.add_argument('--motion-events', type=int, default=5, help='scripted motion detections')
+    parser.add_argument('--motion-hold', type=float, default=3, help='seconds each motion detection lasts')
+    parser.add_argument('--motion-gap', type=float, default=3, help='seconds between motion detections')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds before the first motion detection')
+    parser.add_argument('--tz', default='America/New_York', help='timezone for the sensor sunrise / sunset lookup')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory and logs')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    width, height = (int(x) for x in args.resolution.split('x'))
+    work_dir = tempfile.mkdtemp(prefix='shomesec-scenario-')
+    run_dir = os.path.join(work_dir, 'run')
+    video_dir = os.path.join(work_dir, 'videos')
+    web_port, sync_port, video_port = freePort(), freePort(), freePort()
+
+    # scripted motion timeline, relative to a start time both sides agree on
+    start = time() + args.warmup
+    transitions = []
+    for i in range(args.motion_events):
+        at = i * (args.motion_hold + args.motion_gap)
+        transitions.append((at, MOTION_PIN, 1))
+        transitions.append((at + args.motion_hold, MOTION_PIN, 0))
+    timeline_file = os.path.join(work_dir, 'timeline.json')
+    with open(timeline_file, 'w') as fp:
+        # door starts closed (high) so it does not trigger events
+        json.dump({'start': start, 'transitions': [(-args.warmup, DOOR_PIN, 1)] + transitions}, fp)
+
+    components = []
+    watcher = RecordingWatcher(os.path.join(run_dir, 'pivid.sock'))
+    viewers = []
+    journaled = []
+    try:
+        components.append(Component('webserver', 'server.py', {
+            'WEB_HOST': '127.0.0.1', 'WEB_PORT': web_port,
+            'NODESYNC_HOST': '0.0.0.0', 'NODESYNC_PORT': sync_port,
+            'VIDEO_PROTOCOL': args.protocol,
+            'SHOMESEC_RUN_DIR': run_dir, 'SHOMESEC_PID_FILE': os.path.join(run_dir, 'pyserve.pid'),
+            'EVENTS_DIR': os.path.join(work_dir, 'events'),
+        }, work_dir))
+        components.append(Component('pivideo', 'server.py', {
+            'VIDEO_PORT': video_port, 'CAMERA_BACKEND': 'synthetic',
+            'VIDEO_RESOLUTION': [width, height], 'VIDEO_FPS': args.fps,
+            'SYNTHETIC_FRAME_SIZE': args.frame_size,
+            'VIDEO_DIR': video_dir, 'RUN_DIR': run_dir,
+            'VIDEO_UDP_ENABLED': args.protocol == 'udp', 'VIDEO_UDP_PORT': video_port,
+        }, work_dir))
+        components.append(Component('pisensor', 'sensor.py', {
+            'GPIO_BACKEND': 'simulated', 'GPIO_SIM_TIMELINE': timeline_file,
+            'NODESYNC_HOST': '127.0.0.1', 'NODESYNC_PORT': sync_port, 'NODESYNC_DELAY': 1, 'NODESYNC_INTERVAL': 1,
+            'VIDEO_PORT': video_port, 'RUN_DIR': run_dir,
+            'EVENT_JOURNAL': os.path.join(work_dir, 'events.journal'),
+            'NOTIFY_OUTBOX': os.path.join(work_dir, 'outbox.json'),
+            'SMS_NUMBER_CACHE': os.path.join(work_dir, 'numbers.json'),
+            'IR_ZONE_CACHE': os.path.join(work_dir, 'zones.json'),
+        }, work_dir, env={'TZ': args.tz}))
+        watcher.start()
+
+        # wait for the sensor to register with the webserver
+        sensor_id = None
+        while sensor_id is None and time() < start:
+            for component in components:
+                if not component.alive():
+                    raise RuntimeError('{} exited early, see {}'.format(component.name, component.log_file))
+            try:
+                with urlopen('http://127.0.0.1:{}/info'.format(web_port), timeout=1) as resp:
+                    sensors = json.loads(resp.read())['active_sensors']
+                    sensor_id = next(iter(sensors), None)
+            except (OSError, ValueError):
+                pass
+            sleep(0.2)
+        if sensor_id is None:
+            raise RuntimeError('sensor did not register before the scenario started')
+
+        feed_url = 'http://127.0.0.1:{}/video_feed?sensor_id={}'.format(web_port, sensor_id)
+        viewers = [Viewer(feed_url) for _ in range(args.viewers)]
+        for viewer in viewers:
+            viewer.start()
+
+        duration = args.motion_events * (args.motion_hold + args.motion_gap)
+        sleep(max(start + duration - time(), 0) + 1)
+
+        # journaled events reach the webserver with the next heartbeat
+        sleep(1.5)
+        try:
+            with urlopen('http://127.0.0.1:{}/events?sensor_id={}&sensor=motion&t0={}'.format(
+                    web_port, sensor_id, start - args.warmup), timeout=5) as resp:
+                journaled = json.loads(resp.read())['events']
+        except (OSError, ValueError) as ex:
+            print('could not query events: {}'.format(str(ex)))
+    finally:
+        watcher.running = False
+        for viewer in viewers:
+            viewer.running = False
+        for component in reversed(components):
+            component.stop()
+
+    # report
+    rising = [start + at for at, pin, value in transitions if value == 1]
+    falling = [start + at for at, pin, value in transitions if value == 0]
+    latencies = [x for viewer in viewers for x in viewer.latencies]
+    start_latencies = edgeLatencies(rising, watcher.starts)
+    stop_latencies = edgeLatencies(falling, watcher.stops)
+
+    def ms(values, pct):
+        return '{:.1f}'.format(percentile(values, pct) * 1000)
+
+    print('frames received:      {} across {} viewers'.format(sum(v.frames for v in viewers), len(viewers)))
+    print('frame latency (ms):   p50 {}  p95 {}  max {}'.format(ms(latencies, 50), ms(latencies, 95), ms(latencies, 100)))
+    print('motion -> recording:  {}/{} detected, p50 {} ms  max {} ms'.format(
+        len(start_latencies), len(rising), ms(start_latencies, 50), ms(start_latencies, 100)))
+    print('idle -> stopped:      {}/{} detected, p50 {} ms  max {} ms'.format(
+        len(stop_latencies), len(falling), ms(stop_latencies, 50), ms(stop_latencies, 100)))
+    print('events journaled:     {}/{} motion detections'.format(
+        len([x for x in journaled if x['event'] == 'detected']), len(rising)))
+    print('logs: {}'.format(work_dir) if args.keep else '')
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(1)
+    except RuntimeError as ex:
+        print(str(ex))
+        exit(1)
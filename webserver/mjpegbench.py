@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import sys, io
+from time import perf_counter
+from util.mjpeg import MjpegParser, SOI, EOI
+from util.printing import IO
+
+
+#### App Setings
+buffsize = 16384
+rounds = 5
+
+
+def legacyParse(stream):
+    """previous generateVideoFrames parsing loop, kept as the baseline"""
+
+    buff = b''
+    while True:
+        data = stream.read(buffsize)
+        if len(data) == 0:
+            break
+        buff += data
+
+        start = buff.find(SOI)
+        end = buff.find(EOI)
+
+        # we have the full jpeg
+        if start != -1 and end != -1:
+            yield buff[start:end+2]
+            buff = buff[end+2:]
+
+def parserParse(stream):
+    """incremental parser used by the webserver"""
+
+    return MjpegParser(buffsize).readFrames(stream)
+
+def bench(name, parse, data):
+    best = None
+    frames = 0
+    for _ in range(rounds):
+        stream = io.BytesIO(data)
+        start = perf_counter()
+        frames = sum(1 for _ in parse(stream))
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('{:<8} frames: {:>7}  best: {:>9.3f} ms  throughput: {:>9.1f} MB/s'.format(
+        name, frames, best * 1000, len(data) / best / 1e6))
+
+def main(filename):
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+
+    print('file: {} ({} bytes, chunk size {})'.format(filename, len(data), buffsize))
+    bench('legacy', legacyParse, data)
+    bench('parser', parserParse, data)
+
+def printUsage():
+    IO.printbold('Usage: ')
+    print('  {cmd} [-h|--help] <recording.mjpeg> [<chunk size>]\n'.format(cmd=sys.argv[0]))
+    IO.printbold('Notes: ')
+    print('  The legacy parser emits at most one frame per read, so its frame count may be lower')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 0 or len(args) > 2 or args[0] == '-h' or args[0] == '--help':
+        printUsage()
+        exit(1)
+    if len(args) > 1:
+        buffsize = int(args[1])
+    main(args[0])
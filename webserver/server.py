@@ -2,23 +2,43 @@
 
 import os, socket, signal, logging, datetime, uuid, json, weakref, struct, bjoern
 from copy import copy
-from flask import render_template, request, redirect, session, url_for, Response, send_from_directory
+from flask import render_template, request, redirect, session, url_for, Response, send_from_directory, send_file
+from werkzeug.wsgi import wrap_file
 from util.printing import IO, debugException, debugEndpoint
 from util.pyasync import thread, proc
-from util.flaskcustom import CustomFlask, CustomSessionInterface, cleanupSessionSocks, cleanupRequestSocks
+from util.flaskcustom import CustomFlask, CustomSessionInterface, cleanupSessionStreams, cleanupRequestStreams
+from util.relay import RelayManager
+from util.aioserve import AsyncStreamServer
+from util.catalog import RecordingCatalog
+from util.registry import SensorRegistry
+from util.heartbeat import HeartbeatServer
+from util.journal import EventStore, SENSORS, eventName
 import settings
 
 
-#### constant definitions
-# JPEG exif file headers
-SOI = b'\xff\xd8'
-EOI = b'\xff\xd9'
-
 #### module variables
-active_socks = {} # { session_id: { request_id: [ socks ] } }
-active_pisensors = {} # { sensor_id: (host, port) }
+active_streams = {} # { session_id: { request_id: [ streams ] } }
+sensors = SensorRegistry(settings.NODESYNC_TTL)
+relays = RelayManager(settings.VIDEO_BUFFSIZE, settings.VIDEO_RELAY_GRACE, settings.VIDEO_CONNECT_TIMEOUT,
+                      settings.VIDEO_PROTOCOL, settings.VIDEO_UDP_TTL, settings.VIDEO_UDP_MULTICAST,
+                      settings.VIDEO_UDP_MULTICAST_PORT, health=sensors.setHealth)
+sensors.addListener(relays.onSensorEvent)
+# replicas of the sensor event journals, sensors send them along with their heartbeats
+events = EventStore(settings.EVENTS_DIR)
+# sensors sending datagram heartbeats expire after missing NODESYNC_MISSED of them
+heartbeats = HeartbeatServer(settings.NODESYNC_HOST, settings.NODESYNC_PORT,
+                             lambda sensor_id, host, port, interval, stats: sensors.heartbeat(
+                                 sensor_id, host, port, interval * settings.NODESYNC_MISSED, stats),
+                             settings.NODESYNC_DISCOVERY_GROUP, settings.NODESYNC_DISCOVERY_PORT,
+                             settings.NODESYNC_PROBE_INTERVAL, events.receive)
+catalog = RecordingCatalog(settings.VIDEO_ARCHIVE_DIR)
+# segments are recorded as mjpeg or h264 depending on the sensor's codec
+RECORDING_MIMETYPES = {
+    '.mjpeg': 'video/x-motion-jpeg',
+    '.h264': 'video/h264',
+}
 app = CustomFlask(__name__, static_folder="./static", static_url_path="/static",
-                  session_interface=CustomSessionInterface(cleanupSessionSocks, active_socks=active_socks))
+                  session_interface=CustomSessionInterface(cleanupSessionStreams, active_streams=active_streams))
 # db = loadSession()
 
 
@@ -47,7 +67,13 @@ def index():
 
         # if not session.get('logged_in'):
         #     checkDatabase()
-        return render_template('index.html', version=settings.SHOMESEC_VERSION, resolution=settings.VIDEO_RESOLUTION, sensors=active_pisensors.keys())
+        # streaming routes are served by the asyncio server when it is enabled
+        stream_base = ''
+        if settings.WEB_ASYNC_ENABLED:
+            stream_base = '{}://{}:{}'.format(settings.WEB_PROTO, request.host.rsplit(':', 1)[0], settings.WEB_ASYNC_PORT)
+
+        return render_template('index.html', version=settings.SHOMESEC_VERSION, resolution=settings.VIDEO_RESOLUTION,
+                               sensors=sensors.getSnapshot(), stream_base=stream_base)
 
     # except sql_exceptions.SQLAlchemyError as ex:
     #     debugException(ex, log_ex=False, print_ex=True, showstack=False)
@@ -66,34 +92,13 @@ def index():
         return showError(type=error)
 
 # this functions will continue to stream after the request context is gone
-def generateVideoFrames(sock, session_id, request_id):
-    stream = sock.makefile('rb', settings.VIDEO_BUFFSIZE)
-    buff = b''
-
-    # IO.printdbg('active_socks: {}'.format(str(active_socks)))
-    # IO.printwarn('sock: {}'.format(str(sock)))
-    # IO.printwarn('stream: {}'.format(str(stream)))
-
+def generateVideoFrames(stream, session_id, request_id):
     try:
-        while True:
-            data = stream.read(settings.VIDEO_BUFFSIZE)
-            # IO.printdbg('len(data): {}'.format(len(buff)))
-
-            if len(data) == 0:
-                stream.close()
-                break
-            buff += data
-
-            start = buff.find(SOI)
-            end = buff.find(EOI)
-
-            # we have the full jpeg
-            if start != -1 and end != -1:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + buff[start:end+2] + b'\r\n')
-                buff = buff[end+2:]
+        for frame in stream:
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
     finally:
-        cleanupRequestSocks(active_socks, session_id, request_id)
+        cleanupRequestStreams(active_streams, session_id, request_id)
 
 @app.route('/video_feed')
 def video_feed():
@@ -102,39 +107,201 @@ def video_feed():
 
     sensor_id = request.args.get('sensor_id', default='', type=str)
 
-    # create entry in active_socks for session/request
-    if session['id'] not in active_socks:
-        active_socks[session['id']] = {}
-    if not request.id in active_socks[session['id']]:
-        active_socks[session['id']][request.id] = []
-
-
-
-    # connect to raspi video server on each sensor
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # create entry in active_streams for session/request
+    if session['id'] not in active_streams:
+        active_streams[session['id']] = {}
+    if not request.id in active_streams[session['id']]:
+        active_streams[session['id']][request.id] = []
 
+    # all viewers of a sensor share one upstream connection
     try:
-        sock.connect(active_pisensors[sensor_id])
-    except (socket.error, TypeError) as ex:
-        IO.printerr('Could not connection to sensor [{}]: {}'.format(str(active_pisensors[sensor_id]), str(ex)))
-        if sensor_id in active_pisensors:
-            del active_pisensors[sensor_id]
+        stream = relays.get(sensor_id, sensors.getAddrs()[sensor_id]).subscribe()
+    except (OSError, KeyError) as ex:
+        # the relay marks the sensor unreachable, it stays registered until its heartbeats stop
+        IO.printerr('Could not connection to sensor [{}]: {}'.format(sensor_id, str(ex)))
+        relays.remove(sensor_id)
         return Response()
 
-    # store sock locally
-    active_socks[session['id']][request.id].append(sock)
+    # store stream locally
+    active_streams[session['id']][request.id].append(stream)
 
-    return Response(generateVideoFrames(sock, session['id'], request.id),
+    return Response(generateVideoFrames(stream, session['id'], request.id),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/snapshot')
+def snapshot():
+    sensor_id = request.args.get('sensor_id', default='', type=str)
+
+    # served from the relay's frame cache, only connects upstream when nothing is cached
+    try:
+        frame, frame_seq, frame_time = relays.get(sensor_id, sensors.getAddrs()[sensor_id]).getSnapshot()
+    except KeyError:
+        return Response(status=404)
+    except OSError as ex:
+        IO.printerr('Could not connection to sensor [{}]: {}'.format(sensor_id, str(ex)))
+        relays.remove(sensor_id)
+        return Response(status=503)
+
+    if frame is None:
+        return Response(status=503)
+
+    response = Response(frame, mimetype='image/jpeg')
+    response.set_etag('{:x}-{:x}'.format(frame_seq, int(frame_time * 1000000)))
+    response.last_modified = datetime.datetime.fromtimestamp(frame_time, datetime.timezone.utc)
+    response.cache_control.no_cache = True
+    response.headers['X-Capture-Timestamp'] = '{:.6f}'.format(frame_time)
+    # answers If-None-Match with a 304 when the frame has not changed
+    return response.make_conditional(request)
+
+@app.route('/recordings')
+def recordings():
+    """
+    Browse the video archive\n
+    no args lists sensors, sensor_id lists its days, sensor_id and date lists the segments of that day
+    """
+
+    sensor_id = request.args.get('sensor_id', default=None, type=str)
+    day = request.args.get('date', default=None, type=str)
+
+    if sensor_id is None:
+        return json.dumps({'sensors': catalog.listSensors()}), 200
+    if day is None:
+        return json.dumps({'sensor_id': sensor_id, 'days': catalog.listDays(sensor_id)}), 200
+
+    segments = [{
+        'name': segment.name,
+        'start': segment.start,
+        'end': segment.end,
+        'frames': segment.frames,
+        'size': segment.size,
+        'url': url_for('recording', sensor_id=sensor_id, date=day, name=segment.name),
+    } for segment in catalog.listSegments(sensor_id, day)]
+    return json.dumps({'sensor_id': sensor_id, 'date': day, 'segments': segments}), 200
+
+def recordingMimetype(path):
+    return RECORDING_MIMETYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+
+@app.route('/recording')
+def recording():
+    """
+    Download a recorded segment\n
+    sensor_id, date and name select a segment, served with Range support\n
+    sensor_id and t (epoch seconds) stream the segment holding that time from the keyframe shown at t,
+    Content-Location names the whole segment for clients that want to seek in it
+    """
+
+    sensor_id = request.args.get('sensor_id', default='', type=str)
+    timestamp = request.args.get('t', default=None, type=float)
+
+    # only cataloged segments are served, the request never builds a path itself
+    if timestamp is None:
+        segment = catalog.getSegment(sensor_id, request.args.get('date', default='', type=str),
+                                     request.args.get('name', default='', type=str))
+        if segment is None:
+            return Response(status=404)
+        # conditional handles Range / If-Range / ETag, full downloads go to the server's sendfile wrapper,
+        # ranges are read and copied in chunks by werkzeug
+        return send_file(segment.path, mimetype=recordingMimetype(segment.path), conditional=True,
+                         download_name=segment.name, max_age=0)
+
+    found = catalog.findFrame(sensor_id, timestamp)
+    if found is None:
+        return Response(status=404)
+    segment, offset, captured = found
+    try:
+        fp = open(segment.path, 'rb')
+    except OSError:
+        return Response(status=404)
+    size = os.fstat(fp.fileno()).st_size
+    # the body starts at the keyframe, the sendfile wrapper sends from the current file position
+    fp.seek(offset)
+    response = Response(wrap_file(request.environ, fp), mimetype=recordingMimetype(segment.path),
+                        direct_passthrough=True)
+    response.content_length = size - offset
+    response.cache_control.no_cache = True
+    response.headers['Content-Location'] = url_for('recording', sensor_id=sensor_id, date=segment.name[:10],
+                                                   name=segment.name)
+    response.headers['X-Segment'] = segment.name
+    response.headers['X-Frame-Offset'] = str(offset)
+    response.headers['X-Capture-Timestamp'] = '{:.6f}'.format(captured)
+    return response
+
+@app.route('/events')
+def showEvents():
+    """
+    Motion, door, window and alarm events from the sensor journals\n
+    t0 and t1 (epoch seconds) select the time range, the last day by default,
+    sensor_id and sensor (motion, door, window, alarm) narrow it down\n
+    Returns the newest events up to limit and the event counts of the whole range,
+    events that set a sensor off link to the recording running at that time
+    """
+
+    t1 = request.args.get('t1', default=None, type=float)
+    t1 = t1 if t1 is not None else datetime.datetime.now().timestamp()
+    t0 = request.args.get('t0', default=t1 - 86400, type=float)
+    sensor_id = request.args.get('sensor_id', default=None, type=str)
+    sensor_name = request.args.get('sensor', default=None, type=str)
+    limit = min(request.args.get('limit', default=settings.EVENTS_QUERY_LIMIT, type=int), settings.EVENTS_QUERY_LIMIT)
+
+    sensor = None
+    if sensor_name is not None:
+        sensor = next((code for code, name in SENSORS.items() if name == sensor_name), None)
+        if sensor is None:
+            return json.dumps({'error': 'unknown sensor {}'.format(sensor_name)}), 400
+
+    found, counts = events.query(t0, t1, sensor_id, sensor, max(limit, 0))
+    results = []
+    for event_sensor_id, timestamp, event_sensor, transition in found:
+        event = {
+            'sensor_id': event_sensor_id,
+            'time': timestamp,
+            'sensor': SENSORS.get(event_sensor, str(event_sensor)),
+            'event': eventName(event_sensor, transition),
+            'recording': None,
+            'segment': None,
+        }
+        if transition == 1:
+            segment = catalog.findSegment(event_sensor_id, timestamp, settings.EVENTS_RECORDING_SLACK)
+            if segment is not None:
+                event['recording'] = url_for('recording', sensor_id=event_sensor_id, date=segment.name[:10],
+                                             name=segment.name)
+                event['segment'] = segment.name
+        results.append(event)
+    return json.dumps({'t0': t0, 't1': t1, 'counts': counts, 'events': results}), 200
+
 @app.route('/info')
 def showInfo():
     info = {
-        'active_sensors': active_pisensors
+        'active_sensors': sensors.getSnapshot(),
+        'relays': relays.getStats(),
+        'heartbeats': heartbeats.getStats()
     }
     return json.dumps(info), 200
 
+# this functions will continue to stream after the request context is gone
+def generateSensorEvents(version):
+    while True:
+        changed, snapshot = sensors.wait(version, settings.SENSOR_EVENTS_KEEPALIVE)
+        if changed == version:
+            # comment lines keep proxies from closing an idle stream
+            yield b': keepalive\n\n'
+            continue
+        version = changed
+        yield 'data: {}\n\n'.format(json.dumps(snapshot)).encode('utf-8')
+
+@app.route('/sensors')
+def showSensors():
+    """
+    Registered sensors and their health\n
+    With Accept: text/event-stream the registry snapshot is pushed as a server sent event on every change
+    """
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        response = Response(generateSensorEvents(-1), mimetype='text/event-stream')
+        response.cache_control.no_cache = True
+        return response
+    return json.dumps(sensors.getSnapshot()), 200
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
@@ -210,10 +377,7 @@ class SocketServer(object):
             host = sensor_info[1].decode('utf-8').rstrip('\x00')
             port = sensor_info[2]
 
-            if not nodeid in active_pisensors:
-                active_pisensors[nodeid] = (host, port)
-                print('active sensors: ', end=''); print(active_pisensors)
-
+            sensors.heartbeat(nodeid, host, port)
 
         except (BrokenPipeError, OSError, struct.error) as ex:
             print("Problem handling request from [{}]: {}".format(addr, str(ex)))
@@ -226,6 +390,16 @@ class SocketServer(object):
             print('Connection from {} closed'.format(addr))
             conn.close()
 
+@thread
+def runAsyncStreamServer():
+    """Serve the streaming routes from an event loop in the background"""
+
+    AsyncStreamServer(settings.WEB_ASYNC_HOST, settings.WEB_ASYNC_PORT, sensors,
+                      settings.VIDEO_BUFFSIZE, settings.VIDEO_RELAY_GRACE, settings.VIDEO_CONNECT_TIMEOUT,
+                      settings.WEB_ASYNC_KEEPALIVE,
+                      # the event loop relays read over tcp, datagram mode uses the framed protocol there
+                      'framed' if settings.VIDEO_PROTOCOL == 'udp' else settings.VIDEO_PROTOCOL, heartbeats).run()
+
 def initApp(flask_app):
     # Setup the Flask session manager with a random secret key
     flask_app.secret_key = os.urandom(32)
@@ -257,14 +431,14 @@ def initApp(flask_app):
     bjoern.run(flask_app, settings.WEB_HOST, settings.WEB_PORT, reuse_port=True)
 
 def teardown():
-    for session_id, session_data in active_socks.items():
-        for request_id, request_socks in session_data.items():
-            for sock in request_socks:
-                try:
-                    sock.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                sock.close()
+    for session_id, session_data in active_streams.items():
+        for request_id, request_streams in session_data.items():
+            for stream in request_streams:
+                stream.close()
+    heartbeats.close()
+    sensors.close()
+    events.close()
+    relays.closeAll()
     try:
         os.remove(settings.SHOMESEC_PID_FILE)
     except:
@@ -283,7 +457,12 @@ def teardown():
 # main loop
 if __name__ == '__main__':
     try:
+        sensors.start()
+        events.start()
+        heartbeats.start()
         SocketServer(settings.NODESYNC_HOST, settings.NODESYNC_PORT).start()
+        if settings.WEB_ASYNC_ENABLED:
+            runAsyncStreamServer()
         initApp(app)
     except KeyboardInterrupt:
         exit(0)
@@ -6,6 +6,12 @@ WEB_USER = 'admin'
 WEB_PASS = 'admin'
 WEB_TIMEOUT = 10
 WEB_SOCK = '/run/shomesec/pyserve.sock'
+# serve /video_feed, /snapshot and /info from an asyncio event loop instead of a thread per stream
+# the html pages are still served by flask on WEB_PORT
+WEB_ASYNC_ENABLED = False
+WEB_ASYNC_HOST = '0.0.0.0'
+WEB_ASYNC_PORT = 10002
+WEB_ASYNC_KEEPALIVE = 15
 
 # Logging Settings
 # syslog level and facility values based on:
@@ -40,6 +46,23 @@ SQLALCHEMY_SQL_DEBUG = False
 NODESYNC_HOST = '0.0.0.0'
 NODESYNC_PORT = 10001
 NODESYNC_BUFFSIZE = 4096
+# seconds without a tcp node sync before a sensor is dropped, three missed syncs at the sensor NODESYNC_DELAY of 60
+NODESYNC_TTL = 180
+# sensors sending datagram heartbeats to NODESYNC_PORT are dropped after missing this many
+NODESYNC_MISSED = 3
+# sensors without a configured webserver announce to this multicast (or broadcast) address
+# the webserver probes it every NODESYNC_PROBE_INTERVAL seconds and whenever its interfaces change, '' disables discovery
+NODESYNC_DISCOVERY_GROUP = '239.255.10.1'
+NODESYNC_DISCOVERY_PORT = 10005
+NODESYNC_PROBE_INTERVAL = 30
+# seconds between keepalives on the /sensors event stream
+SENSOR_EVENTS_KEEPALIVE = 15
+# replicas of the sensor event journals
+EVENTS_DIR = '/var/lib/shomesec/events'
+# most events returned by one /events query
+EVENTS_QUERY_LIMIT = 500
+# seconds after an event a recording may start and still be linked to it
+EVENTS_RECORDING_SLACK = 10
 
 # Shomesec App Settings
 SHOMESEC_VERSION = 0.1
@@ -49,3 +72,15 @@ SHOMESEC_PID_FILE = '/run/shomesec/pyserve.pid'
 VIDEO_RESOLUTION = (1640,1232)  # resolution in pixels
 VIDEO_FPS = 40  # frames per second
 VIDEO_BUFFSIZE = 16384
+# seconds to keep a sensor connection open after its last viewer leaves
+VIDEO_RELAY_GRACE = 10
+VIDEO_CONNECT_TIMEOUT = 5
+# protocol used to read sensor streams: framed | raw | udp
+# framed falls back to raw for sensors that do not answer with frame headers
+# udp needs VIDEO_UDP_ENABLED on the sensors and drops incomplete frames instead of waiting on retransmits
+VIDEO_PROTOCOL = 'framed'
+VIDEO_UDP_TTL = 10 # must match the sensors, subscriptions are renewed three times per ttl
+VIDEO_UDP_MULTICAST = '' # receive the group the sensors send to instead of a unicast stream, empty to disable
+VIDEO_UDP_MULTICAST_PORT = 10004
+# recordings synced or mounted from each sensor, one sub directory per sensor
+VIDEO_ARCHIVE_DIR = '/var/backups/videos'
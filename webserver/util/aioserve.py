@@ -0,0 +1,400 @@
+'''
+@Summary: Contains an asyncio server for the video streaming routes
+@Author: devopsec
+'''
+
+import asyncio, json
+from time import time, monotonic
+from urllib.parse import urlsplit, parse_qs
+from email.utils import formatdate
+from util.mjpeg import MjpegParser
+from util.framing import FRAME_HEADER, FrameStats, RawStreamError, parseHeader, packHello
+from util.printing import IO
+
+
+# http status lines used by the streaming routes
+HTTP_STATUS = {
+    200: b'200 OK',
+    304: b'304 Not Modified',
+    400: b'400 Bad Request',
+    404: b'404 Not Found',
+    405: b'405 Method Not Allowed',
+    503: b'503 Service Unavailable',
+}
+
+
+class AsyncSensorRelay():
+    """
+    Event loop version of util.relay.SensorRelay\n
+    Holds one non-blocking upstream connection per sensor and wakes every viewer coroutine on a new frame\n
+    The optional health callback(sensor_id, reachable, streaming, fps) is called like the threaded relay's
+    """
+
+    def __init__(self, sensor_id, addr, buffsize=16384, grace_period=10, timeout=5, protocol='framed', health=None):
+        self.sensor_id = sensor_id
+        self.addr = addr
+        self.buffsize = buffsize
+        self.grace_period = grace_period
+        self.timeout = timeout
+        self.protocol = protocol
+        self.stats = FrameStats()
+        self.condition = asyncio.Condition()
+        # viewers arriving together wait on the first connect instead of opening their own
+        self.connecting = asyncio.Lock()
+        self.task = None
+        self.idle_handle = None
+        self.subscribers = 0
+        self.frame = None
+        self.frame_seq = 0
+        self.frame_time = 0.0
+        self.health = health
+        self.health_seq = 0
+        self.health_time = 0.0
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def reportHealth(self, reachable, streaming):
+        if self.health is None:
+            return
+        now = monotonic()
+        fps = 0.0
+        if streaming and self.health_time > 0:
+            fps = (self.frame_seq - self.health_seq) / max(now - self.health_time, 0.001)
+        self.health_seq = self.frame_seq
+        self.health_time = now if streaming else 0.0
+        self.health(self.sensor_id, reachable, streaming, fps)
+
+    def checkHealth(self):
+        """ Called from the reader task, reports the frame rate once a second """
+
+        if self.health is not None and monotonic() - self.health_time >= 1:
+            self.reportHealth(True, True)
+
+    async def subscribe(self):
+        """
+        Register a viewer, connecting upstream if needed
+
+        :raises OSError:    when the sensor can not be reached
+        """
+
+        self.subscribers += 1
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.running:
+            return
+
+        async with self.connecting:
+            if self.running:
+                return
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.addr), self.timeout)
+            except (OSError, asyncio.TimeoutError) as ex:
+                self.subscribers -= 1
+                self.reportHealth(False, False)
+                raise OSError(str(ex))
+
+            IO.printinfo('[aiorelay] connected to sensor [{}] at {}'.format(self.sensor_id, str(self.addr)))
+            if self.protocol == 'framed':
+                writer.write(packHello())
+            self.frame = None
+            self.reportHealth(True, True)
+            self.task = asyncio.ensure_future(self.run(reader, writer))
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0:
+            self.idle_handle = asyncio.get_running_loop().call_later(self.grace_period, self.close)
+
+    def close(self):
+        self.idle_handle = None
+        if self.running:
+            self.task.cancel()
+
+    def getStats(self):
+        stats = {'addr': self.addr, 'running': self.running, 'subscribers': self.subscribers, 'protocol': self.protocol}
+        if self.protocol == 'framed':
+            stats.update(self.stats.getStats())
+        return stats
+
+    async def publish(self, frame, count=1, timestamp=None):
+        async with self.condition:
+            # viewers only need the newest frame
+            self.frame = frame
+            self.frame_seq += count
+            self.frame_time = timestamp if timestamp is not None else time()
+            self.condition.notify_all()
+
+    async def run(self, reader, writer):
+        parser = MjpegParser(self.buffsize)
+        framed = self.protocol == 'framed'
+        # a relay closed while idle or a sensor ending the stream still counts as reachable
+        reachable = True
+
+        try:
+            while framed:
+                try:
+                    flags, length, seq, timestamp = parseHeader(await reader.readexactly(FRAME_HEADER.size))
+                except RawStreamError as ex:
+                    IO.printwarn('[aiorelay] sensor [{}] sends raw jpegs, falling back to parsing'.format(self.sensor_id))
+                    parser.feed(ex.data)
+                    break
+                frame = await reader.readexactly(length)
+                self.stats.update(seq, timestamp)
+                await self.publish(frame, timestamp=timestamp)
+                self.checkHealth()
+
+            while True:
+                data = await reader.read(self.buffsize)
+                if len(data) == 0:
+                    break
+                frames = parser.feed(data)
+                if len(frames) > 0:
+                    await self.publish(frames[-1], len(frames))
+                    self.checkHealth()
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ValueError) as ex:
+            IO.printerr('[aiorelay] lost connection to sensor [{}]: {}'.format(self.sensor_id, str(ex)))
+            reachable = False
+        finally:
+            self.reportHealth(reachable, False)
+            writer.close()
+            IO.printinfo('[aiorelay] disconnected from sensor [{}]'.format(self.sensor_id))
+            # wake viewers so they notice the relay is down
+            async with self.condition:
+                self.condition.notify_all()
+
+    async def frames(self):
+        """
+        Generate each new frame for one viewer, skipping to the newest when the viewer is slow
+        """
+
+        await self.subscribe()
+        try:
+            last_seq = self.frame_seq - 1 if self.frame is not None else self.frame_seq
+            while True:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: self.frame_seq != last_seq or not self.running)
+                if self.frame_seq == last_seq:
+                    break
+                last_seq = self.frame_seq
+                yield self.frame
+        finally:
+            self.unsubscribe()
+
+    async def getSnapshot(self):
+        if self.running and self.frame is not None:
+            return self.frame, self.frame_seq, self.frame_time
+
+        await self.subscribe()
+        try:
+            async with self.condition:
+                await asyncio.wait_for(self.condition.wait_for(lambda: self.frame is not None or not self.running),
+                                       self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.unsubscribe()
+
+        if self.frame is None:
+            return None, 0, 0.0
+        return self.frame, self.frame_seq, self.frame_time
+
+
+class AsyncStreamServer():
+    """
+    Serves /video_feed, /snapshot and /info from a single event loop\n
+    Each viewer costs a coroutine instead of a worker thread\n
+    Relays report their health to the sensor registry and are closed when it drops their sensor
+    """
+
+    def __init__(self, host, port, registry, buffsize=16384, grace_period=10, timeout=5, keepalive=15, protocol='framed',
+                 heartbeats=None):
+        """
+        :param registry:        sensors to relay, told about the health of each relay
+        :type registry:         util.registry.SensorRegistry
+        :param heartbeats:      heartbeat server whose stats /info reports
+        :type heartbeats:       util.heartbeat.HeartbeatServer
+        """
+
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.heartbeats = heartbeats
+        self.buffsize = buffsize
+        self.grace_period = grace_period
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.protocol = protocol
+        self.relays = {}
+        self.loop = None
+        self.routes = {
+            '/video_feed': self.videoFeed,
+            '/snapshot': self.snapshot,
+            '/info': self.info,
+        }
+
+    def getRelay(self, sensor_id):
+        addr = self.registry.getAddrs().get(sensor_id)
+        if addr is None:
+            return None
+        addr = tuple(addr)
+
+        relay = self.relays.get(sensor_id)
+        if relay is None or relay.addr != addr:
+            if relay is not None:
+                relay.close()
+            relay = AsyncSensorRelay(sensor_id, addr, self.buffsize, self.grace_period, self.timeout, self.protocol,
+                                     self.registry.setHealth)
+            self.relays[sensor_id] = relay
+        return relay
+
+    def removeRelay(self, sensor_id):
+        relay = self.relays.pop(sensor_id, None)
+        if relay is not None:
+            relay.close()
+
+    def onSensorEvent(self, event, sensor_id, info):
+        """ Registry listener, called from the registry's threads """
+
+        if event != 'removed' or self.loop is None:
+            return
+        # relays are only touched from the event loop
+        self.loop.call_soon_threadsafe(self.removeRelay, sensor_id)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.registry.addListener(self.onSensorEvent)
+        server = await asyncio.start_server(self.connHandler, self.host, self.port)
+        print("Listening on {}".format(', '.join(str(sock.getsockname()) for sock in server.sockets)))
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def connHandler(self, reader, writer):
+        try:
+            # keep-alive loop, streaming responses end the connection when the viewer leaves
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self.respond(writer, 400)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                url = urlsplit(target)
+                handler = self.routes.get(url.path)
+                if handler is None:
+                    await self.respond(writer, 404)
+                elif method != 'GET':
+                    await self.respond(writer, 405)
+                else:
+                    args = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    if not await handler(writer, args, headers):
+                        break
+
+                if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body=b'', content_type=None, headers=None):
+        lines = [b'HTTP/1.1 ' + HTTP_STATUS[status]]
+        if content_type is not None:
+            lines.append(b'Content-Type: ' + content_type.encode('latin-1'))
+        lines.append(b'Content-Length: ' + str(len(body)).encode('latin-1'))
+        for key, value in (headers or {}).items():
+            lines.append('{}: {}'.format(key, value).encode('latin-1'))
+        writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+        if len(body) > 0:
+            writer.write(body)
+        await writer.drain()
+
+    async def videoFeed(self, writer, args, headers):
+        relay = self.getRelay(args.get('sensor_id', ''))
+        if relay is None:
+            await self.respond(writer, 404)
+            return True
+
+        frames = relay.frames()
+        try:
+            frame = await frames.__anext__()
+        except (OSError, StopAsyncIteration) as ex:
+            IO.printerr('Could not connection to sensor [{}]: {}'.format(relay.sensor_id, str(ex)))
+            await self.respond(writer, 503)
+            return True
+
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: close\r\n\r\n')
+        try:
+            while True:
+                writer.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                             str(len(frame)).encode('latin-1') + b'\r\n\r\n')
+                writer.write(frame)
+                writer.write(b'\r\n')
+                # a slow viewer waits here and then skips to the newest frame
+                await writer.drain()
+                frame = await frames.__anext__()
+        except StopAsyncIteration:
+            pass
+        finally:
+            await frames.aclose()
+        return False
+
+    async def snapshot(self, writer, args, headers):
+        relay = self.getRelay(args.get('sensor_id', ''))
+        if relay is None:
+            await self.respond(writer, 404)
+            return True
+
+        try:
+            frame, frame_seq, frame_time = await relay.getSnapshot()
+        except OSError as ex:
+            IO.printerr('Could not connection to sensor [{}]: {}'.format(relay.sensor_id, str(ex)))
+            frame = None
+        if frame is None:
+            await self.respond(writer, 503)
+            return True
+
+        etag = '"{:x}-{:x}"'.format(frame_seq, int(frame_time * 1000000))
+        response_headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(frame_time, usegmt=True),
+            'Cache-Control': 'no-cache',
+            'X-Capture-Timestamp': '{:.6f}'.format(frame_time),
+        }
+        if_none_match = [tag.strip() for tag in headers.get('if-none-match', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            await self.respond(writer, 304, headers=response_headers)
+        else:
+            await self.respond(writer, 200, frame, 'image/jpeg', response_headers)
+        return True
+
+    async def info(self, writer, args, headers):
+        # same payload as the flask /info, with the relays of this event loop
+        body = json.dumps({
+            'active_sensors': self.registry.getSnapshot(),
+            'relays': {sensor_id: relay.getStats() for sensor_id, relay in self.relays.items()},
+            'heartbeats': self.heartbeats.getStats() if self.heartbeats is not None else None
+        }).encode('utf-8')
+        await self.respond(writer, 200, body, 'application/json')
+        return True
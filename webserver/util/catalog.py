@@ -0,0 +1,244 @@
+'''
+@Summary: Contains the catalog of recordings in the video archive
+@Author: devopsec
+
+The archive holds one directory per sensor, each laid out like the pivideo video directory:
+    <archive_dir>/<sensor>/YYYY-MM-DD/YYYY-MM-DD_HH-MM-SS.mjpeg|.h264 (+ .idx)
+'''
+
+import os
+from time import time
+from bisect import bisect_right
+from datetime import datetime
+from collections import namedtuple
+from threading import Lock
+from util.segments import SegmentIndex, indexPath, DAY_FORMAT, NAME_FORMAT
+
+SegmentInfo = namedtuple('SegmentInfo', ['name', 'path', 'size', 'start', 'end', 'frames'])
+
+
+class CatalogDir():
+    """ Cached listing of one archive directory and what was derived from it """
+
+    def __init__(self):
+        self.mtime = None
+        self.scanned = 0
+        self.entries = {}
+
+
+class RecordingCatalog():
+    """
+    Incrementally maintained catalog of the recordings in the archive\n
+    A directory is only listed again when its mtime changes, and only segments not seen before are read,
+    so a query costs a few stat calls however many recordings the archive holds\n
+    The newest segment of a day may still be growing and is re-read on every query of that day
+    """
+
+    # directory mtimes this close to the last scan may hide a change made in the same clock tick
+    SETTLE_TIME = 2
+
+    def __init__(self, archive_dir, extensions=('.mjpeg', '.h264')):
+        self.archive_dir = archive_dir
+        self.extensions = extensions
+        self.lock = Lock()
+        self.root = CatalogDir()
+
+    def refreshDir(self, cached, path, load):
+        """
+        Bring a cached directory up to date
+
+        :param cached:  cached directory
+        :type cached:   CatalogDir
+        :param path:    directory path
+        :type path:     str
+        :param load:    callable(name, previous entry or None) returning the entry for a name, or None to skip it
+        :type load:     callable
+        :return:        False if the directory does not exist
+        :rtype:         bool
+        """
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            cached.mtime = None
+            cached.entries = {}
+            return False
+
+        if mtime == cached.mtime and cached.scanned - mtime / 1e9 > RecordingCatalog.SETTLE_TIME:
+            return True
+
+        scanned = time()
+        entries = {}
+        for name in os.listdir(path):
+            entry = load(name, cached.entries.get(name))
+            if entry is not None:
+                entries[name] = entry
+        cached.entries = entries
+        cached.mtime = mtime
+        cached.scanned = scanned
+        return True
+
+    def loadSegment(self, path, name):
+        size = os.stat(path).st_size
+        try:
+            with SegmentIndex(indexPath(path)) as index:
+                if len(index) > 0:
+                    return SegmentInfo(name, path, size, index.timestamp(0), index.timestamp(-1), len(index))
+        except (OSError, ValueError):
+            pass
+        # no usable index, fall back to the start time in the name
+        try:
+            start = datetime.strptime(name[:19], NAME_FORMAT).timestamp()
+        except ValueError:
+            return None
+        return SegmentInfo(name, path, size, start, start, 0)
+
+    def getSensors(self):
+        def load(name, previous):
+            if previous is not None:
+                return previous
+            if os.path.isdir(os.path.join(self.archive_dir, name)):
+                return CatalogDir()
+            return None
+
+        self.refreshDir(self.root, self.archive_dir, load)
+        return self.root.entries
+
+    def getDays(self, sensor):
+        sensor_dir = self.getSensors().get(sensor)
+        if sensor_dir is None:
+            return {}
+
+        def load(name, previous):
+            if previous is not None:
+                return previous
+            try:
+                datetime.strptime(name, DAY_FORMAT)
+            except ValueError:
+                return None
+            return CatalogDir()
+
+        self.refreshDir(sensor_dir, os.path.join(self.archive_dir, sensor), load)
+        return sensor_dir.entries
+
+    def getSegments(self, sensor, day):
+        day_dir = self.getDays(sensor).get(day)
+        if day_dir is None:
+            return []
+        path = os.path.join(self.archive_dir, sensor, day)
+
+        def load(name, previous):
+            if not name.endswith(self.extensions):
+                return None
+            if previous is not None:
+                return previous
+            try:
+                return self.loadSegment(os.path.join(path, name), name)
+            except OSError:
+                return None
+
+        if not self.refreshDir(day_dir, path, load):
+            return []
+        segments = sorted(day_dir.entries.values(), key=lambda segment: segment.name)
+
+        # the newest segment may still be recording
+        if len(segments) > 0:
+            try:
+                latest = self.loadSegment(segments[-1].path, segments[-1].name)
+            except OSError:
+                latest = None
+            if latest is not None:
+                day_dir.entries[latest.name] = latest
+                segments[-1] = latest
+        return segments
+
+    def listSensors(self):
+        """
+        :return:    sensors with recordings
+        :rtype:     list
+        """
+
+        with self.lock:
+            return sorted(self.getSensors().keys())
+
+    def listDays(self, sensor):
+        """
+        :return:    days with recordings for a sensor, YYYY-MM-DD
+        :rtype:     list
+        """
+
+        with self.lock:
+            return sorted(self.getDays(sensor).keys())
+
+    def listSegments(self, sensor, day):
+        """
+        :return:    segments recorded by a sensor on a day, sorted by start time
+        :rtype:     list of SegmentInfo
+        """
+
+        with self.lock:
+            return self.getSegments(sensor, day)
+
+    def getSegment(self, sensor, day, name):
+        """
+        :return:    a cataloged segment, None if it is not in the catalog
+        :rtype:     SegmentInfo|None
+        """
+
+        for segment in self.listSegments(sensor, day):
+            if segment.name == name:
+                return segment
+        return None
+
+    def findSegment(self, sensor, timestamp, slack=0):
+        """
+        Locate the recording running at a wall clock time, without reading any segment index
+
+        :param slack:   seconds after the time a recording may start and still be returned
+        :type slack:    float
+        :return:        segment recording at the time or starting within slack after it, None if there is none
+        :rtype:         SegmentInfo|None
+        """
+
+        days = self.listDays(sensor)
+        day = datetime.fromtimestamp(timestamp).strftime(DAY_FORMAT)
+        # the day holding the time, or the day before as a segment may run past midnight
+        pos = max(bisect_right(days, day) - 1, 0)
+
+        for day in days[max(pos - 1, 0):pos + 2]:
+            segments = self.listSegments(sensor, day)
+            starts = [segment.start for segment in segments]
+            for segment in segments[max(bisect_right(starts, timestamp) - 1, 0):]:
+                if segment.start > timestamp + slack:
+                    return None
+                if segment.end >= timestamp or segment.start >= timestamp:
+                    return segment
+        return None
+
+    def findFrame(self, sensor, timestamp):
+        """
+        Locate the frame a sensor recorded at a wall clock time
+
+        :return:    segment, byte offset and capture time of the frame, None if nothing was recorded at or after it
+        :rtype:     tuple|None
+        """
+
+        days = self.listDays(sensor)
+        day = datetime.fromtimestamp(timestamp).strftime(DAY_FORMAT)
+        # the day holding the time, or the day before as a segment may run past midnight
+        pos = max(bisect_right(days, day) - 1, 0)
+
+        for day in days[max(pos - 1, 0):]:
+            segments = self.listSegments(sensor, day)
+            starts = [segment.start for segment in segments]
+            for segment in segments[max(bisect_right(starts, timestamp) - 1, 0):]:
+                # the frame is in this segment, or the time falls in a gap and the next recording is shown
+                if segment.end < timestamp or segment.frames == 0:
+                    continue
+                try:
+                    with SegmentIndex(indexPath(segment.path)) as index:
+                        offset, captured = index.entry(index.find(timestamp))
+                        return segment, offset, captured
+                except (OSError, ValueError, IndexError):
+                    continue
+        return None
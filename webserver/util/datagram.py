@@ -0,0 +1,121 @@
+'''
+@Summary: Contains the receiving side of the datagram transport for live video
+@Author: devopsec
+
+Frames arrive split into fragments that each fit one datagram:
+    magic (2s) version (B) flags (B) frame seq (I) capture timestamp (d)
+    fragment (H) fragment count (H) frame length (I) fragment offset (I)
+followed by the fragment payload. Frames missing a fragment are dropped instead of waiting for a retransmit.
+Receivers subscribe by sending a control datagram to the video port and must repeat it before the subscription expires:
+    magic (4s) version (B) flags (B)
+'''
+
+import struct
+from util.framing import FrameStats
+
+PACKET_MAGIC = b'SU'
+SUBSCRIBE_MAGIC = b'SUSB'
+UNSUBSCRIBE_MAGIC = b'SUUN'
+PROTOCOL_VERSION = 1
+PACKET_HEADER = struct.Struct('<2sBBIdHHII')
+CONTROL = struct.Struct('<4sBB')
+# frames a packet may trail the last delivered one and still count as late, further back the sender restarted
+RESET_GAP = 64
+
+# subscribe flags
+SUBSCRIBE_MULTICAST = 0x01
+
+
+def packSubscribe(flags=0):
+    return CONTROL.pack(SUBSCRIBE_MAGIC, PROTOCOL_VERSION, flags)
+
+def packUnsubscribe(flags=0):
+    return CONTROL.pack(UNSUBSCRIBE_MAGIC, PROTOCOL_VERSION, flags)
+
+
+class FrameAssembler():
+    """
+    Reassembles frames from datagram fragments\n
+    A frame is delivered as soon as its last fragment arrives, older frames still missing fragments are dropped,
+    fragments of frames older than the last delivered one are ignored
+    """
+
+    def __init__(self, max_pending=4):
+        """
+        :param max_pending:     frames reassembled at the same time before the oldest is dropped
+        :type max_pending:      int
+        """
+
+        self.max_pending = max_pending
+        # { seq: [frame buffer, fragments received, fragment bitmap, timestamp, flags] }
+        self.pending = {}
+        self.last_seq = -1
+        self.dropped_frames = 0
+        self.late_packets = 0
+        self.bad_packets = 0
+        self.resets = 0
+        self.stats = FrameStats()
+
+    def drop(self, seq):
+        self.pending.pop(seq)
+        self.dropped_frames += 1
+
+    def feed(self, packet):
+        """
+        :param packet:  one received datagram
+        :type packet:   memoryview
+        :return:        frame, sequence number, capture timestamp and flags once a frame is complete, else None
+        :rtype:         tuple|None
+        """
+
+        if len(packet) < PACKET_HEADER.size:
+            self.bad_packets += 1
+            return None
+        magic, version, flags, seq, timestamp, index, count, length, offset = PACKET_HEADER.unpack_from(packet)
+        payload = packet[PACKET_HEADER.size:]
+        if magic != PACKET_MAGIC or version != PROTOCOL_VERSION or index >= count or \
+                offset + len(payload) > length:
+            self.bad_packets += 1
+            return None
+        if seq <= self.last_seq:
+            # a restarted sender numbers its frames from 0 again, a late packet is only a few frames behind
+            if self.last_seq - seq <= RESET_GAP:
+                self.late_packets += 1
+                return None
+            self.pending.clear()
+            self.last_seq = -1
+            self.resets += 1
+
+        entry = self.pending.get(seq)
+        if entry is None:
+            while len(self.pending) >= self.max_pending:
+                self.drop(min(self.pending))
+            entry = [bytearray(length), 0, bytearray(count), timestamp, flags]
+            self.pending[seq] = entry
+        buff, received, bitmap = entry[0], entry[1], entry[2]
+        if len(buff) != length or len(bitmap) != count or bitmap[index]:
+            return None
+
+        buff[offset:offset + len(payload)] = payload
+        bitmap[index] = 1
+        entry[1] = received + 1
+        if entry[1] < count:
+            return None
+
+        # complete, anything older will never be shown
+        del self.pending[seq]
+        for older in [pending for pending in self.pending if pending < seq]:
+            self.drop(older)
+        self.last_seq = seq
+        self.stats.update(seq, timestamp)
+        return buff, seq, timestamp, flags
+
+    def getStats(self):
+        stats = self.stats.getStats()
+        stats.update({
+            'dropped_frames': self.dropped_frames,
+            'late_packets': self.late_packets,
+            'bad_packets': self.bad_packets,
+            'resets': self.resets,
+        })
+        return stats
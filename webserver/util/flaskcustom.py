@@ -1,4 +1,4 @@
-import uuid, socket
+import uuid
 from flask import Flask, Request, session, request
 from flask.sessions import SecureCookieSessionInterface
 from itsdangerous import BadSignature, SignatureExpired
@@ -53,26 +53,22 @@ class CustomFlask(Flask):
             CustomFlask.session_interface = CustomSessionInterface()
         super().__init__(*args, **kwargs)
 
-def cleanupSessionSocks(active_socks, session_id=None):
+def cleanupSessionStreams(active_streams, session_id=None):
     if not session:
         session_id = session_id
     else:
         session_id = session['id']
-        
-    # SHOMESEC_DEBUG:
-    IO.printwarn('[session] disconnecting socks: {}'.format(str(active_socks[session_id])))
-
-    if session_id in active_socks:
-        for request_id, request_socks in active_socks[session_id].items():
-            for sock in request_socks:
-                try:
-                    sock.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                sock.close()
-        del active_socks[session_id]
-
-def cleanupRequestSocks(active_socks, session_id=None, request_id=None):
+
+    if session_id in active_streams:
+        # SHOMESEC_DEBUG:
+        IO.printwarn('[session] closing streams: {}'.format(str(active_streams[session_id])))
+
+        for request_id, request_streams in active_streams[session_id].items():
+            for stream in request_streams:
+                stream.close()
+        del active_streams[session_id]
+
+def cleanupRequestStreams(active_streams, session_id=None, request_id=None):
     if not session:
         session_id = session_id
     else:
@@ -81,15 +77,11 @@ def cleanupRequestSocks(active_socks, session_id=None, request_id=None):
         request_id = request_id
     else:
         request_id = request.id
-    
-    if session_id in active_socks:
-        if request_id in active_socks[session_id]:
+
+    if session_id in active_streams:
+        if request_id in active_streams[session_id]:
             # SHOMESEC_DEBUG:
-            IO.printwarn('[request] disconnecting socks: {}'.format(str(active_socks[session_id][request_id])))
-
-            for sock in active_socks[session_id][request_id]:
-                try:
-                    sock.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                sock.close()
+            IO.printwarn('[request] closing streams: {}'.format(str(active_streams[session_id][request_id])))
+
+            for stream in active_streams[session_id].pop(request_id):
+                stream.close()
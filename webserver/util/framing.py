@@ -0,0 +1,149 @@
+'''
+@Summary: Contains the framed wire protocol between pivideo and the webserver
+@Author: devopsec
+
+A client asks for framed delivery by sending a hello right after connecting:
+    magic (4s) version (B) flags (B)
+Every frame is then sent as a fixed size header followed by the payload:
+    magic (2s) version (B) flags (B) payload length (I) sequence number (Q) capture timestamp (d)
+Clients that send nothing get the raw concatenated jpeg stream
+'''
+
+import struct
+from time import time
+
+FRAME_MAGIC = b'SF'
+HELLO_MAGIC = b'SHFH'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('<2sBBIQd')
+HELLO = struct.Struct('<4sBB')
+
+# header flags
+FLAG_KEYFRAME = 0x01
+FLAG_H264 = 0x02 # payload is h264 instead of a jpeg
+# hello flags
+HELLO_H264 = 0x01 # ask for the h264 stream when the camera encodes one
+
+
+def packHello(flags=0):
+    return HELLO.pack(HELLO_MAGIC, PROTOCOL_VERSION, flags)
+
+
+class RawStreamError(ValueError):
+    """
+    The sensor answered with a raw jpeg stream, it predates the framed protocol\n
+    data holds the bytes already read so the stream can be handed to a raw parser
+    """
+
+    def __init__(self, data):
+        super().__init__('sensor does not speak the framed protocol')
+        self.data = data
+
+
+def parseHeader(header):
+    """
+    :return:                    flags, payload length, sequence number and capture timestamp
+    :rtype:                     tuple
+    :raises RawStreamError:     if the stream is raw jpeg
+    :raises ValueError:         on a corrupt header
+    """
+
+    magic, version, flags, length, seq, timestamp = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        if bytes(header[:2]) == b'\xff\xd8':
+            raise RawStreamError(bytes(header))
+        raise ValueError('bad frame header')
+    if version != PROTOCOL_VERSION:
+        raise ValueError('unsupported protocol version {}'.format(version))
+    return flags, length, seq, timestamp
+
+
+class FrameStats():
+    """
+    Gap and latency accounting from frame sequence numbers and capture timestamps
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.lost_frames = 0
+        self.gaps = 0
+        self.last_seq = None
+        # running average of capture -> receive latency in seconds (1/8 weight for new frames)
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def update(self, seq, timestamp):
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.gaps += 1
+            self.lost_frames += seq - self.last_seq - 1
+        self.last_seq = seq
+        self.frames += 1
+
+        latency = time() - timestamp
+        self.latency = latency if self.frames == 1 else self.latency + (latency - self.latency) / 8
+        self.max_latency = max(self.max_latency, latency)
+
+    def getStats(self):
+        return {
+            'frames': self.frames,
+            'lost_frames': self.lost_frames,
+            'gaps': self.gaps,
+            'latency_ms': round(self.latency * 1000, 3),
+            'max_latency_ms': round(self.max_latency * 1000, 3),
+        }
+
+
+class FrameReader():
+    """
+    Reads whole frames from a blocking socket, one recv_into for the header and usually one for the payload\n
+    A socket timeout leaves the partial frame in place and the next read() resumes it
+    """
+
+    def __init__(self):
+        self.header = bytearray(FRAME_HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.received = 0
+        self.payload = None
+        self.payload_view = None
+        self.frame_info = None
+        self.stats = FrameStats()
+
+    def read(self, sock):
+        """
+        :return:                    payload, sequence number, capture timestamp and flags, None at end of stream
+        :rtype:                     tuple|None
+        :raises socket.timeout:     when the socket times out, nothing is lost
+        :raises RawStreamError:     if the sensor sends a raw jpeg stream
+        """
+
+        while self.payload is None:
+            n = sock.recv_into(self.header_view[self.received:])
+            if n == 0:
+                return None
+            self.received += n
+            if self.received == FRAME_HEADER.size:
+                flags, length, seq, timestamp = parseHeader(self.header)
+                self.frame_info = (seq, timestamp, flags)
+                self.payload = bytearray(length)
+                self.payload_view = memoryview(self.payload)
+                self.received = 0
+
+        while self.received < len(self.payload):
+            n = sock.recv_into(self.payload_view[self.received:])
+            if n == 0:
+                return None
+            self.received += n
+
+        payload = self.payload
+        seq, timestamp, flags = self.frame_info
+        self.payload_view.release()
+        self.payload = None
+        self.payload_view = None
+        self.received = 0
+        self.stats.update(seq, timestamp)
+        return payload, seq, timestamp, flags
+
+    def close(self):
+        self.header_view.release()
+        if self.payload_view is not None:
+            self.payload_view.release()
@@ -0,0 +1,249 @@
+'''
+@Summary: Contains the receiver for sensor datagram heartbeats
+@Author: devopsec
+
+Every heartbeat is a single datagram:
+    magic (4s) version (B) capabilities (H) node id (32s) ip (4s) video port (H) sequence (I) interval ms (H)
+    fps (f) active streams (H) disk free bytes (Q) cpu temperature (f)
+Sensors without a configured webserver announce themselves to a discovery group (multicast or broadcast).
+The webserver probes the group and answers announcements with a probe naming its node sync port:
+    magic (4s) version (B) node sync port (H)
+Sensors replicate their event journal in datagrams of whole records:
+    magic (4s) version (B) node id (32s) journal created (Q) first record (I) record count (B) records
+and each is answered with the number of records the webserver holds:
+    magic (4s) version (B) journal created (Q) next record (I)
+'''
+
+import socket, struct, select, binascii, math, ipaddress
+from time import monotonic
+from threading import Thread
+
+HEARTBEAT_MAGIC = b'SHHB'
+PROBE_MAGIC = b'SHPR'
+EVENTS_MAGIC = b'SHEV'
+ACK_MAGIC = b'SHEA'
+PROTOCOL_VERSION = 1
+HEARTBEAT = struct.Struct('<4sBH32s4sHIHfHQf')
+PROBE = struct.Struct('<4sBH')
+EVENTS = struct.Struct('<4sB32sQIB')
+ACK = struct.Struct('<4sBQI')
+EVENT_RECORD_SIZE = 18
+
+CAPABILITIES = {
+    0x01: 'video',
+    0x02: 'motion',
+    0x04: 'door',
+    0x08: 'window',
+    0x10: 'infrared',
+    0x20: 'alarm',
+}
+
+
+def parseHeartbeat(data):
+    """
+    :return:    sensor id, host, video port, sequence number, interval in seconds and node stats, None if invalid
+    :rtype:     tuple|None
+    """
+
+    if len(data) != HEARTBEAT.size:
+        return None
+    magic, version, capabilities, node_id, ip, port, seq, interval_ms, fps, streams, disk_free, cpu_temp = \
+        HEARTBEAT.unpack(data)
+    if magic != HEARTBEAT_MAGIC or version != PROTOCOL_VERSION:
+        return None
+    stats = {
+        'capabilities': [name for flag, name in CAPABILITIES.items() if capabilities & flag],
+        'fps': round(fps, 1),
+        'streams': streams,
+        'disk_free': disk_free,
+        'cpu_temp': None if math.isnan(cpu_temp) else round(cpu_temp, 1),
+    }
+    sensor_id = binascii.hexlify(node_id).decode('utf-8')
+    return sensor_id, socket.inet_ntoa(ip), port, seq, interval_ms / 1000, stats
+
+def parseEvents(data):
+    """
+    :return:    sensor id, journal created time, first record number and the records, None if invalid
+    :rtype:     tuple|None
+    """
+
+    if len(data) < EVENTS.size or bytes(data[:4]) != EVENTS_MAGIC:
+        return None
+    magic, version, node_id, created, first, count = EVENTS.unpack_from(data)
+    records = bytes(data[EVENTS.size:])
+    if version != PROTOCOL_VERSION or len(records) != count * EVENT_RECORD_SIZE:
+        return None
+    return binascii.hexlify(node_id).decode('utf-8'), created, first, records
+
+
+def readRoutes():
+    try:
+        with open('/proc/net/route', 'r') as fp:
+            return fp.read()
+    except OSError:
+        return ''
+
+
+class HeartbeatServer():
+    """
+    Receives sensor heartbeats on one non-blocking datagram socket\n
+    A single thread drains every queued heartbeat per wakeup, so a burst from many sensors costs one select call\n
+    With a discovery group the server also listens for announcements, probes the group every probe interval
+    and right away when the routing table changes, and answers a sensor that is new or restarted with a probe\n
+    Event journal records are handed to on_events and acknowledged with the count it returns
+    """
+
+    def __init__(self, host, port, on_heartbeat, discovery_group='', discovery_port=0, probe_interval=30, on_events=None):
+        """
+        :param on_heartbeat:        callable(sensor_id, host, port, interval, stats) for each valid heartbeat
+        :type on_heartbeat:         callable
+        :param discovery_group:     multicast or broadcast address sensors announce to, '' disables discovery
+        :type discovery_group:      str
+        :param discovery_port:      port sensors listen for probes on
+        :type discovery_port:       int
+        :param probe_interval:      seconds between probes of the discovery group
+        :type probe_interval:       float
+        :param on_events:           callable(sensor_id, created, first, records) returning the records held
+        :type on_events:            callable
+        """
+
+        self.addr = (host, port)
+        self.on_heartbeat = on_heartbeat
+        self.on_events = on_events
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setblocking(False)
+        self.running = False
+        self.discovery = (discovery_group, discovery_port) if discovery_group else None
+        self.probe_interval = probe_interval
+        self.probe = PROBE.pack(PROBE_MAGIC, PROTOCOL_VERSION, port)
+        self.next_probe = 0.0
+        self.routes = None
+        # { sensor_id: last sequence number } and { sensor_id: address heartbeats come from }
+        self.sequences = {}
+        self.peers = {}
+        self.received = 0
+        self.invalid = 0
+        self.lost = 0
+        self.probes = 0
+        self.events = 0
+
+    def start(self):
+        self.sock.bind(self.addr)
+        if self.discovery is not None:
+            if ipaddress.ip_address(self.discovery[0]).is_multicast:
+                self.joinGroup()
+            else:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+        print("Heartbeats on {}".format(str(self.sock.getsockname())))
+
+    def joinGroup(self):
+        """ (Re)join the multicast group, memberships follow the interface of the default route """
+
+        membership = struct.pack('4sl', socket.inet_aton(self.discovery[0]), socket.INADDR_ANY)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, membership)
+        except OSError:
+            pass
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as ex:
+            print('Could not join discovery group {}: {}'.format(self.discovery[0], str(ex)))
+
+    def sendProbe(self, addr):
+        try:
+            self.sock.sendto(self.probe, addr)
+            self.probes += 1
+        except OSError as ex:
+            print('Could not probe {}: {}'.format(str(addr), str(ex)))
+
+    def discover(self):
+        """ Probe the discovery group when it is due or an interface came up or went down """
+
+        routes = readRoutes()
+        changed = self.routes is not None and routes != self.routes
+        self.routes = routes
+        if changed and ipaddress.ip_address(self.discovery[0]).is_multicast:
+            self.joinGroup()
+        if changed or monotonic() >= self.next_probe:
+            self.sendProbe(self.discovery)
+            self.next_probe = monotonic() + self.probe_interval
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+    def run(self):
+        buff = bytearray(2048)
+        while self.running:
+            if self.discovery is not None:
+                self.discover()
+            try:
+                readable, _, _ = select.select((self.sock,), (), (), 1)
+            except (OSError, ValueError):
+                break
+            if len(readable) == 0:
+                continue
+
+            while True:
+                try:
+                    n, addr = self.sock.recvfrom_into(buff)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    return
+                self.handle(bytes(buff[:n]), addr)
+
+    def handleEvents(self, events, addr):
+        sensor_id, created, first, records = events
+        try:
+            held = self.on_events(sensor_id, created, first, records)
+        except Exception as ex:
+            print('Storing events from [{}] failed: {}'.format(sensor_id, str(ex)))
+            return
+        self.events += len(records) // EVENT_RECORD_SIZE
+        if addr is not None:
+            try:
+                self.sock.sendto(ACK.pack(ACK_MAGIC, PROTOCOL_VERSION, created, held), addr)
+            except OSError as ex:
+                print('Could not acknowledge events from [{}]: {}'.format(sensor_id, str(ex)))
+
+    def handle(self, data, addr=None):
+        if self.on_events is not None:
+            events = parseEvents(data)
+            if events is not None:
+                self.handleEvents(events, addr)
+                return
+        beat = parseHeartbeat(data)
+        if beat is None:
+            # our own probes come back from the group
+            if data != self.probe:
+                self.invalid += 1
+            return
+        sensor_id, host, port, seq, interval, stats = beat
+        self.received += 1
+        last = self.sequences.get(sensor_id)
+        # a lower sequence number means the sensor restarted
+        if last is not None and seq > last + 1:
+            self.lost += seq - last - 1
+        self.sequences[sensor_id] = seq
+        # a new, restarted or moved sensor may still be announcing, tell it where we are
+        if self.discovery is not None and addr is not None and \
+                (last is None or seq <= last or self.peers.get(sensor_id) != addr):
+            self.peers[sensor_id] = addr
+            self.sendProbe(addr)
+        try:
+            self.on_heartbeat(sensor_id, host, port, interval, stats)
+        except Exception as ex:
+            print('Handling heartbeat from [{}] failed: {}'.format(sensor_id, str(ex)))
+
+    def getStats(self):
+        return {
+            'received': self.received,
+            'invalid': self.invalid,
+            'lost': self.lost,
+            'probes': self.probes,
+            'events': self.events,
+        }
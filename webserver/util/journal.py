@@ -0,0 +1,395 @@
+'''
+@Summary: Contains the replicas of the sensor event journals
+@Author: devopsec
+
+Sensors replicate their journals over node sync, the webserver keeps one replica per sensor and journal:
+    <events_dir>/<sensor_id>-<created>.journal
+Every motion, door, window and alarm transition is appended as one fixed size record:
+    header:     magic (4s) version (H) record size (H) created (Q, microseconds since the epoch)
+    records:    timestamp (d) node (8s) sensor (B) transition (B)
+Timestamps never go backwards within a journal, so it is sorted by time and can be binary searched in place.
+The created time identifies the journal, a journal that was recreated starts over at record 0.
+'''
+
+import os, mmap, struct
+from time import time
+from collections import Counter
+from threading import Lock, Thread
+
+JOURNAL_MAGIC = b'SHEJ'
+JOURNAL_VERSION = 1
+JOURNAL_HEADER = struct.Struct('<4sHHQ')
+JOURNAL_RECORD = struct.Struct('<d8sBB')
+
+# sensors
+SENSOR_MOTION = 1
+SENSOR_DOOR = 2
+SENSOR_WINDOW = 3
+SENSOR_ALARM = 4
+SENSORS = {
+    SENSOR_MOTION: 'motion',
+    SENSOR_DOOR: 'door',
+    SENSOR_WINDOW: 'window',
+    SENSOR_ALARM: 'alarm',
+}
+# event names for the inactive and active transition of each sensor
+TRANSITIONS = {
+    SENSOR_MOTION: ('ended', 'detected'),
+    SENSOR_DOOR: ('closed', 'opened'),
+    SENSOR_WINDOW: ('closed', 'opened'),
+    SENSOR_ALARM: ('disarmed', 'triggered'),
+}
+# records summarized per block of the time range index
+SUMMARY_BLOCK = 4096
+JOURNAL_EXTENSION = '.journal'
+
+
+def readHeader(fp, path):
+    """
+    :return:                created time of the journal and its number of whole records
+    :rtype:                 tuple
+    :raises ValueError:     if the file is not an event journal
+    """
+
+    header = fp.read(JOURNAL_HEADER.size)
+    if len(header) < JOURNAL_HEADER.size:
+        raise ValueError('truncated journal {}'.format(path))
+    magic, version, record_size, created = JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or record_size != JOURNAL_RECORD.size:
+        raise ValueError('unsupported journal {}'.format(path))
+    size = os.fstat(fp.fileno()).st_size
+    return created, (size - JOURNAL_HEADER.size) // JOURNAL_RECORD.size
+
+def journalPath(events_dir, sensor_id, created):
+    return os.path.join(events_dir, '{}-{}{}'.format(sensor_id, created, JOURNAL_EXTENSION))
+
+def eventName(sensor, transition):
+    try:
+        return TRANSITIONS[sensor][transition]
+    except (KeyError, IndexError):
+        return str(transition)
+
+
+class JournalWriter():
+    """
+    Appends records to a journal, each record is a single write to a file opened for appending\n
+    A partial record left by a crash is cut off when the journal is opened
+    """
+
+    def __init__(self, path, node=b'', created=None):
+        """
+        :param path:    journal file, created if it does not exist
+        :type path:     str
+        :param node:    node the events happened on, the first 8 bytes of its node id
+        :type node:     bytes
+        :param created: created time of a new journal, a replica takes it from the sensor's journal
+        :type created:  int
+        """
+
+        self.path = path
+        self.node = node[:8]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            self.created = created if created is not None else int(time() * 1000000)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, JOURNAL_RECORD.size, self.created))
+            os.replace(path + '.tmp', path)
+        with open(path, 'rb') as fp:
+            self.created, self.count = readHeader(fp, path)
+            self.last = 0.0
+            if self.count > 0:
+                fp.seek(JOURNAL_HEADER.size + (self.count - 1) * JOURNAL_RECORD.size)
+                self.last = JOURNAL_RECORD.unpack(fp.read(JOURNAL_RECORD.size))[0]
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        os.truncate(self.fd, JOURNAL_HEADER.size + self.count * JOURNAL_RECORD.size)
+
+    def append(self, sensor, transition, timestamp=None):
+        """
+        :param sensor:      SENSOR_* the event came from
+        :type sensor:       int
+        :param transition:  1 when the sensor became active, 0 when it became inactive
+        :type transition:   int
+        :return:            number of the record
+        :rtype:             int
+        """
+
+        # a clock set back does not break the time order
+        self.last = max(timestamp if timestamp is not None else time(), self.last)
+        os.write(self.fd, JOURNAL_RECORD.pack(self.last, self.node, sensor, transition))
+        self.count += 1
+        return self.count - 1
+
+    def extend(self, records):
+        """
+        Append records as stored in another journal, a replica keeps their time order
+
+        :param records:     whole records
+        :type records:      bytes
+        """
+
+        count = len(records) // JOURNAL_RECORD.size
+        if count == 0:
+            return
+        os.write(self.fd, records[:count * JOURNAL_RECORD.size])
+        self.count += count
+        self.last = JOURNAL_RECORD.unpack_from(records, (count - 1) * JOURNAL_RECORD.size)[0]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JournalReader():
+    """
+    Memory mapped reader of a journal, records are read in place and nothing is loaded up front\n
+    refresh() maps records appended since the journal was opened\n
+    Time ranges are found by binary search over the records, counts over a range add up per block summaries
+    and only unpack the records of the partial blocks at its ends
+    """
+
+    def __init__(self, path):
+        """
+        :raises ValueError:     if the file is not an event journal
+        """
+
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.map = None
+        self.count = 0
+        # Counter of (sensor, transition) for each whole block of SUMMARY_BLOCK records
+        self.summaries = []
+        try:
+            self.created, _ = readHeader(self.fp, path)
+        except:
+            self.fp.close()
+            raise
+        self.refresh()
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def refresh(self):
+        """
+        :return:    True if records were appended since the last refresh
+        :rtype:     bool
+        """
+
+        size = os.fstat(self.fp.fileno()).st_size
+        # a journal still being written may end in a partial record, ignore it
+        count = (size - JOURNAL_HEADER.size) // JOURNAL_RECORD.size
+        if count == self.count:
+            return False
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = count
+        return True
+
+    def raw(self, start, stop):
+        """
+        :return:    records start to stop as stored
+        :rtype:     bytes
+        """
+
+        start, stop = max(start, 0), min(stop, self.count)
+        if start >= stop:
+            return b''
+        return self.map[JOURNAL_HEADER.size + start * JOURNAL_RECORD.size:JOURNAL_HEADER.size + stop * JOURNAL_RECORD.size]
+
+    def timestamp(self, i):
+        return JOURNAL_RECORD.unpack_from(self.map, JOURNAL_HEADER.size + i * JOURNAL_RECORD.size)[0]
+
+    def find(self, timestamp):
+        """
+        :return:    first record at or after the timestamp, the record count if there is none
+        :rtype:     int
+        """
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start, stop):
+        """
+        :return:    timestamp, node, sensor and transition of records start to stop
+        :rtype:     iterator
+        """
+
+        return JOURNAL_RECORD.iter_unpack(self.raw(start, stop))
+
+    def latest(self, start, stop, limit, sensor=None):
+        """
+        :return:    the last limit records between start and stop, optionally of one sensor only
+        :rtype:     list
+        """
+
+        found = []
+        while stop > start and len(found) < limit:
+            begin = max(start, stop - max(limit, 256))
+            found = [x for x in self.records(begin, stop) if sensor is None or x[2] == sensor] + found
+            stop = begin
+        return found[-limit:] if limit > 0 else []
+
+    def summarize(self):
+        """ Extend the block summaries over blocks completed since the last call """
+
+        for block in range(len(self.summaries), self.count // SUMMARY_BLOCK):
+            self.summaries.append(Counter((x[2], x[3]) for x in
+                                          self.records(block * SUMMARY_BLOCK, (block + 1) * SUMMARY_BLOCK)))
+
+    def countRange(self, start, stop):
+        """
+        :return:    number of records per (sensor, transition) between start and stop
+        :rtype:     Counter
+        """
+
+        self.summarize()
+        counts = Counter()
+        first_block = -(-start // SUMMARY_BLOCK)
+        last_block = stop // SUMMARY_BLOCK
+        if first_block >= last_block:
+            counts.update((x[2], x[3]) for x in self.records(start, stop))
+            return counts
+        counts.update((x[2], x[3]) for x in self.records(start, first_block * SUMMARY_BLOCK))
+        for summary in self.summaries[first_block:last_block]:
+            counts.update(summary)
+        counts.update((x[2], x[3]) for x in self.records(last_block * SUMMARY_BLOCK, stop))
+        return counts
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fp.close()
+
+
+class EventStore():
+    """
+    Replicas of the sensor event journals and queries across them\n
+    A sensor whose journal was recreated starts a new replica, older replicas stay queryable
+    """
+
+    def __init__(self, events_dir):
+        self.events_dir = events_dir
+        self.lock = Lock()
+        # { sensor_id: JournalWriter } for the current replica of each sensor
+        self.writers = {}
+        # { path: JournalReader }
+        self.readers = {}
+
+    def receive(self, sensor_id, created, first, records):
+        """
+        Add records sent by a sensor, records the replica already holds are skipped
+
+        :param created:     created time of the sensor's journal
+        :type created:      int
+        :param first:       number of the first record
+        :type first:        int
+        :param records:     whole records as stored in the sensor's journal
+        :type records:      bytes
+        :return:            number of records the replica holds, the next record the sensor should send
+        :rtype:             int
+        """
+
+        with self.lock:
+            writer = self.writers.get(sensor_id)
+            if writer is None or writer.created != created:
+                if writer is not None:
+                    writer.close()
+                writer = JournalWriter(journalPath(self.events_dir, sensor_id, created), created=created)
+                self.writers[sensor_id] = writer
+            # a gap waits for the sensor to resend from what we hold
+            if first <= writer.count:
+                writer.extend(records[(writer.count - first) * JOURNAL_RECORD.size:])
+            return writer.count
+
+    def getReaders(self, sensor_id=None):
+        """ Must be called with the lock held """
+
+        try:
+            names = [x.name for x in os.scandir(self.events_dir) if x.name.endswith(JOURNAL_EXTENSION)]
+        except FileNotFoundError:
+            names = []
+        readers = []
+        for name in names:
+            journal_sensor = name[:-len(JOURNAL_EXTENSION)].rsplit('-', 1)[0]
+            if sensor_id is not None and journal_sensor != sensor_id:
+                continue
+            path = os.path.join(self.events_dir, name)
+            reader = self.readers.get(path)
+            try:
+                if reader is None:
+                    reader = JournalReader(path)
+                    self.readers[path] = reader
+                else:
+                    reader.refresh()
+            except (OSError, ValueError) as ex:
+                print('Skipping journal {}: {}'.format(name, str(ex)))
+                continue
+            readers.append((journal_sensor, reader))
+        return readers
+
+    def query(self, t0, t1, sensor_id=None, sensor=None, limit=500):
+        """
+        Events between t0 (inclusive) and t1 (exclusive)
+
+        :param sensor_id:   only events of this sensor node
+        :type sensor_id:    str
+        :param sensor:      only events of this SENSOR_*
+        :type sensor:       int
+        :param limit:       most events returned, the newest are kept
+        :type limit:        int
+        :return:            (sensor_id, timestamp, sensor, transition) sorted by time,
+                            and { sensor_id: { sensor: { event: count } } } over the whole range
+        :rtype:             tuple
+        """
+
+        events = []
+        counts = {}
+        with self.lock:
+            for journal_sensor, reader in self.getReaders(sensor_id):
+                if reader.count == 0:
+                    continue
+                start, stop = reader.find(t0), reader.find(t1)
+                if start >= stop:
+                    continue
+                sensor_counts = counts.setdefault(journal_sensor, {})
+                for (record_sensor, transition), count in reader.countRange(start, stop).items():
+                    if sensor is not None and record_sensor != sensor:
+                        continue
+                    by_event = sensor_counts.setdefault(SENSORS.get(record_sensor, str(record_sensor)), {})
+                    event = eventName(record_sensor, transition)
+                    by_event[event] = by_event.get(event, 0) + count
+                events.extend((journal_sensor, timestamp, record_sensor, transition)
+                              for timestamp, _, record_sensor, transition in reader.latest(start, stop, limit, sensor))
+        events.sort(key=lambda x: x[1])
+        return events[-limit:] if limit > 0 else [], counts
+
+    def warm(self):
+        with self.lock:
+            for _, reader in self.getReaders():
+                reader.summarize()
+
+    def start(self):
+        """ Build the block summaries of the existing journals in the background """
+
+        Thread(target=self.warm, daemon=True).start()
+
+    def close(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            for reader in self.readers.values():
+                reader.close()
+            self.writers = {}
+            self.readers = {}
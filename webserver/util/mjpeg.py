@@ -0,0 +1,92 @@
+'''
+@Summary: Contains methods for parsing motion jpeg streams
+@Author: devopsec
+'''
+
+# JPEG exif file headers
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+
+class MjpegParser():
+    """
+    Incremental parser for a stream of concatenated jpeg frames\n
+    Scanning resumes where the previous call stopped so each byte is only searched once
+    """
+
+    def __init__(self, buffsize=16384):
+        self.buffsize = buffsize
+        self.buff = bytearray()
+        self.scan_pos = 0       # offset in buff where the next marker search starts
+        self.frame_start = -1   # offset in buff of the SOI for the frame in progress
+        self.bytes_parsed = 0
+        self.frames_parsed = 0
+
+    def reset(self):
+        self.buff.clear()
+        self.scan_pos = 0
+        self.frame_start = -1
+
+    def feed(self, data):
+        """
+        Append data to the stream
+
+        :param data:    bytes-like chunk read from the stream
+        :type data:     bytes|bytearray|memoryview
+        :return:        every frame completed by this chunk
+        :rtype:         list of bytes
+        """
+
+        buff = self.buff
+        buff += data
+        self.bytes_parsed += len(data)
+
+        frames = []
+        pos = self.scan_pos
+        with memoryview(buff) as view:
+            while True:
+                if self.frame_start == -1:
+                    start = buff.find(SOI, pos)
+                    if start == -1:
+                        break
+                    self.frame_start = start
+                    pos = start + 2
+
+                end = buff.find(EOI, pos)
+                if end == -1:
+                    break
+                pos = end + 2
+                frames.append(bytes(view[self.frame_start:pos]))
+                self.frame_start = -1
+
+        self.frames_parsed += len(frames)
+
+        # drop consumed bytes, keeping the last byte in case a marker is split across reads
+        if self.frame_start == -1:
+            discard = max(len(buff) - 1, 0)
+            self.scan_pos = 0
+        else:
+            discard = self.frame_start
+            self.scan_pos = max(len(buff) - 1, self.frame_start + 2) - discard
+            self.frame_start = 0
+        del buff[:discard]
+
+        return frames
+
+    def readFrames(self, stream):
+        """
+        Generate frames from a binary stream until it is exhausted
+
+        :param stream:  unbuffered or buffered binary stream supporting readinto()
+        :type stream:   io.RawIOBase|io.BufferedIOBase
+        :return:        frames as they are completed
+        :rtype:         generator of bytes
+        """
+
+        chunk = bytearray(self.buffsize)
+        with memoryview(chunk) as view:
+            while True:
+                n = stream.readinto(chunk)
+                if not n:
+                    break
+                yield from self.feed(view[:n])
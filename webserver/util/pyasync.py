@@ -4,9 +4,11 @@
 '''
 
 from functools import wraps
-from threading import Thread, Lock
+from time import monotonic
+from collections import deque
+from threading import Thread, Lock, Condition
 from multiprocessing import Process
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 
 class ThreadingIter():
@@ -50,6 +52,195 @@ def proc(func):
 
     return wrapper
 
+class PoolFullError(RuntimeError):
+    """
+    Raised by WorkerPool.submit when every worker is busy and the queue is full
+    """
+
+
+class WorkerPool():
+    """
+    Fixed number of worker threads fed from a bounded queue\n
+    Workers are started on demand, so an idle pool costs nothing\n
+    Once every worker is busy and the queue is full the pool either rejects new work ('reject')
+    or drops the oldest queued work to make room ('shed'), it never grows past its limits\n
+    Every task records how long it waited in the queue
+    """
+
+    def __init__(self, workers=4, queue_size=16, policy='reject', name='pool'):
+        """
+        :param workers:     maximum number of worker threads
+        :type workers:      int
+        :param queue_size:  tasks waiting for a free worker before the policy applies
+        :type queue_size:   int
+        :param policy:      'reject' raises PoolFullError, 'shed' cancels the oldest queued task
+        :type policy:       str
+        :param name:        name prefix of the worker threads
+        :type name:         str
+        """
+
+        if policy not in ('reject', 'shed'):
+            raise ValueError('unknown pool policy {}'.format(policy))
+        self.max_workers = max(workers, 1)
+        self.queue_size = max(queue_size, 0)
+        self.policy = policy
+        self.name = name
+        self.condition = Condition()
+        # (future, func, args, kwargs, enqueued) in submit order
+        self.queue = deque()
+        self.workers = 0
+        self.idle = 0
+        self.running = True
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.shed = 0
+        # running average of the queue wait in seconds (1/8 weight for new tasks)
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) for a worker
+
+        :return:                    future of the call, a shed task's future is cancelled
+        :rtype:                     concurrent.futures.Future
+        :raises PoolFullError:      if the pool is saturated and the policy is 'reject'
+        :raises RuntimeError:       if the pool is shut down
+        """
+
+        future = Future()
+        shed = None
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('{} is shut down'.format(self.name))
+            # waiting tasks beyond the idle workers are what fills the queue
+            if len(self.queue) - self.idle >= self.queue_size and self.workers >= self.max_workers:
+                if self.policy == 'reject' or len(self.queue) == 0:
+                    self.rejected += 1
+                    raise PoolFullError('{} is saturated ({} workers, {} queued)'.format(
+                        self.name, self.workers, len(self.queue)))
+                shed = self.queue.popleft()[0]
+                self.shed += 1
+            self.queue.append((future, func, args, kwargs, monotonic()))
+            self.submitted += 1
+            # idle workers that were already woken may not have taken their task yet
+            if len(self.queue) > self.idle and self.workers < self.max_workers:
+                self.workers += 1
+                Thread(target=self.work, name='{}-{}'.format(self.name, self.workers), daemon=True).start()
+            else:
+                self.condition.notify()
+        if shed is not None:
+            shed.cancel()
+        return future
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.idle += 1
+                self.condition.wait_for(lambda: len(self.queue) > 0 or not self.running)
+                self.idle -= 1
+                if len(self.queue) == 0:
+                    self.workers -= 1
+                    return
+                future, func, args, kwargs, enqueued = self.queue.popleft()
+                wait = monotonic() - enqueued
+                self.wait = wait if self.completed + self.failed == 0 else self.wait + (wait - self.wait) / 8
+                self.max_wait = max(self.max_wait, wait)
+
+            future.queue_wait = wait
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+                with self.condition:
+                    self.failed += 1
+            else:
+                future.set_result(result)
+                with self.condition:
+                    self.completed += 1
+
+    def shutdown(self, cancel=False):
+        """
+        Stop accepting work, workers exit once the queue is drained
+
+        :param cancel:  cancel the tasks still queued instead of running them
+        :type cancel:   bool
+        """
+
+        with self.condition:
+            self.running = False
+            queued = []
+            if cancel:
+                queued = [task[0] for task in self.queue]
+                self.queue.clear()
+            self.condition.notify_all()
+        for future in queued:
+            future.cancel()
+
+    def getStats(self):
+        with self.condition:
+            return {
+                'workers': self.workers,
+                'busy': self.workers - self.idle,
+                'queued': len(self.queue),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'shed': self.shed,
+                'wait_ms': round(self.wait * 1000, 3),
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+            }
+
+def pooled(pool):
+    """
+    Execute task on a bounded worker pool, the wrapper returns the future of the call\n
+    A saturated pool raises PoolFullError from the wrapper or cancels older calls, depending on its policy
+
+    :param pool:    pool to submit calls to
+    :type pool:     WorkerPool
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return pool.submit(func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def submitAll(executor, func, args=None, kwargs=None, workers=None):
+    # no args or kwargs, number of tasks = num workers
+    if args is None and kwargs is None:
+        workers = workers if workers is not None else 1
+        return [executor.submit(func) for _ in range(workers)]
+    # args without kwargs
+    elif kwargs is None:
+        return [executor.submit(func, *func_args) for func_args in args]
+    # args and kwargs
+    else:
+        return [executor.submit(func, *func_args, **func_kwargs) for func_args, func_kwargs in zip(args, kwargs)]
+
+def collect(executor, tasks, callback=None):
+    """
+    Yield results in completion order, tasks not started yet are cancelled when the consumer stops early
+    """
+
+    try:
+        for task in as_completed(tasks):
+            if callback:
+                callback(task)
+            yield task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=True)
+
 def mpexec(func, args=None, kwargs=None, workers=None, callback=None):
     """
     Execute task with pool of processes
@@ -57,32 +248,12 @@ def mpexec(func, args=None, kwargs=None, workers=None, callback=None):
     :param args:        list of arg lists for each function execution
     :param kwargs:      list of kwarg dicts for each function execution
     :param workers:     number of workers processes to use
-    :param callback:    callable function to execute after each completion
-    :return:            list of results
+    :param callback:    callable function to execute with each future as it completes
+    :return:            generator of results in completion order
     """
 
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        # no args or kwargs, number of tasks = num workers
-        if args is None and kwargs is None:
-            workers = workers if workers is not None else 1
-            if callback:
-                tasks = [executor.submit(func).add_done_callback(callback) for _ in range(workers)]
-            else:
-                tasks = [executor.submit(func) for _ in range(workers)]
-        # args without kwargs
-        elif kwargs is None:
-            if callback:
-                tasks = [executor.submit(func, *func_args).add_done_callback(callback) for func_args in args]
-            else:
-                tasks = [executor.submit(func, *func_args) for func_args in args]
-        # args and kwargs
-        else:
-            if callback:
-                tasks = [executor.submit(func, *func_args, **func_kwargs).add_done_callback(callback) for func_args, func_kwargs in zip(args, kwargs)]
-            else:
-                tasks = [executor.submit(func, *func_args, **func_kwargs) for func_args, func_kwargs in zip(args, kwargs)]
-
-    return [task.result() for task in tasks]
+    executor = ProcessPoolExecutor(max_workers=workers)
+    return collect(executor, submitAll(executor, func, args, kwargs, workers), callback)
 
 def mtexec(func, args=None, kwargs=None, workers=None, callback=None):
     """
@@ -91,29 +262,9 @@ def mtexec(func, args=None, kwargs=None, workers=None, callback=None):
     :param args:        list of arg lists for each function execution
     :param kwargs:      list of kwarg dicts for each function execution
     :param workers:     number of workers threads to use
-    :param callback:    callable function to execute after each completion
-    :return:            list of results
+    :param callback:    callable function to execute with each future as it completes
+    :return:            generator of results in completion order
     """
 
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        # no args or kwargs, number of tasks = num workers
-        if args is None and kwargs is None:
-            workers = workers if workers is not None else 1
-            if callback:
-                tasks = [executor.submit(func).add_done_callback(callback) for _ in range(workers)]
-            else:
-                tasks = [executor.submit(func) for _ in range(workers)]
-        # args without kwargs
-        elif kwargs is None:
-            if callback:
-                tasks = [executor.submit(func, *func_args).add_done_callback(callback) for func_args in args]
-            else:
-                tasks = [executor.submit(func, *func_args) for func_args in args]
-        # args and kwargs
-        else:
-            if callback:
-                tasks = [executor.submit(func, *func_args, **func_kwargs).add_done_callback(callback) for func_args, func_kwargs in zip(args, kwargs)]
-            else:
-                tasks = [executor.submit(func, *func_args, **func_kwargs) for func_args, func_kwargs in zip(args, kwargs)]
-
-    return [task.result() for task in tasks]
+    executor = ThreadPoolExecutor(max_workers=workers)
+    return collect(executor, submitAll(executor, func, args, kwargs, workers), callback)
@@ -0,0 +1,173 @@
+'''
+@Summary: Contains the registry of sensors known to the webserver
+@Author: devopsec
+'''
+
+from time import time, monotonic
+from threading import Condition, Thread
+
+
+class SensorRegistry():
+    """
+    Sensors announced by node sync heartbeats, each expires after missing heartbeats for the ttl\n
+    Every change rebuilds an immutable snapshot, readers take the current snapshot without locking
+    and never see a dict another thread is changing\n
+    Listeners are called with (event, sensor_id, info) for 'added', 'changed' and 'removed' sensors,
+    health changes (reachable / streaming) count as changes
+
+    Only changes bump the version and wake waiters, heartbeats and fps updates just refresh the snapshot
+    """
+
+    def __init__(self, ttl=180, interval=1):
+        """
+        :param ttl:         seconds without a heartbeat before a sensor is dropped
+        :type ttl:          float
+        :param interval:    seconds between expiry checks
+        :type interval:     float
+        """
+
+        self.ttl = ttl
+        self.interval = interval
+        self.condition = Condition()
+        # { sensor_id: info } owned by the registry, only changed under the condition
+        self.sensors = {}
+        self.deadlines = {}
+        self.listeners = []
+        self.version = 0
+        self.snapshot = {}
+        self.addrs = {}
+        self.running = False
+
+    def addListener(self, listener):
+        """
+        :param listener:    callable(event, sensor_id, info), called outside the registry lock
+        :type listener:     callable
+        """
+
+        self.listeners = self.listeners + [listener]
+
+    def publish(self, changed=True):
+        """
+        Must be called with the condition held
+
+        :param changed:     False if only last_seen, fps or node stats were updated, waiters are not woken up
+        :type changed:      bool
+        """
+
+        self.snapshot = {sensor_id: dict(info) for sensor_id, info in self.sensors.items()}
+        if not changed:
+            return
+        self.addrs = {sensor_id: (info['host'], info['port']) for sensor_id, info in self.sensors.items()}
+        self.version += 1
+        self.condition.notify_all()
+
+    def notify(self, events):
+        for event, sensor_id, info in events:
+            print('Sensor [{}] {}: {}'.format(sensor_id, event, info))
+            for listener in self.listeners:
+                try:
+                    listener(event, sensor_id, info)
+                except Exception as ex:
+                    print('Sensor listener failed: {}'.format(str(ex)))
+
+    def heartbeat(self, sensor_id, host, port, ttl=None, stats=None):
+        """
+        Record a node sync heartbeat, adds the sensor if it is new
+
+        :param ttl:     seconds until the sensor expires without another heartbeat, defaults to the registry ttl
+        :type ttl:      float
+        :param stats:   stats the node reported about itself
+        :type stats:    dict
+        """
+
+        events = []
+        with self.condition:
+            info = self.sensors.get(sensor_id)
+            if info is None:
+                info = {'host': host, 'port': port, 'last_seen': time(), 'reachable': None, 'streaming': False, 'fps': 0.0,
+                        'node': stats}
+                self.sensors[sensor_id] = info
+                events.append(('added', sensor_id, dict(info)))
+            else:
+                if (info['host'], info['port']) != (host, port):
+                    info.update(host=host, port=port, reachable=None, streaming=False, fps=0.0)
+                    events.append(('changed', sensor_id, dict(info)))
+                info['last_seen'] = time()
+            if stats is not None:
+                info['node'] = stats
+            self.deadlines[sensor_id] = monotonic() + (ttl if ttl is not None else self.ttl)
+            self.publish(len(events) > 0)
+        self.notify(events)
+
+    def setHealth(self, sensor_id, reachable, streaming, fps=0.0):
+        """
+        Record how a relay currently sees the sensor, unknown sensors are ignored
+        """
+
+        events = []
+        with self.condition:
+            info = self.sensors.get(sensor_id)
+            if info is None:
+                return
+            changed = info['reachable'] != reachable or info['streaming'] != streaming
+            info.update(reachable=reachable, streaming=streaming, fps=round(fps, 1))
+            if changed:
+                events.append(('changed', sensor_id, dict(info)))
+            self.publish(changed)
+        self.notify(events)
+
+    def expire(self):
+        events = []
+        now = monotonic()
+        with self.condition:
+            for sensor_id in [x for x, deadline in self.deadlines.items() if deadline <= now]:
+                del self.deadlines[sensor_id]
+                events.append(('removed', sensor_id, self.sensors.pop(sensor_id)))
+            if len(events) > 0:
+                self.publish()
+        self.notify(events)
+
+    def getSnapshot(self):
+        """
+        :return:    { sensor_id: info } as of the last change, must not be modified
+        :rtype:     dict
+        """
+
+        return self.snapshot
+
+    def getAddrs(self):
+        """
+        :return:    { sensor_id: (host, port) } as of the last change, must not be modified
+        :rtype:     dict
+        """
+
+        return self.addrs
+
+    def wait(self, version, timeout=None):
+        """
+        Block until the registry changes after version
+
+        :return:    current version and snapshot, the same version if the timeout expired
+        :rtype:     tuple
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version or not self.running, timeout)
+            return self.version, self.snapshot
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running, self.interval)
+                if not self.running:
+                    break
+            self.expire()
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
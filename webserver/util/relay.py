@@ -0,0 +1,438 @@
+'''
+@Summary: Contains classes for relaying sensor video streams to many viewers
+@Author: devopsec
+'''
+
+import socket, struct
+from time import monotonic, time
+from threading import Thread, Lock, Condition
+from util.mjpeg import MjpegParser
+from util.framing import FrameReader, RawStreamError, packHello
+from util.datagram import FrameAssembler, packSubscribe, packUnsubscribe, SUBSCRIBE_MULTICAST
+from util.printing import IO
+
+
+class SensorRelay():
+    """
+    Holds a single upstream connection to a sensor video server\n
+    Frames are parsed once and handed to every subscribed viewer\n
+    Connects lazily on the first viewer and disconnects once the last viewer has been gone for the grace period\n
+    With the framed protocol frames are read whole from their headers, sensors that only send raw jpegs
+    are detected from the first bytes and parsed by scanning for markers\n
+    The optional health callback(sensor_id, reachable, streaming, fps) hears about connects, failures
+    and the received frame rate about once a second
+    """
+
+    def __init__(self, sensor_id, addr, buffsize=16384, grace_period=10, timeout=5, protocol='framed', health=None):
+        self.sensor_id = sensor_id
+        self.addr = addr
+        self.buffsize = buffsize
+        self.grace_period = grace_period
+        self.timeout = timeout
+        self.protocol = protocol
+        self.reader = None
+        self.condition = Condition()
+        self.sock = None
+        self.running = False
+        self.closed = False
+        self.subscribers = 0
+        self.idle_since = None
+        self.frame = None
+        self.frame_seq = 0
+        self.frame_time = 0.0
+        self.health = health
+        self.health_seq = 0
+        self.health_time = 0.0
+
+    def reportHealth(self, reachable, streaming):
+        if self.health is None:
+            return
+        now = monotonic()
+        fps = 0.0
+        if streaming and self.health_time > 0:
+            fps = (self.frame_seq - self.health_seq) / max(now - self.health_time, 0.001)
+        self.health_seq = self.frame_seq
+        self.health_time = now if streaming else 0.0
+        self.health(self.sensor_id, reachable, streaming, fps)
+
+    def checkHealth(self):
+        """ Called from the reader loop, reports the frame rate once a second """
+
+        if self.health is not None and monotonic() - self.health_time >= 1:
+            self.reportHealth(True, True)
+
+    def subscribe(self):
+        """
+        Register a viewer, connecting upstream if needed
+
+        :return:            subscription yielding each new frame
+        :rtype:             RelaySubscription
+        :raises OSError:    when the sensor can not be reached
+        """
+
+        with self.condition:
+            self.subscribers += 1
+            self.idle_since = None
+            self.closed = False
+            if self.running:
+                return RelaySubscription(self)
+
+            try:
+                sock = self.connect()
+            except OSError as ex:
+                self.subscribers -= 1
+                error = ex
+            else:
+                error = None
+                self.running = True
+                subscription = RelaySubscription(self)
+
+        # health listeners may call back into the relays, so report without holding the lock
+        if error is not None:
+            self.reportHealth(False, False)
+            raise error
+        self.reportHealth(True, True)
+        Thread(target=self.run, args=(sock,), daemon=True).start()
+        return subscription
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.idle_since = monotonic()
+
+    def connect(self):
+        sock = socket.create_connection(self.addr, timeout=self.timeout)
+        if self.protocol == 'framed':
+            sock.sendall(packHello())
+        # wake up periodically to check whether the relay went idle
+        sock.settimeout(1)
+        self.sock = sock
+        self.frame = None
+        IO.printinfo('[relay] connected to sensor [{}] at {}'.format(self.sensor_id, str(self.addr)))
+        return sock
+
+    def isIdle(self):
+        """ Must be called with the condition held """
+        if self.closed:
+            return True
+        return self.subscribers == 0 and self.idle_since is not None and \
+            monotonic() - self.idle_since >= self.grace_period
+
+    def getSnapshot(self, timeout=None):
+        """
+        Latest complete frame, connecting upstream if no frame is cached
+
+        The relay then stays up for the grace period so following snapshots are served from memory
+
+        :param timeout:     seconds to wait for a frame when none is cached
+        :type timeout:      float
+        :return:            frame, sequence number and capture time or (None, 0, 0.0)
+        :rtype:             tuple
+        :raises OSError:    when the sensor can not be reached
+        """
+
+        with self.condition:
+            if self.running and self.frame is not None:
+                if self.subscribers == 0:
+                    self.idle_since = monotonic()
+                return self.frame, self.frame_seq, self.frame_time
+
+        stream = self.subscribe()
+        try:
+            with self.condition:
+                self.condition.wait_for(lambda: self.frame is not None or not self.running,
+                                        timeout if timeout is not None else self.timeout)
+                if self.frame is None:
+                    return None, 0, 0.0
+                return self.frame, self.frame_seq, self.frame_time
+        finally:
+            stream.close()
+
+    def publish(self, frame, timestamp=None):
+        with self.condition:
+            self.frame = frame
+            self.frame_seq += 1
+            self.frame_time = timestamp if timestamp is not None else time()
+            self.condition.notify_all()
+
+    def getStats(self):
+        stats = {'addr': self.addr, 'running': self.running, 'subscribers': self.subscribers, 'protocol': self.protocol}
+        if self.reader is not None:
+            stats.update(self.reader.stats.getStats())
+        return stats
+
+    def run(self, sock):
+        """
+        Read frames from the sensor until it goes away or the relay goes idle
+        """
+
+        parser = MjpegParser(self.buffsize)
+        chunk = bytearray(self.buffsize)
+        view = memoryview(chunk)
+        reader = FrameReader() if self.protocol == 'framed' else None
+        self.reader = reader
+
+        try:
+            while True:
+                try:
+                    if reader is not None:
+                        result = reader.read(sock)
+                        if result is None:
+                            break
+                        frame, seq, timestamp, flags = result
+                        self.publish(frame, timestamp)
+                    else:
+                        n = sock.recv_into(chunk)
+                        if n == 0:
+                            break
+                        for frame in parser.feed(view[:n]):
+                            self.publish(frame)
+                except socket.timeout:
+                    pass
+                except RawStreamError as ex:
+                    IO.printwarn('[relay] sensor [{}] sends raw jpegs, falling back to parsing'.format(self.sensor_id))
+                    reader.close()
+                    reader = None
+                    self.reader = None
+                    for frame in parser.feed(ex.data):
+                        self.publish(frame)
+
+                self.checkHealth()
+                with self.condition:
+                    # decided under the lock so a new subscriber either sees us running or starts a new reader
+                    if self.isIdle():
+                        self.running = False
+                        break
+            self.reportHealth(True, False)
+        except (OSError, ValueError) as ex:
+            IO.printerr('[relay] lost connection to sensor [{}]: {}'.format(self.sensor_id, str(ex)))
+            self.reportHealth(False, False)
+        finally:
+            view.release()
+            if reader is not None:
+                reader.close()
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            IO.printinfo('[relay] disconnected from sensor [{}]'.format(self.sensor_id))
+
+    def close(self):
+        """
+        Force the relay down, ending every subscription
+        """
+
+        with self.condition:
+            self.closed = True
+            sock = self.sock if self.running else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class DatagramSensorRelay(SensorRelay):
+    """
+    Relay receiving the sensor video as datagram fragments (see util/datagram.py)\n
+    Incomplete frames are dropped rather than waited for, so a lost packet never delays the frames behind it\n
+    With a multicast group every consumer on the network shares the stream the sensor sends to the group
+    """
+
+    # socket receive buffer, holds a few frames worth of fragments
+    RCVBUF = 4194304
+
+    def __init__(self, sensor_id, addr, buffsize=16384, grace_period=10, timeout=5, ttl=10,
+                 multicast_group='', multicast_port=0, health=None):
+        super().__init__(sensor_id, addr, buffsize, grace_period, timeout, 'udp', health)
+        self.ttl = ttl
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.assembler = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DatagramSensorRelay.RCVBUF)
+            if self.multicast_group:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(('', self.multicast_port))
+                membership = struct.pack('4sl', socket.inet_aton(self.multicast_group), socket.INADDR_ANY)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            else:
+                sock.bind(('', 0))
+            self.sendControl(sock, packSubscribe)
+        except OSError:
+            sock.close()
+            raise
+        # wake up periodically to renew the subscription and check whether the relay went idle
+        sock.settimeout(1)
+        self.sock = sock
+        self.frame = None
+        IO.printinfo('[relay] subscribed to datagrams from sensor [{}] at {}'.format(self.sensor_id, str(self.addr)))
+        return sock
+
+    def sendControl(self, sock, pack):
+        sock.sendto(pack(SUBSCRIBE_MULTICAST if self.multicast_group else 0), self.addr)
+
+    def getStats(self):
+        stats = super().getStats()
+        if self.assembler is not None:
+            stats.update(self.assembler.getStats())
+        return stats
+
+    def run(self, sock):
+        """
+        Reassemble frames from the sensor until the relay goes idle
+        """
+
+        assembler = FrameAssembler()
+        self.assembler = assembler
+        packet = bytearray(65536)
+        view = memoryview(packet)
+        renew_at = monotonic() + self.ttl / 3
+
+        try:
+            while True:
+                try:
+                    n, addr = sock.recvfrom_into(packet)
+                    # a multicast group may carry other sensors too
+                    if addr[0] == self.addr[0]:
+                        result = assembler.feed(view[:n])
+                        if result is not None:
+                            frame, seq, timestamp, flags = result
+                            self.publish(frame, timestamp)
+                except socket.timeout:
+                    pass
+
+                if monotonic() >= renew_at:
+                    self.sendControl(sock, packSubscribe)
+                    renew_at = monotonic() + self.ttl / 3
+
+                self.checkHealth()
+                with self.condition:
+                    if self.isIdle():
+                        self.running = False
+                        break
+            self.reportHealth(True, False)
+        except OSError as ex:
+            IO.printerr('[relay] lost datagrams from sensor [{}]: {}'.format(self.sensor_id, str(ex)))
+            self.reportHealth(False, False)
+        finally:
+            view.release()
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+            try:
+                self.sendControl(sock, packUnsubscribe)
+            except OSError:
+                pass
+            sock.close()
+            IO.printinfo('[relay] unsubscribed from sensor [{}]'.format(self.sensor_id))
+
+    def close(self):
+        # the reader notices within a second through its receive timeout
+        with self.condition:
+            self.closed = True
+
+
+class RelaySubscription():
+    """
+    Iterator over the frames of a relay for a single viewer\n
+    A slow viewer skips straight to the newest frame instead of queueing old ones
+    """
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.active = True
+        # start with the latest frame if one is available
+        self.last_seq = relay.frame_seq - 1 if relay.frame is not None else relay.frame_seq
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        relay = self.relay
+        with relay.condition:
+            while self.active and relay.running and relay.frame_seq == self.last_seq:
+                relay.condition.wait(relay.timeout)
+            if not self.active or relay.frame_seq == self.last_seq:
+                raise StopIteration
+            self.last_seq = relay.frame_seq
+            return relay.frame
+
+    def close(self):
+        relay = self.relay
+        with relay.condition:
+            if not self.active:
+                return
+            self.active = False
+            relay.condition.notify_all()
+        relay.unsubscribe()
+
+
+class RelayManager():
+    """
+    Keeps one relay per sensor\n
+    onSensorEvent() can be registered with the sensor registry to drop relays of sensors that went away or moved
+    """
+
+    def __init__(self, buffsize=16384, grace_period=10, timeout=5, protocol='framed', udp_ttl=10,
+                 multicast_group='', multicast_port=0, health=None):
+        self.health = health
+        self.buffsize = buffsize
+        self.grace_period = grace_period
+        self.timeout = timeout
+        self.protocol = protocol
+        self.udp_ttl = udp_ttl
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.relays = {}
+        self.lock = Lock()
+
+    def get(self, sensor_id, addr):
+        with self.lock:
+            relay = self.relays.get(sensor_id)
+            if relay is None or relay.addr != addr:
+                if relay is not None:
+                    relay.close()
+                if self.protocol == 'udp':
+                    relay = DatagramSensorRelay(sensor_id, addr, self.buffsize, self.grace_period, self.timeout,
+                                                self.udp_ttl, self.multicast_group, self.multicast_port, self.health)
+                else:
+                    relay = SensorRelay(sensor_id, addr, self.buffsize, self.grace_period, self.timeout, self.protocol,
+                                        self.health)
+                self.relays[sensor_id] = relay
+            return relay
+
+    def getStats(self):
+        with self.lock:
+            relays = dict(self.relays)
+        return {sensor_id: relay.getStats() for sensor_id, relay in relays.items()}
+
+    def onSensorEvent(self, event, sensor_id, info):
+        if event == 'removed':
+            self.remove(sensor_id)
+        elif event == 'changed':
+            with self.lock:
+                relay = self.relays.get(sensor_id)
+            # a sensor that moved gets a new relay on the next request
+            if relay is not None and relay.addr != (info['host'], info['port']):
+                self.remove(sensor_id)
+
+    def remove(self, sensor_id):
+        with self.lock:
+            relay = self.relays.pop(sensor_id, None)
+        if relay is not None:
+            relay.close()
+
+    def closeAll(self):
+        with self.lock:
+            relays, self.relays = self.relays, {}
+        for relay in relays.values():
+            relay.close()
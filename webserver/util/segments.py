@@ -0,0 +1,103 @@
+'''
+@Summary: Contains readers for the segment files of the video archive written by pivideo
+@Author: devopsec
+
+Recordings are split into fixed duration segments stored under one directory per day:
+    <video_dir>/YYYY-MM-DD/YYYY-MM-DD_HH-MM-SS.mjpeg (or .h264)
+Each segment has a .idx sidecar with one fixed size entry per keyframe, which is every frame for mjpeg:
+    header:     magic (4s) version (H) entry size (H)
+    entries:    byte offset of the frame in the segment (Q) capture timestamp (d)
+Entries are appended in capture order so the index is sorted by timestamp and can be binary searched in place
+'''
+
+import os, mmap, struct
+
+INDEX_MAGIC = b'SHIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHH')
+INDEX_ENTRY = struct.Struct('<Qd')
+INDEX_EXTENSION = '.idx'
+DAY_FORMAT = '%Y-%m-%d'
+NAME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+def indexPath(segment_path):
+    return os.path.splitext(segment_path)[0] + INDEX_EXTENSION
+
+
+class SegmentIndex():
+    """
+    Memory mapped reader of a segment index\n
+    Lookups binary search the mapped entries, nothing is loaded up front
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    segment or index path
+        :type path:     str
+        :raises ValueError:     if the file is not a segment index
+        """
+
+        self.path = path if path.endswith(INDEX_EXTENSION) else indexPath(path)
+        self.map = None
+        with open(self.path, 'rb') as fp:
+            header = fp.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                raise ValueError('truncated index {}'.format(self.path))
+            magic, version, entry_size = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION or entry_size != INDEX_ENTRY.size:
+                raise ValueError('unsupported index {}'.format(self.path))
+            # an index still being written may end in a partial entry, ignore it
+            size = os.fstat(fp.fileno()).st_size
+            self.count = (size - INDEX_HEADER.size) // INDEX_ENTRY.size
+            if self.count > 0:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def entry(self, i):
+        """
+        :return:    byte offset and capture timestamp of frame i
+        :rtype:     tuple
+        """
+
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('frame index out of range')
+        return INDEX_ENTRY.unpack_from(self.map, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+    def timestamp(self, i):
+        return self.entry(i)[1]
+
+    def offset(self, i):
+        return self.entry(i)[0]
+
+    def find(self, timestamp):
+        """
+        Frame showing the given time, that is the last frame captured at or before it
+
+        :return:    frame number, 0 if timestamp is before the first frame
+        :rtype:     int
+        """
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None